@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+nginx -T 发现方式基准测试
+生成配置树（与 bench_suite 相同）和模拟 nginx -T 输出的桩程序，比较 include 和 dump 两种发现方式
+在冷索引和热索引下的耗时、本进程打开文件的次数（审计钩子统计 open 事件），
+并检查两种方式得到的配置文件和 server 块一致。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from bench_suite import generate_tree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ssl_bot  # noqa: E402
+
+# 按 nginx 的顺序（打开文件的顺序，深度优先）输出每个配置文件，同一文件只输出一次
+NGINX_STUB = r'''#!/usr/bin/env python3
+import os, re, sys, glob
+args = sys.argv[1:]
+if '-T' not in args:
+    sys.exit(0)
+conf = args[args.index('-c') + 1] if '-c' in args else '/etc/nginx/nginx.conf'
+prefix = os.path.dirname(conf)
+include = re.compile(rb'^\s*include\s+([^;]+);', re.M)
+seen = set()
+out = sys.stdout.buffer
+
+def dump(path):
+    if path in seen:
+        return
+    seen.add(path)
+    with open(path, 'rb') as f:
+        data = f.read()
+    out.write(b'# configuration file ' + path.encode() + b':\n' + data + b'\n')
+    for match in include.finditer(data):
+        pattern = match.group(1).decode().strip()
+        for found in sorted(glob.glob(os.path.join(prefix, pattern))):
+            dump(found)
+
+sys.stderr.write(f"nginx: the configuration file {conf} syntax is ok\n")
+dump(conf)
+'''
+
+opens = [0]
+
+
+def audit(event, args):
+    if event == 'open':
+        opens[0] += 1
+
+
+def discover(tree: str, discovery: str, index_path: str) -> tuple:
+    parser = ssl_bot.NginxConfigParser(tree, ssl_bot.ScanIndex(index_path), discovery)
+    opens[0] = 0
+    start = time.perf_counter()
+    config_files = parser.find_nginx_configs()
+    blocks = parser.parse_config_files(config_files)
+    seconds = time.perf_counter() - start
+    result = {'seconds': round(seconds, 3), 'opens': opens[0]}
+    parser.save_index()
+    return result, config_files, blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='nginx -T 发现方式基准测试')
+    parser.add_argument('--blocks', type=int, nargs='+', default=[10000, 100000], help='要测试的 server 块数量')
+    args = parser.parse_args()
+
+    sys.addaudithook(audit)
+    results = []
+    for count in args.blocks:
+        workdir = tempfile.mkdtemp(prefix='ssl-bot-bench-')
+        try:
+            tree = os.path.join(workdir, 'nginx')
+            os.makedirs(tree)
+            generated = generate_tree(tree, count)
+            bin_dir = os.path.join(workdir, 'bin')
+            os.makedirs(bin_dir)
+            with open(os.path.join(bin_dir, 'nginx'), 'w') as f:
+                f.write(NGINX_STUB)
+            os.chmod(os.path.join(bin_dir, 'nginx'), 0o755)
+            os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+
+            result = dict(generated)
+            found = {}
+            for discovery in ('include', 'dump'):
+                index_path = os.path.join(workdir, f"index-{discovery}.json")
+                cold, config_files, blocks = discover(tree, discovery, index_path)
+                warm, _, _ = discover(tree, discovery, index_path)
+                result[discovery] = {'config_files': len(config_files), 'cold': cold, 'warm': warm}
+                found[discovery] = {config_file: [block.to_row() for block in file_blocks]
+                                    for config_file, file_blocks in zip(config_files, blocks)}
+            result['identical'] = found['include'] == found['dump']
+            results.append(result)
+        finally:
+            shutil.rmtree(workdir)
+        print(f"{count} 个 server 块完成", file=sys.stderr)
+
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""
+多租户扫描基准测试
+生成多个容器风格的 Nginx 配置根目录（include 写的是容器内的 /etc/nginx 绝对路径），
+分别用 1 个进程和多个进程运行 SSLBot.fleet()，比较冷索引和热索引的耗时，
+并检查各根目录只发现了自己目录下的配置文件。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+from bench_suite import generate_tree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ssl_bot  # noqa: E402
+
+
+def generate_fleet(workdir: str, tenants: int, blocks: int) -> list:
+    """生成 tenants 个配置根目录，nginx.conf 中的 include 改为 /etc/nginx 下的绝对路径"""
+    roots = []
+    for n in range(tenants):
+        root = os.path.join(workdir, 'tenants', f"t{n}", 'etc', 'nginx')
+        os.makedirs(root)
+        generate_tree(root, blocks)
+        main_conf = os.path.join(root, 'nginx.conf')
+        with open(main_conf) as f:
+            text = f.read()
+        with open(main_conf, 'w') as f:
+            f.write(text.replace('include conf.d/', 'include /etc/nginx/conf.d/')
+                    .replace('include sites-enabled/', 'include /etc/nginx/sites-enabled/'))
+        roots.append(root)
+    return roots
+
+
+def timed_fleet(config: dict, pattern: str, jobs: int) -> tuple:
+    bot = ssl_bot.SSLBot(jobs=jobs)
+    bot.config = config
+    start = time.perf_counter()
+    result = bot.fleet([pattern])
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='多租户扫描基准测试')
+    parser.add_argument('--tenants', type=int, default=200, help='配置根目录数量')
+    parser.add_argument('--blocks', type=int, default=50, help='每个根目录的 server 块数量')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='并行扫描的进程数')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='ssl-bot-bench-')
+    try:
+        roots = generate_fleet(workdir, args.tenants, args.blocks)
+        pattern = os.path.join(workdir, 'tenants', '*', 'etc', 'nginx')
+        results = {'tenants': args.tenants, 'blocks_per_tenant': args.blocks, 'jobs': args.jobs}
+        for jobs in sorted({1, args.jobs}):
+            config = {'exclude_domains': ['localhost'], 'state_dir': os.path.join(workdir, f"state-{jobs}")}
+            cold, result = timed_fleet(config, pattern, jobs)
+            warm, _ = timed_fleet(config, pattern, jobs)
+            results[f"jobs_{jobs}"] = {'cold_seconds': round(cold, 3), 'warm_seconds': round(warm, 3)}
+
+        # /etc/nginx 的绝对 include 映射到根目录下后，每个根目录都能发现 nginx.conf 以外的文件
+        unmatched = [report['root'] for report in result['reports']
+                     if report['error'] or report['config_files'] <= 1]
+        results.update({key: result[key] for key in ('roots', 'config_files', 'server_blocks', 'needs_ssl',
+                                                      'certificates', 'errors')})
+        results['roots_matched'] = len(roots) == result['roots'] and not unmatched
+    finally:
+        shutil.rmtree(workdir)
+
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
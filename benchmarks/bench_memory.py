@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+内存基准测试
+生成配置树（与 bench_suite 相同）后，每个命令在单独的子进程中运行，测量进程峰值内存
+（ru_maxrss）和导入 ssl_bot 之后的增量：冷缓存的 scan_and_apply（certbot / nginx 用桩程序）、
+热缓存的 plan 和 status。把本文件复制到其他版本的 benchmarks/ 下运行即可对比。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+from bench_suite import generate_tree, write_stubs, write_config
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMANDS = ['scan_and_apply', 'plan', 'status']
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_command(command: str, config: str, jobs: int) -> dict:
+    """在当前进程中运行一个命令"""
+    sys.path.insert(0, ROOT)
+    import ssl_bot
+
+    baseline = peak_rss_kb()
+    start = time.perf_counter()
+    bot = ssl_bot.SSLBot(jobs=jobs, config_path=config, rebuild_index=command == 'scan_and_apply')
+    result = {}
+    if command == 'scan_and_apply':
+        result['ssl_applied'] = bot.scan_and_apply()
+        bot.finish()
+    elif command == 'plan':
+        result['certificates'] = len(bot.plan())
+    else:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            bot.status('ndjson')
+    peak = peak_rss_kb()
+    return dict(result, seconds=round(time.perf_counter() - start, 3), peak_rss_kb=peak,
+                delta_rss_kb=peak - baseline)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='内存基准测试')
+    parser.add_argument('--blocks', type=int, nargs='+', default=[10000, 100000], help='要测试的 server 块数量')
+    parser.add_argument('--jobs', type=int, default=1, help='并行解析的进程数')
+    parser.add_argument('--run-command', choices=COMMANDS, help=argparse.SUPPRESS)
+    parser.add_argument('--config', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_command:
+        print(json.dumps(run_command(args.run_command, args.config, args.jobs)))
+        return 0
+
+    results = []
+    for blocks in args.blocks:
+        workdir = tempfile.mkdtemp(prefix='ssl-bot-bench-')
+        try:
+            tree = os.path.join(workdir, 'nginx')
+            os.makedirs(tree)
+            generated = generate_tree(tree, blocks)
+            bin_dir = os.path.join(workdir, 'bin')
+            write_stubs(bin_dir, os.path.join(workdir, 'calls.log'), 0, 0, 0)
+            config = write_config(workdir, tree, os.path.join(bin_dir, 'certbot'), 1)
+            env = dict(os.environ, PATH=f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+            commands = {}
+            for command in COMMANDS:
+                cmd = [sys.executable, os.path.abspath(__file__), '--run-command', command, '--config', config,
+                       '--jobs', str(args.jobs)]
+                output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True, env=env).stdout
+                commands[command] = json.loads(output)
+            results.append(dict(generated, commands=commands))
+        finally:
+            shutil.rmtree(workdir)
+        print(f"{blocks} 个 server 块完成", file=sys.stderr)
+
+    print(json.dumps({'jobs': args.jobs, 'results': results}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+并行解析基准测试
+生成包含大量虚拟主机的 Nginx 配置树，比较不同进程数下的发现 + 解析耗时
+"""
+
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import argparse
+import tempfile
+
+from bench_parser import load_ssl_bot
+
+
+def generate_tree(root: str, vhosts: int):
+    """生成 nginx.conf + sites-available/sites-enabled 结构的配置树"""
+    available = os.path.join(root, 'sites-available')
+    enabled = os.path.join(root, 'sites-enabled')
+    os.makedirs(available)
+    os.makedirs(enabled)
+
+    with open(os.path.join(root, 'nginx.conf'), 'w') as f:
+        f.write('events {}\nhttp {\n    include sites-enabled/*;\n}\n')
+
+    for i in range(vhosts):
+        name = f'site{i}.example.io'
+        with open(os.path.join(available, name), 'w') as f:
+            f.write(f'''server {{
+    listen 80;
+    server_name {name} www.{name};
+    root /var/www/{name};
+    location / {{
+        try_files $uri $uri/ =404;
+    }}
+}}
+''')
+        os.symlink(os.path.join('..', 'sites-available', name), os.path.join(enabled, name))
+
+
+def bench(ssl_bot, root: str, jobs: int) -> dict:
+    parser = ssl_bot.NginxConfigParser(config_path=root, index=ssl_bot.ScanIndex(), jobs=jobs)
+    start = time.perf_counter()
+    config_files = parser.find_nginx_configs()
+    blocks = sum(len(server_blocks) for server_blocks in parser.parse_config_files(config_files))
+    elapsed = time.perf_counter() - start
+    return {'jobs': jobs, 'files': len(config_files), 'server_blocks': blocks, 'seconds': round(elapsed, 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='并行解析基准测试')
+    parser.add_argument('--vhosts', type=int, default=50000, help='生成的虚拟主机数量')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 4, 16], help='要测试的进程数')
+    args = parser.parse_args()
+
+    ssl_bot = load_ssl_bot()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    root = tempfile.mkdtemp(prefix='ssl-bot-bench-')
+    try:
+        generate_tree(root, args.vhosts)
+        results = [bench(ssl_bot, root, jobs) for jobs in args.jobs]
+    finally:
+        shutil.rmtree(root)
+
+    print(json.dumps({'vhosts': args.vhosts, 'cpu_count': os.cpu_count(), 'results': results}, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Nginx 配置解析器基准测试
+生成数 MB 的配置（嵌套 location、注释、引号），验证解析结果正确且耗时随输入线性增长
+"""
+
+import os
+import sys
+import time
+import json
+import logging
+import argparse
+import importlib.util
+
+
+def load_ssl_bot():
+    """按文件路径加载 ssl-bot.py（文件名带连字符，不能直接 import）"""
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ssl-bot.py')
+    spec = importlib.util.spec_from_file_location('ssl_bot', path)
+    module = importlib.util.module_from_spec(spec)
+    # 注册到 sys.modules，进程池才能按模块名 pickle 其中的函数
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def generate_config(servers: int) -> str:
+    """生成包含 servers 个 server 块的配置"""
+    parts = []
+    for i in range(servers):
+        # listen 443 放在嵌套 location 之后，旧的 [^}]+ 正则会在第一个 } 处截断而漏掉
+        parts.append(f'''# vhost {i} {{ not a block }}
+server {{
+    listen 80;
+    server_name site{i}.example.io www.site{i}.example.io;
+    root "/var/www/site {i}";
+    location / {{
+        try_files $uri $uri/ =404;
+        location ~* "\\.(css|js)$" {{ expires 1y; add_header Cache-Control "public; max-age=31536000"; }}
+    }}
+    location ~ /\\.ht {{ deny all; }}
+    listen {443 if i % 2 else 8443} ssl;
+}}
+''')
+    return ''.join(parts)
+
+
+def bench(ssl_bot, servers: int, repeat: int) -> dict:
+    text = generate_config(servers)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        blocks = list(ssl_bot.iter_server_directives(text))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # 正确性：每个 server 块都完整保留了嵌套 location 之后的指令
+    assert len(blocks) == servers, (len(blocks), servers)
+    for i, block in enumerate(blocks):
+        names = [name for d in block.find('server_name') for name in d.args]
+        assert names == [f'site{i}.example.io', f'www.site{i}.example.io'], names
+        assert block.find('root')[0].args == [f'/var/www/site {i}']
+        assert len(block.find('location')) == 2
+        assert block.find('listen')[-1].args == [str(443 if i % 2 else 8443), 'ssl']
+
+    size_mb = len(text) / (1024 * 1024)
+    return {
+        'servers': servers,
+        'size_mb': round(size_mb, 2),
+        'seconds': round(best, 4),
+        'mb_per_second': round(size_mb / best, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Nginx 配置解析器基准测试')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2500, 5000, 10000, 20000],
+                        help='每次生成的 server 块数量')
+    parser.add_argument('--repeat', type=int, default=3, help='每个规模重复次数（取最快）')
+    args = parser.parse_args()
+
+    ssl_bot = load_ssl_bot()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = [bench(ssl_bot, servers, args.repeat) for servers in args.sizes]
+
+    # 线性时间：吞吐量（MB/s）在各规模间应基本一致
+    rates = [r['mb_per_second'] for r in results]
+    linear = max(rates) / min(rates) < 1.5
+    print(json.dumps({'results': results, 'linear': linear}, indent=2))
+    return 0 if linear else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
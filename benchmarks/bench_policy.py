@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+域名策略基准测试
+生成大量域名（多级公共后缀、国际化域名、排除和无效域名混合），测量 DomainPolicy
+的判定吞吐量（首次判定和缓存命中）以及按公共后缀列表计算注册域的吞吐量，
+并与原来的逐条子串匹配实现对比（排除列表越长差距越大）。
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ssl_bot  # noqa: E402
+
+SUFFIXES = ['com', 'io', 'co.uk', 'com.cn', 'github.io', 'kawasaki.jp', 'xn--55qx5d.cn', 'lan']
+EXCLUDE = ['localhost', 'test.', 'staging.', 'dev.', 'internal.', 'example.', '*.corp.example.net']
+
+
+def generate_domains(count: int) -> list:
+    domains = []
+    for i in range(count):
+        prefix = ('staging', 'www', 'api', 'a.b')[i % 4] if i % 5 else 'dev'
+        domains.append(f"{prefix}.site{i}.{SUFFIXES[i % len(SUFFIXES)]}")
+    return domains
+
+
+def legacy_classify(domain: str, exclude_domains: list) -> str:
+    """原来的判定方式：逐条子串匹配，每次调用重新导入 re 并编译正则"""
+    if any(excluded in domain for excluded in exclude_domains):
+        return 'excluded'
+    invalid_domains = ['localhost', 'localdomain', 'example.com', 'test.com',
+                       'invalid.com', 'example.org', 'test.org', 'example.net']
+    if domain in invalid_domains or domain.endswith('.local') or domain.endswith('.home') or domain.endswith('.lan'):
+        return 'invalid'
+    domain_pattern = (r'^[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?'
+                      r'(\.[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*\.[a-zA-Z]{2,}$')
+    return 'allowed' if re.match(domain_pattern, domain) else 'invalid'
+
+
+def per_ms(count: int, seconds: float) -> int:
+    return int(count / seconds / 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='域名策略基准测试')
+    parser.add_argument('--domains', type=int, default=200000, help='生成的域名数量')
+    parser.add_argument('--extra-excludes', type=int, default=200, help='额外加入排除列表的条目数')
+    args = parser.parse_args()
+
+    domains = generate_domains(args.domains)
+    exclude = EXCLUDE + [f"tenant{i}." for i in range(args.extra_excludes)]
+    load_start = time.perf_counter()
+    ssl_bot.public_suffix_list()
+    load_ms = (time.perf_counter() - load_start) * 1000
+
+    legacy_exclude = [entry for entry in exclude if not entry.startswith('*.')]
+    start = time.perf_counter()
+    for domain in domains:
+        legacy_classify(domain, legacy_exclude)
+    legacy = time.perf_counter() - start
+
+    policy = ssl_bot.DomainPolicy(exclude)
+    start = time.perf_counter()
+    verdicts = [policy.classify(domain) for domain in domains]
+    cold = time.perf_counter() - start
+    start = time.perf_counter()
+    for domain in domains:
+        policy.classify(domain)
+    warm = time.perf_counter() - start
+
+    start = time.perf_counter()
+    registered = {policy.registered_domain(domain) for domain in domains}
+    grouping = time.perf_counter() - start
+
+    print(json.dumps({
+        'domains': len(domains),
+        'exclude_entries': len(exclude),
+        'psl_load_ms': round(load_ms, 1),
+        'verdicts': {verdict: verdicts.count(verdict) for verdict in sorted(set(verdicts))},
+        'registered_domains': len(registered),
+        'legacy_classify_per_ms': per_ms(len(domains), legacy),
+        'classify_per_ms': per_ms(len(domains), cold),
+        'classify_cached_per_ms': per_ms(len(domains), warm),
+        'registered_domain_per_ms': per_ms(len(domains), grouping),
+    }, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+启动耗时基准测试
+在生成的配置树上先运行一次 --status 预热扫描索引、状态库和证书清单缓存，
+然后多次运行 --status，统计进程启动到退出的耗时（目标: 缓存预热后 < 50 ms）。
+同时测量直接运行 ssl-bot.py（每次重新编译脚本）和经 ssl_bot.py 入口运行（使用缓存的字节码）
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+from bench_parallel import generate_tree
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TARGET_MS = 50
+
+
+def write_config(workdir: str, tree: str) -> str:
+    """生成指向临时目录的配置文件（JSON 是 YAML 的子集）"""
+    config = {
+        'nginx': {'config_path': tree, 'scan_index': os.path.join(workdir, 'scan-index.json')},
+        'state_dir': os.path.join(workdir, 'state'),
+        'certbot': {'config_dir': os.path.join(workdir, 'letsencrypt')},
+        'preflight': {'enabled': False},
+    }
+    path = os.path.join(workdir, 'config.yaml')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def timed_runs(cmd: list, runs: int) -> list:
+    """运行 runs 次，返回每次的耗时（毫秒）"""
+    # 与生产环境一致，允许写入 __pycache__ 字节码缓存
+    env = {key: value for key, value in os.environ.items() if key != 'PYTHONDONTWRITEBYTECODE'}
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True, env=env)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def summary(timings: list) -> dict:
+    return {'min_ms': round(min(timings), 1), 'median_ms': round(statistics.median(timings), 1),
+            'max_ms': round(max(timings), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='启动耗时基准测试')
+    parser.add_argument('--vhosts', type=int, default=100, help='生成的虚拟主机数量')
+    parser.add_argument('--runs', type=int, default=20, help='每项测量的运行次数')
+    args = parser.parse_args()
+
+    python = sys.executable
+    script = os.path.join(ROOT, 'ssl-bot.py')
+    entry = os.path.join(ROOT, 'ssl_bot.py')
+    workdir = tempfile.mkdtemp(prefix='ssl-bot-bench-')
+    try:
+        tree = os.path.join(workdir, 'nginx')
+        os.makedirs(tree)
+        generate_tree(tree, args.vhosts)
+        config = write_config(workdir, tree)
+        status = ['--config', config, '--status', '--format', 'ndjson']
+
+        # 冷启动：解析全部配置并写入缓存
+        cold = timed_runs([python, entry, *status], 1)[0]
+        results = {
+            'vhosts': args.vhosts,
+            'cold_status_ms': round(cold, 1),
+            'interpreter': summary(timed_runs([python, '-c', 'pass'], args.runs)),
+            'import': summary(timed_runs([python, '-c', f'import sys; sys.path.insert(0, {ROOT!r}); import ssl_bot'],
+                                         args.runs)),
+            'help': summary(timed_runs([python, entry, '--help'], args.runs)),
+            'warm_status_script': summary(timed_runs([python, script, *status], args.runs)),
+            'warm_status': summary(timed_runs([python, entry, *status], args.runs)),
+        }
+    finally:
+        shutil.rmtree(workdir)
+
+    results['target_ms'] = TARGET_MS
+    results['within_target'] = results['warm_status']['median_ms'] < TARGET_MS
+    print(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+扩展性基准测试
+生成 1k ~ 100k 个 server 块的 Nginx 配置树（嵌套 location、include、软链接、注释），
+用带可配置延迟的 certbot / nginx / systemctl 桩程序代替真实命令，分别测量
+find_nginx_configs、parse_server_blocks、needs_ssl、scan_and_apply、status、list_domains
+的耗时和进程峰值内存，输出可跨版本比较的 JSON。
+
+每个规模在单独的子进程中运行，峰值内存互不影响。
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def generate_tree(root: str, blocks: int, blocks_per_file: int = 10, ssl_ratio: float = 0.2,
+                  disabled_ratio: float = 0.1) -> dict:
+    """生成配置树，返回统计信息
+
+    - nginx.conf include conf.d/*.conf 和 sites-enabled/*
+    - 每个站点文件包含 blocks_per_file 个 server 块，server 块内 include 公共片段
+    - 按 ssl_ratio 的比例已配置 SSL，按 disabled_ratio 的比例只在 sites-available 中（未启用）
+    """
+    for directory in ('conf.d', 'snippets', 'sites-available', 'sites-enabled'):
+        os.makedirs(os.path.join(root, directory))
+
+    with open(os.path.join(root, 'nginx.conf'), 'w') as f:
+        f.write('''# 基准测试生成的主配置
+user www-data;
+worker_processes auto;
+events { worker_connections 1024; }  # 注释中的 { 不是块
+http {
+    sendfile on;
+    include conf.d/*.conf;
+    include sites-enabled/*;
+}
+''')
+    with open(os.path.join(root, 'conf.d', 'default.conf'), 'w') as f:
+        f.write('server {\n    listen 80 default_server;\n    server_name _;\n    return 444;\n}\n')
+    with open(os.path.join(root, 'snippets', 'common.conf'), 'w') as f:
+        f.write('''location ~ /\\.(?!well-known) { deny all; }
+location = /robots.txt { access_log off; log_not_found off; }
+''')
+
+    files = (blocks + blocks_per_file - 1) // blocks_per_file
+    ssl_every = int(1 / ssl_ratio) if ssl_ratio else 0
+    disabled_every = int(1 / disabled_ratio) if disabled_ratio else 0
+    enabled_blocks = 0
+    for n in range(files):
+        zone = f"d{n}.io"
+        parts = [f"# site file {n} {{ braces in comments are ignored }}\n"]
+        for i in range(n * blocks_per_file, min(blocks, (n + 1) * blocks_per_file)):
+            name = f"site{i}.{zone}"
+            ssl = ssl_every and i % ssl_every == 0
+            listen = (f"    listen 443 ssl;\n    ssl_certificate /etc/letsencrypt/live/{zone}/fullchain.pem;\n"
+                      f"    ssl_certificate_key /etc/letsencrypt/live/{zone}/privkey.pem;\n" if ssl else
+                      "    listen 80;\n    listen [::]:80;\n")
+            parts.append(f'''server {{
+{listen}    server_name {name} www.{name};
+    root "/var/www/{name}/html";
+    index index.html;
+    include snippets/common.conf;
+
+    location / {{
+        try_files $uri $uri/ =404;
+        location ~* \\.(css|js|png)$ {{
+            expires 30d;
+            add_header Cache-Control "public; max-age=2592000";
+        }}
+    }}
+    location /api/ {{
+        proxy_pass http://127.0.0.1:{8000 + i % 1000};
+        proxy_set_header Host $host;  # }} 引号外的注释
+    }}
+}}
+''')
+        filename = f"{zone}.conf"
+        with open(os.path.join(root, 'sites-available', filename), 'w') as f:
+            f.write(''.join(parts))
+        if disabled_every and n % disabled_every == disabled_every - 1:
+            continue
+        enabled_blocks += min(blocks, (n + 1) * blocks_per_file) - n * blocks_per_file
+        os.symlink(os.path.join('..', 'sites-available', filename), os.path.join(root, 'sites-enabled', filename))
+
+    return {'server_blocks': blocks, 'site_files': files, 'enabled_server_blocks': enabled_blocks}
+
+
+def write_stubs(bin_dir: str, log_path: str, certbot_latency: float, nginx_latency: float,
+                systemctl_latency: float):
+    """生成桩程序：按指定延迟 sleep 后成功退出，并把调用参数记入日志"""
+    os.makedirs(bin_dir)
+    for name, latency in (('certbot', certbot_latency), ('nginx', nginx_latency),
+                          ('systemctl', systemctl_latency)):
+        path = os.path.join(bin_dir, name)
+        with open(path, 'w') as f:
+            f.write(f'#!/bin/sh\necho "{name} $*" >> "{log_path}"\n')
+            if latency:
+                f.write(f'sleep {latency}\n')
+            f.write('exit 0\n')
+        os.chmod(path, 0o755)
+
+
+def write_config(workdir: str, tree: str, certbot: str, workers: int) -> str:
+    """生成指向临时目录的配置文件（JSON 是 YAML 的子集）"""
+    unlimited = {'limit': 10 ** 9, 'period': 1}
+    config = {
+        'exclude_domains': ['localhost'],
+        'nginx': {'config_path': tree, 'scan_index': os.path.join(workdir, 'scan-index.json')},
+        'state_dir': os.path.join(workdir, 'state'),
+        'certbot': {'command': certbot, 'config_dir': os.path.join(workdir, 'letsencrypt'), 'workers': workers,
+                    'rate_limits': {'per_registered_domain': unlimited, 'global': unlimited}},
+        'preflight': {'enabled': False},
+    }
+    path = os.path.join(workdir, 'config.yaml')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Stages:
+    """依次记录各阶段的耗时和结束时的进程峰值内存"""
+
+    def __init__(self):
+        self.results = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **extra):
+        start = time.perf_counter()
+        yield extra
+        self.results[name] = dict(extra, seconds=round(time.perf_counter() - start, 4),
+                                  peak_rss_kb=peak_rss_kb())
+
+
+def run_one(args) -> dict:
+    """在当前进程中对一个规模运行所有阶段"""
+    sys.path.insert(0, ROOT)
+    import ssl_bot
+
+    workdir = tempfile.mkdtemp(prefix='ssl-bot-bench-')
+    try:
+        tree = os.path.join(workdir, 'nginx')
+        os.makedirs(tree)
+        generated = generate_tree(tree, args.blocks[0], args.blocks_per_file, args.ssl_ratio, args.disabled_ratio)
+        bin_dir = os.path.join(workdir, 'bin')
+        calls_log = os.path.join(workdir, 'calls.log')
+        write_stubs(bin_dir, calls_log, args.certbot_latency, args.nginx_latency, args.systemctl_latency)
+        os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+        config = write_config(workdir, tree, os.path.join(bin_dir, 'certbot'), args.workers)
+
+        stages = Stages()
+        baseline_rss = peak_rss_kb()
+
+        # 发现：从 nginx.conf 展开 include（发现过程中会解析各文件的 include）
+        bot = ssl_bot.SSLBot(jobs=args.jobs, config_path=config)
+        with stages.stage('find_nginx_configs') as extra:
+            config_files = bot.nginx_parser.find_nginx_configs()
+            extra['files'] = len(config_files)
+
+        # 解析：不使用缓存，逐个文件串行解析
+        parser = ssl_bot.NginxConfigParser(config_path=tree, index=ssl_bot.ScanIndex())
+        with stages.stage('parse_server_blocks') as extra:
+            server_blocks = [block for config_file in config_files
+                             for block in parser.parse_server_blocks(config_file)]
+            extra['server_blocks'] = len(server_blocks)
+
+        with stages.stage('needs_ssl') as extra:
+            extra['needs_ssl'] = sum(1 for block in server_blocks if bot.ssl_manager.needs_ssl(block))
+        del parser, server_blocks, config_files
+
+        # 完整运行（冷缓存）：发现、解析、判定、规划、调用 certbot 桩程序、重载
+        bot = ssl_bot.SSLBot(jobs=args.jobs, config_path=config, rebuild_index=True)
+        with stages.stage('scan_and_apply') as extra:
+            extra['ssl_applied'] = bot.scan_and_apply()
+            bot.finish()
+        with open(calls_log) as f:
+            stages.results['scan_and_apply']['certbot_calls'] = sum(1 for line in f if line.startswith('certbot '))
+
+        # 缓存预热后的只读命令（新的 SSLBot 实例，与命令行运行一致）
+        bot = ssl_bot.SSLBot(jobs=args.jobs, config_path=config)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with stages.stage('status') as extra:
+                bot.status('ndjson')
+        domain_manager = ssl_bot.DomainManager(bot.config, bot.nginx_parser, bot.reload_coordinator, bot.store)
+        with stages.stage('list_domains') as extra:
+            extra['domains'] = len(domain_manager.list_domains())
+
+        return dict(generated, baseline_rss_kb=baseline_rss, stages=stages.results)
+    finally:
+        shutil.rmtree(workdir)
+
+
+def version_info() -> dict:
+    """被测版本：git 提交和 ssl-bot.py 的内容摘要"""
+    with open(os.path.join(ROOT, 'ssl-bot.py'), 'rb') as f:
+        info = {'ssl_bot_sha1': hashlib.sha1(f.read()).hexdigest()}
+    try:
+        info['git_commit'] = subprocess.run(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'], check=True,
+                                            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description='扩展性基准测试')
+    parser.add_argument('--blocks', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='要测试的 server 块数量')
+    parser.add_argument('--blocks-per-file', type=int, default=10, help='每个站点文件的 server 块数量')
+    parser.add_argument('--ssl-ratio', type=float, default=0.2, help='已配置 SSL 的 server 块比例')
+    parser.add_argument('--disabled-ratio', type=float, default=0.1, help='未启用的站点文件比例')
+    parser.add_argument('--certbot-latency', type=float, default=0, help='certbot 桩程序的延迟（秒）')
+    parser.add_argument('--nginx-latency', type=float, default=0, help='nginx 桩程序的延迟（秒）')
+    parser.add_argument('--systemctl-latency', type=float, default=0, help='systemctl 桩程序的延迟（秒）')
+    parser.add_argument('--workers', type=int, default=1, help='certbot 并发数')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help='并行解析的进程数')
+    parser.add_argument('--output', type=str, help='结果写入文件（默认输出到标准输出）')
+    parser.add_argument('--run-one', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        print(json.dumps(run_one(args)))
+        return 0
+
+    results = []
+    for blocks in args.blocks:
+        cmd = [sys.executable, os.path.abspath(__file__), '--run-one', '--blocks', str(blocks)]
+        for option in ('blocks_per_file', 'ssl_ratio', 'disabled_ratio', 'certbot_latency', 'nginx_latency',
+                       'systemctl_latency', 'workers', 'jobs'):
+            cmd += [f"--{option.replace('_', '-')}", str(getattr(args, option))]
+        output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.append(json.loads(output))
+        print(f"{blocks} 个 server 块完成", file=sys.stderr)
+
+    report = json.dumps({
+        'version': version_info(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('blocks', 'output', 'run_one')},
+        'results': results,
+    }, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
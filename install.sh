@@ -260,10 +260,10 @@ update_cron_for_venv() {
     # 创建新的 cron 任务
     cat > "/etc/cron.d/ssl-bot-renew" << EOF
 # SSL Bot 自动续签 - 每天凌晨检查
-0 2 * * * root $venv_dir/bin/python3 /opt/ssl-bot/ssl-bot.py --renew >> /var/log/ssl-bot-cron.log 2>&1
+0 2 * * * root $venv_dir/bin/python3 /opt/ssl-bot/ssl_bot.py --renew >> /var/log/ssl-bot-cron.log 2>&1
 
 # SSL Bot 自动扫描 - 每周扫描新域名
-0 3 * * 0 root $venv_dir/bin/python3 /opt/ssl-bot/ssl-bot.py --scan-and-apply >> /var/log/ssl-bot-cron.log 2>&1
+0 3 * * 0 root $venv_dir/bin/python3 /opt/ssl-bot/ssl_bot.py --scan-and-apply >> /var/log/ssl-bot-cron.log 2>&1
 EOF
     
     log "更新 cron 任务配置"
@@ -282,7 +282,7 @@ download_ssl_bot() {
     
     # 检查所有文件是否都已存在
     all_files_exist=true
-    for file in ssl-bot.py nginx-utils.sh config.yaml; do
+    for file in ssl-bot.py ssl_bot.py nginx-utils.sh config.yaml public_suffix_list.dat; do
         if [ ! -f "$INSTALL_DIR/$file" ]; then
             all_files_exist=false
             break
@@ -302,7 +302,7 @@ download_ssl_bot() {
     fi
     
     # 下载核心文件
-    for file in ssl-bot.py nginx-utils.sh config.yaml; do
+    for file in ssl-bot.py ssl_bot.py nginx-utils.sh config.yaml public_suffix_list.dat; do
         # 如果文件已存在，跳过下载
         if [ -f "$INSTALL_DIR/$file" ]; then
             log "文件已存在，跳过: $file"
@@ -328,6 +328,7 @@ download_ssl_bot() {
     done
     
     chmod +x $INSTALL_DIR/ssl-bot.py
+    chmod +x $INSTALL_DIR/ssl_bot.py
     chmod +x $INSTALL_DIR/nginx-utils.sh
 }
 
@@ -353,10 +354,10 @@ EOF
     # 创建定时任务自动续签
     cat > /etc/cron.d/ssl-bot-renew << EOF
 # SSL Bot 自动续签 - 每天凌晨检查
-0 2 * * * root $INSTALL_DIR/ssl-bot.py --renew > /dev/null 2>&1
+0 2 * * * root $INSTALL_DIR/ssl_bot.py --renew > /dev/null 2>&1
 
 # SSL Bot 自动扫描 - 每周扫描新域名
-0 3 * * 0 root $INSTALL_DIR/ssl-bot.py --scan-and-apply > /dev/null 2>&1
+0 3 * * 0 root $INSTALL_DIR/ssl_bot.py --scan-and-apply > /dev/null 2>&1
 EOF
 }
 
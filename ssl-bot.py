@@ -6,60 +6,845 @@ SSL Bot - 自动 SSL 证书管理工具
 
 import os
 import re
+import abc
+import csv
+import glob
 import sys
-import yaml
+import json
+import time
+import select
+import signal
+import struct
+import sqlite3
+import threading
+import shlex
+import shutil
+import base64
+import calendar
+import hashlib
 import logging
+import itertools
 import subprocess
 import argparse
-from pathlib import Path
-from typing import List, Dict, Optional
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/var/log/ssl-bot.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+import contextlib
+from collections import deque
+from functools import cached_property, lru_cache
+from typing import List, Dict, Optional, Iterator, Iterable, Tuple, Set
+
+__all__ = [
+    'NginxConfigParser', 'NginxDirective', 'NginxConfigSyntaxError', 'ScanIndex', 'ReloadCoordinator',
+    'CertificateInventory', 'StateStore', 'SSLCertManager', 'IssuancePlanner', 'IssuanceScheduler',
+    'PreflightChecker', 'AcmeClient', 'AcmeError', 'DnsBackend', 'Rfc2136Backend', 'HookDnsBackend',
+    'DnsUpdateError', 'NginxSSLInstaller', 'RecordWriter', 'SSLBot', 'ServerBlock',
+    'DomainManager', 'parse_nginx_config', 'iter_server_directives', 'parse_certificate',
+    'classify_certbot_error', 'PublicSuffixList', 'DomainPolicy', 'registered_domain', 'setup_logging', 'Metrics', 'metrics', 'main',
+]
+
+# 作为库导入时不做任何配置，日志由调用方决定；命令行入口调用 setup_logging()
 logger = logging.getLogger(__name__)
 
+DEFAULT_CONFIG = "/opt/ssl-bot/config.yaml"
+DEFAULT_LOG_FILE = "/var/log/ssl-bot.log"
+DEFAULT_STATE_DIR = "/var/lib/ssl-bot"
+DEFAULT_CHALLENGE_WEBROOT = "/var/www/letsencrypt"
+# 验证路径片段默认放在 Nginx 配置根目录下
+DEFAULT_CHALLENGE_SNIPPET = "snippets/ssl-bot-acme-challenge.conf"
+DEFAULT_NGINX_ROOT = "/etc/nginx"
+# 源码编译和 BSD 上的 Nginx 配置目录，只在使用默认配置根目录时查找
+HOST_NGINX_ROOTS = ["/usr/local/nginx/conf", "/usr/local/etc/nginx"]
+LETSENCRYPT_DIRECTORY = "https://acme-v02.api.letsencrypt.org/directory"
+LETSENCRYPT_STAGING_DIRECTORY = "https://acme-staging-v02.api.letsencrypt.org/directory"
+DEFAULT_SCAN_INDEX = "/var/lib/ssl-bot/scan-index.json"
+# 公共后缀列表：优先使用系统的（随发行版更新），没有时使用随 ssl-bot 发布的快照
+PUBLIC_SUFFIX_LIST_PATHS = [
+    "/usr/share/publicsuffix/public_suffix_list.dat",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "public_suffix_list.dat"),
+]
+
+# 待解析文件少于该数量时串行解析（进程池启动开销大于收益）
+PARALLEL_PARSE_MIN_FILES = 256
+# 每批交给子进程的最大文件数
+PARALLEL_PARSE_MAX_CHUNK = 512
+# 流水线中每批同步到状态库并判定的配置文件数
+PIPELINE_CHUNK_FILES = 256
+# 每批并发预检的 server 块数
+PREFLIGHT_CHUNK_BLOCKS = 1024
+# nginx -T 输出中每个配置文件之前的标记行：# configuration file /etc/nginx/nginx.conf:
+NGINX_DUMP_MARKER = b"# configuration file "
+NGINX_DUMP_TIMEOUT = 120
+
+
+def setup_logging(log_file: Optional[str] = DEFAULT_LOG_FILE, stream=None):
+    """配置日志：写入日志文件（无权限时跳过）和标准输出"""
+    handlers = [logging.StreamHandler(stream or sys.stdout)]
+    if log_file:
+        try:
+            handlers.append(logging.FileHandler(log_file))
+        except OSError as e:
+            print(f"无法写入日志文件 {log_file}: {e}", file=sys.stderr)
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=handlers
+    )
+
+
+class Metrics:
+    """本进程的运行指标：各阶段耗时、计数器和证书过期时间
+
+    运行结束时写成 node_exporter textfile collector 格式。计数器从进程启动开始累计
+    （单次运行即本次的值，守护进程为启动以来的累计值）。线程安全。
+
+    流水线各阶段（解析、判定、预检、规划、申请）交替执行，用 timed() 包装各阶段的迭代器，
+    只统计各阶段自身的耗时；外层的 span() 和 timed() 都不再重复计入。
+    """
+
+    COUNTERS = {
+        'config_files_scanned': '发现的生效配置文件数',
+        'config_files_parsed': '实际解析（扫描索引未命中）的配置文件数',
+        'server_blocks_parsed': '解析得到的 server 块数',
+        'certbot_invocations': 'certbot 调用次数',
+        'certbot_failures': 'certbot 调用失败次数',
+        'issuance_failures': '证书申请失败次数',
+        'renewals': '续签的证书数',
+        'renewal_failures': '续签失败的证书数',
+        'nginx_tests': 'nginx -t 次数',
+        'nginx_reloads': 'Nginx 重载次数',
+        'nginx_reload_failures': 'Nginx 配置测试或重载失败次数',
+    }
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.phases: Dict[str, List[float]] = {}
+        self.counters: Dict[str, float] = {}
+        self.expiry: Optional[Dict[str, Tuple[str, int]]] = None
+        # 当前线程中已计入流水线阶段的耗时
+        self._local = threading.local()
+
+    def record(self, phase: str, seconds: float, calls: int = 1):
+        with self._lock:
+            entry = self.phases.setdefault(phase, [0.0, 0])
+            entry[0] += seconds
+            entry[1] += calls
+
+    def _enter(self) -> Tuple[float, float]:
+        outer = getattr(self._local, 'nested', 0.0)
+        self._local.nested = 0.0
+        return outer, time.perf_counter()
+
+    def _exit(self, outer: float, start: float, pipeline: bool) -> float:
+        """返回扣除内层流水线阶段后的耗时；pipeline 为 True 时本段耗时计入外层"""
+        elapsed = time.perf_counter() - start
+        own = elapsed - self._local.nested
+        self._local.nested = outer + (elapsed if pipeline else self._local.nested)
+        return own
+
+    @contextlib.contextmanager
+    def span(self, phase: str):
+        """统计代码块的耗时（同名阶段累加，不含其中流水线阶段的耗时）"""
+        outer, start = self._enter()
+        try:
+            yield
+        finally:
+            self.record(phase, self._exit(outer, start, False))
+
+    def timed(self, phase: str, iterable: Iterable) -> Iterator:
+        """包装流水线阶段的迭代器，只统计生成各项时本阶段自身的耗时"""
+        iterator = iter(iterable)
+        own = 0.0
+        try:
+            while True:
+                outer, start = self._enter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    own += self._exit(outer, start, True)
+                yield item
+        finally:
+            self.record(phase, own)
+
+    def inc(self, name: str, value: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_certificates(self, lineages: Dict[str, Dict]):
+        """记录每张证书的主域名和过期时间"""
+        with self._lock:
+            self.expiry = {name: ((info.get('domains') or [''])[0], info['not_after'])
+                           for name, info in lineages.items()}
+
+    def summary(self) -> str:
+        """各阶段耗时摘要（用于日志）"""
+        with self._lock:
+            phases = sorted(self.phases.items(), key=lambda item: -item[1][0])
+        return ', '.join(f"{phase} {seconds:.2f}s" + (f"×{calls}" if calls > 1 else '')
+                         for phase, (seconds, calls) in phases)
+
+    @staticmethod
+    def _label(value: str) -> str:
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self, command: str) -> str:
+        """本进程的耗时和计数器（带 command 标签，不同命令写入不同文件不会重复）"""
+        label = f'command="{self._label(command)}"'
+        with self._lock:
+            phases = sorted(self.phases.items())
+            counters = dict(self.counters)
+        lines = [
+            '# HELP ssl_bot_phase_seconds_total 各阶段累计耗时（秒）',
+            '# TYPE ssl_bot_phase_seconds_total counter',
+            *(f'ssl_bot_phase_seconds_total{{{label},phase="{self._label(phase)}"}} {seconds:.6f}'
+              for phase, (seconds, _) in phases),
+            '# HELP ssl_bot_phase_calls_total 各阶段执行次数',
+            '# TYPE ssl_bot_phase_calls_total counter',
+            *(f'ssl_bot_phase_calls_total{{{label},phase="{self._label(phase)}"}} {calls}'
+              for phase, (_, calls) in phases),
+        ]
+        for name, help_text in self.COUNTERS.items():
+            lines += [f'# HELP ssl_bot_{name}_total {help_text}', f'# TYPE ssl_bot_{name}_total counter',
+                      f'ssl_bot_{name}_total{{{label}}} {counters.get(name, 0):g}']
+        lines += [
+            '# HELP ssl_bot_last_run_timestamp_seconds 最近一次写入指标的时间',
+            '# TYPE ssl_bot_last_run_timestamp_seconds gauge',
+            f'ssl_bot_last_run_timestamp_seconds{{{label}}} {time.time():.3f}',
+            '# HELP ssl_bot_process_start_time_seconds 进程启动时间',
+            '# TYPE ssl_bot_process_start_time_seconds gauge',
+            f'ssl_bot_process_start_time_seconds{{{label}}} {self.started:.3f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def render_certificates(self) -> str:
+        with self._lock:
+            expiry = sorted((self.expiry or {}).items())
+        lines = [
+            '# HELP ssl_bot_certificate_expiry_timestamp_seconds 证书过期时间',
+            '# TYPE ssl_bot_certificate_expiry_timestamp_seconds gauge',
+            *(f'ssl_bot_certificate_expiry_timestamp_seconds{{lineage="{self._label(name)}",'
+              f'domain="{self._label(domain)}"}} {not_after}' for name, (domain, not_after) in expiry),
+            '# HELP ssl_bot_certificates 证书数量',
+            '# TYPE ssl_bot_certificates gauge',
+            f'ssl_bot_certificates {len(expiry)}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, directory: str, command: str):
+        """原子写入 ssl_bot_<命令>.prom；本次读取过证书清单时同时写入 ssl_bot_certificates.prom"""
+        files = {f"ssl_bot_{re.sub(r'[^A-Za-z0-9_]', '_', command)}.prom": self.render(command)}
+        if self.expiry is not None:
+            files['ssl_bot_certificates.prom'] = self.render_certificates()
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for name, content in files.items():
+                # node_exporter 只读取 .prom 文件，临时文件不会被读到一半
+                tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+                with open(tmp_path, 'w') as f:
+                    f.write(content)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, os.path.join(directory, name))
+        except OSError as e:
+            logger.error(f"写入指标文件失败 {directory}: {e}")
+
+
+# 本进程共用的指标（写入由命令行入口在运行结束时完成）
+metrics = Metrics()
+
+
+def iter_chunks(iterable: Iterable, size: int) -> Iterator[List]:
+    """把可迭代对象按 size 个一批切分"""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class ScanIndex:
+    """Nginx 配置扫描索引
+
+    按 路径/inode/mtime/size 记录每个配置文件的解析结果（内容哈希兜底），
+    未变化的文件直接从索引读取，只有新增或修改过的文件才会重新解析。
+    server 块以紧凑记录（ServerBlock.to_row()）保存。
+    """
+
+    VERSION = 4
+
+    def __init__(self, index_path: Optional[str] = None, rebuild: bool = False):
+        self.index_path = index_path
+        self.entries: Dict[str, Dict] = {}
+        self.hits = 0
+        self.misses = 0
+        self._checked: Dict[str, Optional[Dict]] = {}
+        self._dirty = False
+
+        if index_path and not rebuild:
+            self.load()
+        elif rebuild:
+            logger.info("重建扫描索引")
+            self._dirty = True
+
+    def load(self):
+        """从磁盘加载索引"""
+        try:
+            with open(self.index_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION:
+                self.entries = data.get('entries', {})
+            else:
+                logger.info("扫描索引版本不匹配，将重新生成")
+                self._dirty = True
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"加载扫描索引失败，将重新生成: {e}")
+            self._dirty = True
+
+    def save(self):
+        """原子写入索引，并清理已删除文件的记录"""
+        stale = [path for path in self.entries
+                 if path not in self._checked and not os.path.exists(path)]
+        for path in stale:
+            del self.entries[path]
+
+        if not self.index_path or not (self._dirty or stale):
+            return
+
+        try:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': self.VERSION, 'entries': self.entries}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+        except Exception as e:
+            logger.warning(f"保存扫描索引失败: {e}")
+
+    def invalidate(self, paths: Optional[Set[str]] = None):
+        """让指定文件（默认全部）在下次访问时重新校验
+
+        同一个索引在守护进程中跨多轮扫描使用，每个文件的校验结果会被记住，
+        只有收到变更通知的文件需要重新 stat。
+        """
+        if paths is None:
+            self._checked.clear()
+        else:
+            for path in paths:
+                self._checked.pop(path, None)
+
+    def digest(self, path: str) -> Optional[str]:
+        """本次运行中已校验文件的内容哈希"""
+        entry = self._checked.get(path)
+        return entry.get('sha1') if entry else None
+
+    def get(self, path: str, field: str):
+        """读取未变化文件的缓存字段，文件已变化或无缓存时返回 None"""
+        entry = self._validate(path)
+        if entry is not None and field in entry['data']:
+            self.hits += 1
+            return entry['data'][field]
+
+        self.misses += 1
+        return None
+
+    def put(self, path: str, field: str, value, st: Optional[os.stat_result] = None,
+            digest: Optional[str] = None):
+        """写入文件的缓存字段"""
+        try:
+            st = st or os.stat(path)
+        except OSError:
+            return
+
+        stat_key = self._stat_key(st)
+        entry = self.entries.get(path)
+        if entry is None or entry['stat'] != stat_key:
+            entry = {'stat': stat_key, 'sha1': digest, 'data': {}}
+            self.entries[path] = entry
+        elif digest:
+            entry['sha1'] = digest
+
+        entry['data'][field] = value
+        self._checked[path] = entry
+        self._dirty = True
+
+    def _validate(self, path: str) -> Optional[Dict]:
+        """校验索引记录是否仍然有效（每次运行每个文件只校验一次）"""
+        if path in self._checked:
+            return self._checked[path]
+
+        entry = self.entries.get(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            entry = None
+        else:
+            stat_key = self._stat_key(st)
+            if entry is not None and entry['stat'] != stat_key:
+                # 大小相同但 inode/mtime 变化时（touch、备份还原等），用内容哈希兜底
+                if entry['stat'][2] == st.st_size and entry.get('sha1') == self._hash_file(path):
+                    entry['stat'] = stat_key
+                else:
+                    del self.entries[path]
+                    entry = None
+                self._dirty = True
+
+        self._checked[path] = entry
+        return entry
+
+    @staticmethod
+    def _stat_key(st: os.stat_result) -> List[int]:
+        return [st.st_ino, st.st_mtime_ns, st.st_size]
+
+    @staticmethod
+    def _hash_file(path: str) -> Optional[str]:
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            return None
+
+
+class NginxConfigSyntaxError(ValueError):
+    """Nginx 配置语法错误"""
+
+    def __init__(self, message: str, text: str, offset: int):
+        self.line = text.count('\n', 0, offset) + 1
+        super().__init__(f"{message} (第 {self.line} 行)")
+
+
+class NginxDirective:
+    """Nginx 配置指令，块指令的子指令保存在 block 中"""
+
+    __slots__ = ('name', 'args', 'block', 'start', 'end')
+
+    def __init__(self, name: str, args: List[str], start: int, end: int = -1):
+        self.name = name
+        self.args = args
+        self.block: Optional[List['NginxDirective']] = None
+        self.start = start
+        self.end = end
+
+    def find(self, name: str) -> List['NginxDirective']:
+        """查找直接子指令"""
+        return [child for child in self.block or () if child.name == name]
+
+    def __repr__(self):
+        return f"NginxDirective({self.name!r}, {self.args!r}, block={self.block!r})"
+
+
+# Nginx 词法规则：# 只在词首开始注释；引号只在词首开始字符串；${var} 中的花括号属于单词
+_NGINX_TOKEN_RE = re.compile(r"""
+      (?P<space>\s+)
+    | (?P<comment>\#[^\n]*)
+    | (?P<quoted>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | (?P<punct>[{};])
+    | (?P<word>(?:\$\{[^}\s]*\}|\\.|[^\s{};"'\#\\])(?:\$\{[^}\s]*\}|\\.|[^\s{};\\])*)
+    | (?P<error>.)
+""", re.VERBOSE | re.DOTALL)
+
+_NGINX_UNESCAPE_RE = re.compile(r'\\(["\'\\])')
+
+# 这些上下文中的 server 块不是 HTTP 虚拟主机
+_NON_HTTP_CONTEXTS = frozenset(['stream', 'mail'])
+
+
+def tokenize_nginx_config(text: str) -> Iterator[Tuple[str, str, int]]:
+    """单遍扫描 Nginx 配置，产出 (类型, 值, 偏移)，类型为 word 或 { } ;"""
+    for match in _NGINX_TOKEN_RE.finditer(text):
+        kind = match.lastgroup
+        if kind == 'word':
+            yield 'word', match.group(), match.start()
+        elif kind == 'punct':
+            yield match.group(), match.group(), match.start()
+        elif kind == 'quoted':
+            yield 'word', _NGINX_UNESCAPE_RE.sub(r'\1', match.group()[1:-1]), match.start()
+        elif kind == 'error':
+            raise NginxConfigSyntaxError("未闭合的引号", text, match.start())
+
+
+def _iter_closed_blocks(text: str, root: List[NginxDirective], names=frozenset(),
+                        detach: bool = False) -> Iterator[NginxDirective]:
+    """构建指令树，每当 names 中的块指令闭合时立即产出
+
+    detach 为 True 时产出的块不挂到父节点上，流式处理时不会保留整棵树。
+    """
+    stack = [NginxDirective('', [], 0)]
+    stack[0].block = root
+    words: List[str] = []
+    start = 0
+
+    for kind, value, offset in tokenize_nginx_config(text):
+        if kind == 'word':
+            if not words:
+                start = offset
+            words.append(value)
+        elif kind == ';':
+            if words:
+                stack[-1].block.append(NginxDirective(words[0], words[1:], start, offset + 1))
+                words = []
+        elif kind == '{':
+            if not words:
+                raise NginxConfigSyntaxError("块缺少指令名", text, offset)
+            directive = NginxDirective(words[0], words[1:], start)
+            directive.block = []
+            stack.append(directive)
+            words = []
+        else:
+            if words:
+                raise NginxConfigSyntaxError("指令缺少结尾的 ;", text, offset)
+            if len(stack) == 1:
+                raise NginxConfigSyntaxError("多余的 }", text, offset)
+            directive = stack.pop()
+            directive.end = offset + 1
+            wanted = directive.name in names and not any(
+                parent.name in _NON_HTTP_CONTEXTS or parent.name in names for parent in stack)
+            if not (wanted and detach):
+                stack[-1].block.append(directive)
+            if wanted:
+                yield directive
+
+    if words:
+        raise NginxConfigSyntaxError("指令缺少结尾的 ;", text, len(text))
+    if len(stack) > 1:
+        raise NginxConfigSyntaxError(f"{stack[-1].name} 块缺少 }}", text, stack[-1].start)
+
+
+def parse_nginx_config(text: str) -> List[NginxDirective]:
+    """把 Nginx 配置解析为完整的指令树"""
+    root: List[NginxDirective] = []
+    for _ in _iter_closed_blocks(text, root):
+        pass
+    return root
+
+
+def iter_server_directives(text: str) -> Iterator[NginxDirective]:
+    """流式产出 HTTP server 块（支持嵌套 location，解析到闭合的 } 即产出）"""
+    return _iter_closed_blocks(text, [], frozenset(['server']), detach=True)
+
+
+def iter_nginx_dump(stream: Iterable[bytes]) -> Iterator[Tuple[str, bytes]]:
+    """按标记行切分 nginx -T 的输出（逐行读取），逐个生成 (配置文件路径, 文件内容)
+
+    nginx 在每个文件的内容之后多输出一个换行，这里去掉它，得到与磁盘上相同的内容。
+    """
+    path: Optional[str] = None
+    lines: List[bytes] = []
+    for line in stream:
+        marker = line.rstrip(b'\r\n')
+        if line.startswith(NGINX_DUMP_MARKER) and marker.endswith(b':'):
+            if path is not None:
+                yield path, b''.join(lines)[:-1]
+            path = marker[len(NGINX_DUMP_MARKER):-1].decode('utf-8', errors='surrogateescape')
+            lines = []
+        elif path is not None:
+            lines.append(line)
+    if path is not None:
+        yield path, b''.join(lines)[:-1]
+
+
+class ServerBlock:
+    """解析得到的 server 块
+
+    使用 __slots__，域名、路径等字符串驻留（sys.intern），不保存 server 块内容的副本，
+    只记录其在配置文件中的位置（start/end），需要时用 source() 读取原文。
+    兼容原来的 dict 表示：block['server_names']、block.get('root_path') 仍然可用。
+    """
+
+    __slots__ = ('config_file', 'server_names', 'root_path', 'has_ssl', 'listen_80', 'redirects_https',
+                 'start', 'end')
+
+    def __init__(self, config_file: str, server_names: List[str], root_path: Optional[str], has_ssl: bool,
+                 listen_80: bool, redirects_https: bool = False, start: int = -1, end: int = -1):
+        self.config_file = sys.intern(config_file)
+        self.server_names = [sys.intern(name) for name in server_names]
+        self.root_path = sys.intern(root_path) if root_path else root_path
+        self.has_ssl = has_ssl
+        self.listen_80 = listen_80
+        self.redirects_https = redirects_https
+        self.start = start
+        self.end = end
+
+    @classmethod
+    def from_row(cls, config_file: str, row: List) -> 'ServerBlock':
+        """从扫描索引中的紧凑记录还原"""
+        return cls(config_file, *row)
+
+    def to_row(self) -> List:
+        """扫描索引中的紧凑记录（不含配置文件路径，路径是索引的键）"""
+        return [self.server_names, self.root_path, self.has_ssl, self.listen_80, self.redirects_https,
+                self.start, self.end]
+
+    def to_dict(self) -> Dict:
+        return {field: getattr(self, field) for field in self.__slots__}
+
+    def source(self) -> str:
+        """从配置文件中读取 server 块的原文（文件修改后可能已不一致）"""
+        with open(self.config_file, 'rb') as f:
+            return f.read().decode('utf-8', errors='ignore')[self.start:self.end]
+
+    def __getitem__(self, key: str):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key, default)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.__slots__
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, ServerBlock):
+            return NotImplemented
+        return self.config_file == other.config_file and self.to_row() == other.to_row()
+
+    def __reduce__(self):
+        # 进程池返回解析结果时按紧凑记录传输
+        return ServerBlock.from_row, (self.config_file, self.to_row())
+
+    def __repr__(self):
+        return f"ServerBlock({self.config_file!r}, {self.server_names!r}, ssl={self.has_ssl})"
+
+
 class NginxConfigParser:
     """Nginx 配置解析器"""
     
-    def __init__(self, config_path: str = "/etc/nginx"):
-        self.config_path = config_path
+    def __init__(self, config_path: str = DEFAULT_NGINX_ROOT, index: Optional[ScanIndex] = None,
+                 discovery: str = "include", jobs: int = 1):
+        self.config_path = os.path.normpath(config_path)
         self.sites_available = os.path.join(config_path, "sites-available")
         self.sites_enabled = os.path.join(config_path, "sites-enabled")
+        self.index = index or ScanIndex()
+        # include: 从主配置沿 include 解析生效的配置；dump: 读取 nginx -T 输出的生效配置，
+        # 失败时改为 include；scan: 扫描常见配置目录
+        self.discovery = discovery
+        # 并行解析使用的进程数
+        self.jobs = max(1, jobs)
+
+    def save_index(self):
+        """保存扫描索引并输出命中统计"""
+        logger.info(f"扫描索引: 命中 {self.index.hits}，未命中 {self.index.misses}")
+        self.index.save()
     
     def find_nginx_configs(self) -> List[str]:
-        """查找所有 Nginx 配置文件"""
+        """查找所有生效的 Nginx 配置文件"""
+        with metrics.span('discover'):
+            config_files = self._find_nginx_configs()
+        metrics.inc('config_files_scanned', len(config_files))
+        return config_files
+
+    def _find_nginx_configs(self) -> List[str]:
+        if self.discovery == 'dump':
+            config_files = self._dump_nginx_configs()
+            if config_files is not None:
+                return config_files
+            logger.warning("无法从 nginx -T 得到生效的配置，改为从主配置解析 include")
+
+        if self.discovery in ('include', 'dump'):
+            main_conf = self._find_main_config()
+            if main_conf:
+                return self._resolve_include_graph(main_conf)
+            logger.warning("未找到 Nginx 主配置文件，改为扫描配置目录")
+
+        return self._scan_nginx_configs()
+
+    @property
+    def host_roots(self) -> List[str]:
+        """查找配置的根目录：指定了其他配置根目录（容器、chroot 挂载的配置）时只在其中查找"""
+        if self.config_path != DEFAULT_NGINX_ROOT:
+            return [self.config_path]
+        return [self.config_path] + HOST_NGINX_ROOTS
+
+    def rebase(self, path: str) -> str:
+        """把指向 /etc/nginx 的绝对路径映射到配置根目录下（挂载的配置中 include 写的是容器内的路径）"""
+        if self.config_path != DEFAULT_NGINX_ROOT and (path == DEFAULT_NGINX_ROOT
+                                                     or path.startswith(DEFAULT_NGINX_ROOT + '/')):
+            return self.config_path + path[len(DEFAULT_NGINX_ROOT):]
+        return path
+
+    def _find_main_config(self) -> Optional[str]:
+        """查找 Nginx 主配置文件"""
+        candidates = [os.path.join(root, "nginx.conf") for root in self.host_roots]
+        for main_conf in candidates:
+            if os.path.isfile(main_conf):
+                return main_conf
+        return None
+
+    def _dump_nginx_configs(self) -> Optional[List[str]]:
+        """运行一次 nginx -T，按输出中的 "# configuration file" 标记得到生效的配置文件
+
+        输出逐段读取：未变化的文件直接使用扫描索引，其余的用输出中的内容解析，不再逐个打开文件。
+        指定了其他配置根目录时用 -c 指定其中的 nginx.conf；输出中出现 /etc/nginx 下的文件
+        （include 写的是容器内的路径，nginx 读到的是本机的文件）说明与该目录不符，返回 None。
+        nginx -T 失败或没有输出配置文件时也返回 None。
+        """
+        command = ['nginx', '-T']
+        if self.config_path != DEFAULT_NGINX_ROOT:
+            main_conf = os.path.join(self.config_path, "nginx.conf")
+            if not os.path.isfile(main_conf):
+                return None
+            command += ['-c', main_conf]
+
+        import tempfile
+        configs: List[str] = []
+        seen = set()
+        outside = []
+        try:
+            # stderr 写入临时文件：大量警告（如重复的 server_name）不会填满管道
+            with tempfile.TemporaryFile() as stderr:
+                with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr) as process:
+                    try:
+                        for path, raw in iter_nginx_dump(process.stdout):
+                            if self.rebase(path) != path:
+                                outside.append(path)
+                                continue
+                            config_file = os.path.realpath(path)
+                            if config_file in seen:
+                                continue
+                            seen.add(config_file)
+                            configs.append(config_file)
+                            self._load_dumped_file(config_file, raw)
+                        returncode = process.wait(NGINX_DUMP_TIMEOUT)
+                    except BaseException:
+                        process.kill()
+                        raise
+                if returncode != 0:
+                    stderr.seek(0)
+                    logger.warning(f"nginx -T 失败: {stderr.read().decode(errors='ignore').strip()[-500:]}")
+                    return None
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.warning(f"无法运行 nginx -T: {e}")
+            return None
+
+        if outside:
+            logger.warning(f"nginx -T 读取了本机 {DEFAULT_NGINX_ROOT} 下的 {len(outside)} 个文件（如 {outside[0]}），"
+                           f"与配置根目录 {self.config_path} 不符")
+            return None
+        if not configs:
+            logger.warning("nginx -T 没有输出配置文件")
+            return None
+        logger.info(f"从 nginx -T 的输出得到 {len(configs)} 个生效的 Nginx 配置文件")
+        return configs
+
+    def _load_dumped_file(self, config_file: str, raw: bytes):
+        """文件未变化时使用扫描索引，否则解析 nginx -T 输出中的内容
+
+        内容与磁盘上的文件大小不一致时（nginx -T 之后文件被修改）重新读取文件。
+        """
+        if self.index.get(config_file, 'server_blocks') is not None:
+            return
+        try:
+            st = os.stat(config_file)
+        except OSError:
+            return
+        if st.st_size == len(raw):
+            result = self._parse_config_content(config_file, raw, st)
+        else:
+            result = self._read_config_file(config_file)
+        if result is not None:
+            self._store_parse_result(config_file, result)
+
+    def _resolve_include_graph(self, main_conf: str) -> List[str]:
+        """从主配置出发按 Nginx 的方式展开 include，每个真实文件只处理一次
+
+        sites-enabled 中的软链接与其目标只算一个文件，未被 include 的
+        sites-available 站点（未启用）不会出现在结果中。
+        """
+        # 相对路径的 include 以主配置所在目录为前缀
+        prefix = os.path.dirname(main_conf)
+        configs: List[str] = []
+        seen = set()
+
+        def visit(real_path: str):
+            if real_path in seen:
+                return
+            seen.add(real_path)
+            configs.append(real_path)
+
+            included = [os.path.realpath(path)
+                        for pattern in self._read_includes(real_path)
+                        for path in self._expand_include(pattern, prefix)]
+            # 先批量（可并行）解析新发现的文件，再按 include 顺序深度遍历
+            for _ in self.iter_config_files([path for path in dict.fromkeys(included) if path not in seen]):
+                pass
+            for path in included:
+                visit(path)
+
+        visit(os.path.realpath(main_conf))
+
+        logger.info(f"从 {main_conf} 解析 include 得到 {len(configs)} 个生效的 Nginx 配置文件")
+        logger.debug(f"生效的 Nginx 配置文件: {configs}")
+        return configs
+
+    def watch_directories(self, config_files: List[str]) -> List[str]:
+        """需要监视变更的目录：配置文件所在目录以及 include 通配符所在目录"""
+        directories = {os.path.dirname(config_file) for config_file in config_files}
+
+        if self.discovery in ('include', 'dump'):
+            main_conf = self._find_main_config()
+            prefix = os.path.dirname(main_conf) if main_conf else self.config_path
+            for config_file in config_files:
+                for pattern in self._read_includes(config_file):
+                    if not os.path.isabs(pattern):
+                        pattern = os.path.join(prefix, pattern)
+                    pattern = self.rebase(pattern)
+                    directory = os.path.dirname(pattern)
+                    if glob.has_magic(directory):
+                        directories.update(glob.glob(directory))
+                    else:
+                        directories.add(directory)
+        else:
+            directories.update([self.sites_available, self.sites_enabled,
+                                os.path.join(self.config_path, "conf.d")])
+
+        return sorted(directory for directory in directories if os.path.isdir(directory))
+
+    def _expand_include(self, pattern: str, prefix: str) -> List[str]:
+        """展开 include 参数（支持通配符，按文件名排序，与 Nginx 一致）"""
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(prefix, pattern)
+        pattern = self.rebase(pattern)
+
+        if glob.has_magic(pattern):
+            return [path for path in sorted(glob.glob(pattern)) if os.path.isfile(path)]
+
+        if os.path.isfile(pattern):
+            return [pattern]
+
+        logger.warning(f"include 的文件不存在: {pattern}")
+        return []
+
+    def _read_includes(self, config_file: str) -> List[str]:
+        """读取配置文件中的 include 参数（未变化的文件使用扫描索引）"""
+        cached = self.index.get(config_file, 'includes')
+        if cached is None:
+            self._parse_config_file(config_file)
+            cached = self.index.get(config_file, 'includes')
+        return cached or []
+
+    def _scan_nginx_configs(self) -> List[str]:
+        """扫描常见的 Nginx 配置目录"""
         configs = []
         
         # 扫描所有可能的 Nginx 配置目录
         nginx_dirs = [
             self.sites_available,
             self.sites_enabled,
-            "/etc/nginx/conf.d",
-            "/etc/nginx/conf.d/*",
-            "/usr/local/nginx/conf",
-            "/usr/local/etc/nginx"
-        ]
+            os.path.join(self.config_path, "conf.d"),
+            os.path.join(self.config_path, "conf.d", "*"),
+        ] + self.host_roots[1:]
         
         # 添加主配置文件
-        main_configs = [
-            "/etc/nginx/nginx.conf",
-            "/usr/local/nginx/conf/nginx.conf",
-            "/usr/local/etc/nginx/nginx.conf"
-        ]
+        main_configs = [os.path.join(root, "nginx.conf") for root in self.host_roots]
         
         # 扫描所有配置目录
         for directory in nginx_dirs:
             # logger.info(f"正在扫描 Nginx 配置目录: {directory}")
             if '*' in directory:
                 # 处理通配符路径
-                import glob
                 expanded_dirs = glob.glob(directory)
                 for expanded_dir in expanded_dirs:
                     if os.path.isdir(expanded_dir):
@@ -114,65 +899,163 @@ class NginxConfigParser:
             file_ext = os.path.splitext(file_path)[1]
             
             if file_ext in valid_extensions:
+                cached = self.index.get(file_path, 'is_config')
+                if cached is not None:
+                    return cached
+
                 # 进一步检查文件内容
+                st = os.stat(file_path)
                 with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
                     content = f.read(1024)  # 只读取前1024字节
                     
-                    # 检查是否包含 Nginx 配置关键字
-                    nginx_keywords = ['server {', 'location ', 'listen ', 'server_name ']
-                    if any(keyword in content for keyword in nginx_keywords):
-                        return True
+                # 检查是否包含 Nginx 配置关键字
+                nginx_keywords = ['server {', 'location ', 'listen ', 'server_name ']
+                is_config = any(keyword in content for keyword in nginx_keywords)
+                self.index.put(file_path, 'is_config', is_config, st)
+                return is_config
             
             return False
             
         except Exception:
             return False
     
-    def parse_server_blocks(self, config_file: str) -> List[Dict]:
-        """解析 server 块配置"""
+    def parse_server_blocks(self, config_file: str) -> List[ServerBlock]:
+        """解析 server 块配置（未变化的文件直接使用扫描索引中的结果）"""
+        cached = self._cached_server_blocks(config_file)
+        if cached is not None:
+            return cached
+
+        return self._parse_config_file(config_file)
+
+    def _cached_server_blocks(self, config_file: str) -> Optional[List[ServerBlock]]:
+        rows = self.index.get(config_file, 'server_blocks')
+        if rows is None:
+            return None
+        return [ServerBlock.from_row(config_file, row) for row in rows]
+
+    def parse_config_files(self, config_files: List[str]) -> List[List[ServerBlock]]:
+        """批量解析配置文件，返回的结果与输入顺序一一对应"""
+        results = dict(self.iter_config_files(config_files))
+        return [results.get(config_file, []) for config_file in config_files]
+
+    def iter_config_files(self, config_files: Iterable[str]) -> Iterator[Tuple[str, List[ServerBlock]]]:
+        """按输入顺序逐个生成 (配置文件, server 块)，重复的文件只生成一次
+
+        命中扫描索引的文件直接生成；未命中的文件较多时交给进程池并行解析，
+        结果按顺序陆续到达，调用方不必等全部文件解析完。
+        """
+        cached = {config_file: self.index.get(config_file, 'server_blocks') for config_file in config_files}
+        misses = [config_file for config_file, rows in cached.items() if rows is None]
+        parsed = self._iter_read_config_files(misses)
+
+        for config_file, rows in cached.items():
+            if rows is not None:
+                yield config_file, [ServerBlock.from_row(config_file, row) for row in rows]
+                continue
+            result = next(parsed)
+            if result is None:
+                yield config_file, []
+                continue
+            self._store_parse_result(config_file, result)
+            yield config_file, result[2]
+
+    def _iter_read_config_files(self, config_files: List[str]) -> Iterator[Optional[Tuple]]:
+        """按顺序解析多个配置文件，文件足够多时使用进程池"""
+        if self.jobs <= 1 or len(config_files) < PARALLEL_PARSE_MIN_FILES:
+            for config_file in config_files:
+                yield self._read_config_file(config_file)
+            return
+
+        chunksize = max(1, min(PARALLEL_PARSE_MAX_CHUNK, len(config_files) // (self.jobs * 4)))
+        logger.info(f"使用 {self.jobs} 个进程并行解析 {len(config_files)} 个配置文件")
+        done = 0
+        try:
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.jobs) as executor:
+                # map 按输入顺序返回结果，合并结果与串行解析完全一致
+                for result in executor.map(_read_config_file_worker, config_files, chunksize=chunksize):
+                    done += 1
+                    yield result
+        except Exception as e:
+            logger.warning(f"并行解析失败，改为串行解析: {e}")
+            for config_file in config_files[done:]:
+                yield self._read_config_file(config_file)
+
+    def _parse_config_file(self, config_file: str) -> List[ServerBlock]:
+        """解析配置文件，把 server 块和 include 参数一起写入扫描索引"""
+        result = self._read_config_file(config_file)
+        if result is None:
+            return []
+
+        self._store_parse_result(config_file, result)
+        return result[2]
+
+    def _store_parse_result(self, config_file: str, result: Tuple):
+        """把解析结果写入扫描索引"""
+        st, digest, server_blocks, includes = result
+        metrics.inc('config_files_parsed')
+        metrics.inc('server_blocks_parsed', len(server_blocks))
+        self.index.put(config_file, 'server_blocks', [block.to_row() for block in server_blocks], st, digest)
+        self.index.put(config_file, 'includes', includes, st, digest)
+
+    def _read_config_file(self, config_file: str) -> Optional[Tuple]:
+        """读取并解析配置文件，返回 (stat, 内容哈希, server 块, include 参数)
+
+        不访问扫描索引，可以在子进程中执行。
+        """
+        try:
+            st = os.stat(config_file)
+            with open(config_file, 'rb') as f:
+                raw = f.read()
+        except OSError as e:
+            logger.error(f"解析配置文件 {config_file} 失败: {e}")
+            return None
+
+        return self._parse_config_content(config_file, raw, st)
+
+    def _parse_config_content(self, config_file: str, raw: bytes, st: os.stat_result) -> Optional[Tuple]:
+        """解析配置文件的内容，返回 (stat, 内容哈希, server 块, include 参数)"""
         server_blocks = []
+        includes: List[Tuple[int, str]] = []
         
         try:
-            with open(config_file, 'r', encoding='utf-8', errors='ignore') as f:
-                content = f.read()
+            content = raw.decode('utf-8', errors='ignore')
             
-            # 移除注释，简化解析
-            content = self._remove_comments(content)
-            
-            # 使用正则表达式匹配 server 块
-            server_pattern = r'server\s*\{([^}]+)\}'
-            servers = re.findall(server_pattern, content, re.DOTALL)
-            
-            logger.debug(f"在文件 {config_file} 中找到 {len(servers)} 个 server 块")
-            
-            for i, server_content in enumerate(servers):
-                server_info = self._parse_server_content(server_content, config_file, i)
+            # 单遍词法分析，server 块闭合时立即处理
+            root: List[NginxDirective] = []
+            for i, server in enumerate(_iter_closed_blocks(content, root, frozenset(['server']), detach=True)):
+                self._collect_includes(server.block, includes)
+                server_info = self._parse_server_content(server, content, config_file, i)
                 if server_info:
                     server_blocks.append(server_info)
+            self._collect_includes(root, includes)
+
+            logger.debug(f"在文件 {config_file} 中找到 {len(server_blocks)} 个有效 server 块")
+
+            # include 按在文件中出现的顺序保存
+            return st, hashlib.sha1(raw).hexdigest(), server_blocks, [arg for _, arg in sorted(includes)]
                     
         except Exception as e:
             logger.error(f"解析配置文件 {config_file} 失败: {e}")
-            
-        return server_blocks
+            return None
 
-    def _remove_comments(self, content: str) -> str:
-        """移除注释"""
-        # 移除单行注释
-        content = re.sub(r'#.*$', '', content, flags=re.MULTILINE)
-        # 移除多行注释（如果有的话）
-        content = re.sub(r'/\*.*?\*/', '', content, flags=re.DOTALL)
-        return content
+    def _collect_includes(self, directives: List[NginxDirective], includes: List[Tuple[int, str]]):
+        """收集指令树中所有 include 的位置和参数"""
+        for directive in directives:
+            if directive.name == 'include' and directive.args:
+                includes.append((directive.start, directive.args[0]))
+            if directive.block:
+                self._collect_includes(directive.block, includes)
 
-    def _parse_server_content(self, content: str, config_file: str, block_index: int) -> Optional[Dict]:
+    def _parse_server_content(self, server: NginxDirective, content: str, config_file: str,
+                              block_index: int) -> Optional[ServerBlock]:
         """解析 server 块内容"""
         try:
-            # 提取 server_name
-            server_name_match = re.search(r'server_name\s+([^;]+);', content)
-            if not server_name_match:
+            # 提取 server_name（可以有多条）
+            server_names = [name for directive in server.find('server_name') for name in directive.args]
+            if not server_names:
                 logger.debug(f"server 块 {block_index} 没有 server_name，跳过")
                 return None
-                
-            server_names = server_name_match.group(1).strip().split()
             
             # 过滤掉无效域名
             valid_domains = []
@@ -189,34 +1072,48 @@ class NginxConfigParser:
                 logger.debug(f"server 块 {block_index} 没有有效域名，跳过")
                 return None
             
-            # 提取 root 路径
-            root_match = re.search(r'root\s+([^;]+);', content)
-            root_path = root_match.group(1).strip() if root_match else "/var/www/html"
-            
-            # 清理 root 路径（移除引号等）
-            root_path = root_path.strip('"\'').strip()
+            # 提取 root 路径（server 级别）；没有 root 指令（如反向代理）时为 None
+            roots = server.find('root')
+            root_path = roots[0].args[0] if roots and roots[0].args else None
             
             # 检查是否已有 SSL 配置
-            has_ssl = bool(re.search(r'listen\s+443', content)) or bool(re.search(r'ssl_certificate', content))
+            listens = server.find('listen')
+            listen_ports = [self._listen_port(listen.args[0]) for listen in listens if listen.args]
+            has_ssl = (443 in listen_ports or any('ssl' in listen.args[1:] for listen in listens)
+                       or bool(server.find('ssl_certificate')))
             
-            # 检查是否监听 80 端口（HTTP）
-            listen_80 = bool(re.search(r'listen\s+80', content)) or bool(re.search(r'listen\s+\[::\]:80', content))
+            # 检查是否监听 80 端口（HTTP），没有 listen 指令时 Nginx 默认监听 80
+            listen_80 = 80 in listen_ports or not listens
             
-            server_info = {
-                'config_file': config_file,
-                'server_names': valid_domains,
-                'root_path': root_path,
-                'has_ssl': has_ssl,
-                'listen_80': listen_80,
-                'content': content[:500]  # 只保存部分内容用于调试
-            }
+            server_info = ServerBlock(config_file, valid_domains, root_path, has_ssl, listen_80,
+                                      self._redirects_https(server), server.start, server.end)
             
-            logger.info(f"解析到 server 块: {valid_domains} (SSL: {has_ssl}, HTTP: {listen_80})")
+            logger.debug(f"解析到 server 块: {valid_domains} (SSL: {has_ssl}, HTTP: {listen_80})")
             return server_info
             
         except Exception as e:
             logger.error(f"解析 server 块失败: {e}")
             return None
+
+    @staticmethod
+    def _redirects_https(server: NginxDirective) -> bool:
+        """server 块是否只做 HTTPS 跳转（server 级或 location / 中的 return 30x https://...）"""
+        scopes = [server] + [location for location in server.find('location') if location.args == ['/']]
+        return any(len(directive.args) == 2 and directive.args[0] in ('301', '302', '307', '308')
+                   and directive.args[1].startswith('https://')
+                   for scope in scopes for directive in scope.find('return'))
+
+    @staticmethod
+    def _listen_port(address: str) -> Optional[int]:
+        """解析 listen 地址中的端口（80 / [::]:80 / 127.0.0.1:8080 / unix:...）"""
+        if address.startswith('unix:'):
+            return None
+        if ']' in address:
+            address = address.rsplit(']', 1)[1].lstrip(':')
+        elif ':' in address:
+            address = address.rsplit(':', 1)[1]
+        # 只写地址不写端口时使用默认端口 80
+        return int(address) if address.isdigit() else 80
         
     # def parse_server_blocks(self, config_file: str) -> List[Dict]:
     #     """解析 server 块配置"""
@@ -278,207 +1175,2829 @@ class NginxConfigParser:
     #         logger.error(f"解析 server 块失败: {e}")
     #         return None
 
-class SSLCertManager:
-    """SSL 证书管理器"""
-    
-    def __init__(self, config: Dict):
-        self.config = config
-        self.email = config.get('email', 'admin@example.com')
-    
-    def scan_and_apply(self):
-        """扫描 Nginx 配置并应用 SSL"""
-        logger.info("开始扫描 Nginx 配置...")
-        
-        config_files = self.nginx_parser.find_nginx_configs()
-        
-        total_servers = 0
-        ssl_applied = 0
-        
-        for config_file in config_files:
-            logger.debug(f"解析配置文件: {config_file}")
-            server_blocks = self.nginx_parser.parse_server_blocks(config_file)
-            total_servers += len(server_blocks)
-            
-            for server_block in server_blocks:
-                logger.debug(f"检查 server 块: {server_block['server_names']}")
-                if self.ssl_manager.needs_ssl(server_block):
-                    logger.info(f"发现需要 SSL 的配置: {server_block['server_names']}")
-                    
-                    if self.ssl_manager.apply_ssl(server_block):
-                        ssl_applied += 1
-        
-        logger.info(f"扫描完成，共发现 {total_servers} 个 server 块，为 {ssl_applied} 个服务应用了 SSL")
-        return ssl_applied
+def _read_config_file_worker(config_file: str) -> Optional[Tuple]:
+    """进程池任务：在子进程中解析单个配置文件"""
+    return NginxConfigParser()._read_config_file(config_file)
 
-    # def needs_ssl(self, server_block: Dict) -> bool:
-    #     """检查服务器块是否需要 SSL"""
-    #     # 如果已有 SSL，跳过
-    #     if server_block['has_ssl']:
-    #         return False
-        
-    #     # 检查域名是否在排除列表中
-    #     exclude_domains = self.config.get('exclude_domains', [])
-    #     for domain in server_block['server_names']:
-    #         if any(excluded in domain for excluded in exclude_domains):
-    #             return False
-                
-    #     return True
-    
-    def needs_ssl(self, server_block: Dict) -> bool:
-        """检查服务器块是否需要 SSL"""
-        # 如果已有 SSL，跳过
-        if server_block['has_ssl']:
-            logger.debug(f"域名 {server_block['server_names']} 已有 SSL 配置，跳过")
-            return False
-        
-        # 检查是否监听 80 端口（只有 HTTP 服务才需要 SSL）
-        if not server_block.get('listen_80', True):
-            logger.debug(f"域名 {server_block['server_names']} 不监听 80 端口，跳过")
-            return False
-        
-        # 检查域名是否在排除列表中
-        exclude_domains = self.config.get('exclude_domains', [])
-        for domain in server_block['server_names']:
-            # 检查是否在排除列表中
-            if any(excluded in domain for excluded in exclude_domains):
-                logger.info(f"跳过排除域名: {domain}")
-                return False
-            
-            # 额外验证域名
-            if not self._is_valid_public_domain(domain):
-                logger.info(f"跳过无效域名: {domain}")
-                return False
-                
-        logger.info(f"发现需要 SSL 的配置: {server_block['server_names']}")
-        return True
 
-    def _is_valid_public_domain(self, domain: str) -> bool:
-        """验证是否是有效的公共域名"""
-        # 硬编码的无效域名
-        invalid_domains = [
-            'localhost', 'localdomain', 'example.com', 'test.com',
-            'invalid.com', 'example.org', 'test.org', 'example.net'
-        ]
+class ReloadCoordinator:
+    """Nginx 重载协调器
+
+    一次运行中的各个步骤只标记 Nginx 需要重载，由协调器在运行结束时
+    （或每累计 checkpoint 次标记时）统一执行一次 nginx -t 和一次重载。
+    """
+
+    def __init__(self, checkpoint: int = 0):
+        # 0 表示只在运行结束时重载
+        self.checkpoint = max(0, checkpoint)
+        self.requests = 0
+        self.reloads = 0
+        self._pending: List[str] = []
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self._pending)
+
+    def mark_dirty(self, reason: str):
+        """标记 Nginx 需要重载"""
+        self.requests += 1
+        self._pending.append(reason)
+        logger.debug(f"Nginx 待重载: {reason}")
+        if self.checkpoint and len(self._pending) >= self.checkpoint:
+            self.flush()
+
+    def flush(self) -> bool:
+        """有待重载的变更时执行一次 nginx -t 和重载"""
+        if not self._pending:
+            return True
+
+        reasons = self._pending
+        self._pending = []
+        with metrics.span('nginx_reload'):
+            try:
+                # 测试配置
+                metrics.inc('nginx_tests')
+                subprocess.run(["nginx", "-t"], check=True, capture_output=True)
+                # 重载
+                subprocess.run(["systemctl", "reload", "nginx"], check=True)
+                self.reloads += 1
+                metrics.inc('nginx_reloads')
+                logger.info(f"Nginx 重载成功（合并了 {len(reasons)} 次重载请求）")
+                return True
+            except (subprocess.CalledProcessError, OSError) as e:
+                metrics.inc('nginx_reload_failures')
+                logger.error(f"Nginx 重载失败: {e}")
+                return False
+
+    def report(self):
+        """输出本次运行避免的重载次数"""
+        if self.requests:
+            logger.info(f"Nginx 重载: 请求 {self.requests} 次，实际 {self.reloads} 次，"
+                        f"避免 {self.requests - self.reloads} 次")
+
+
+_PEM_CERT_RE = re.compile(rb'-----BEGIN CERTIFICATE-----(.+?)-----END CERTIFICATE-----', re.DOTALL)
+# subjectAltName 扩展的 OID（2.5.29.17）
+_SAN_OID = b'\x55\x1d\x11'
+
+
+def _der_element(data: bytes, offset: int) -> Tuple[int, int, int]:
+    """读取一个 DER 元素，返回 (tag, 内容起始, 内容结束)"""
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7f
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    return tag, offset, offset + length
+
+
+def _der_children(data: bytes, start: int, end: int) -> Iterator[Tuple[int, int, int]]:
+    """遍历 DER 结构（SEQUENCE 等）的子元素"""
+    offset = start
+    while offset < end:
+        element = _der_element(data, offset)
+        yield element
+        offset = element[2]
+
+
+def _der_time(data: bytes, tag: int, start: int, end: int) -> int:
+    """把 UTCTime / GeneralizedTime 转为 Unix 时间戳"""
+    value = data[start:end].decode('ascii').rstrip('Z')
+    if tag == 0x17:
+        # UTCTime 两位年份：50 及以上为 19xx
+        year = int(value[:2])
+        value = f"{1900 + year if year >= 50 else 2000 + year}{value[2:]}"
+    return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+
+
+def parse_certificate(pem: bytes) -> Dict:
+    """解析 PEM 证书中的 SAN 域名和过期时间（只处理第一张证书）"""
+    match = _PEM_CERT_RE.search(pem)
+    if not match:
+        raise ValueError("不是 PEM 格式的证书")
+    der = base64.b64decode(b''.join(match.group(1).split()))
+
+    _, cert_start, cert_end = _der_element(der, 0)
+    _, tbs_start, tbs_end = next(_der_children(der, cert_start, cert_end))
+    fields = list(_der_children(der, tbs_start, tbs_end))
+    # 有 [0] version 时字段整体后移一位：serial, signature, issuer, validity, subject, spki, ...
+    if fields[0][0] == 0xa0:
+        fields = fields[1:]
+
+    _, validity_start, validity_end = fields[3]
+    not_before, not_after = [_der_time(der, *element)
+                             for element in _der_children(der, validity_start, validity_end)]
+
+    domains = []
+    for tag, start, end in fields[6:]:
+        if tag != 0xa3:
+            continue
+        _, ext_start, ext_end = _der_element(der, start)
+        for _, item_start, item_end in _der_children(der, ext_start, ext_end):
+            parts = list(_der_children(der, item_start, item_end))
+            if der[parts[0][1]:parts[0][2]] != _SAN_OID:
+                continue
+            _, names_start, names_end = _der_element(der, parts[-1][1])
+            for name_tag, name_start, name_end in _der_children(der, names_start, names_end):
+                # dNSName: [2] IA5String
+                if name_tag == 0x82:
+                    domains.append(der[name_start:name_end].decode('ascii'))
+
+    return {'domains': domains, 'not_before': not_before, 'not_after': not_after}
+
+
+class CertificateInventory:
+    """本地证书清单
+
+    直接读取 Let's Encrypt 目录下的 live/*/cert.pem 和 renewal/*.conf，
+    不启动 certbot。解析结果按文件 mtime 缓存到磁盘，未变化的证书不再解析。
+    """
+
+    VERSION = 2
+
+    def __init__(self, config_dir: str = "/etc/letsencrypt", cache_path: Optional[str] = None):
+        self.config_dir = config_dir
+        self.cache_path = cache_path
+        self._cache: Dict[str, Dict] = {}
+        self._dirty = False
+        self._load_cache()
+
+    def _load_cache(self):
+        if not self.cache_path:
+            return
+        try:
+            with open(self.cache_path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == self.VERSION and data.get('config_dir') == self.config_dir:
+                self._cache = data.get('lineages', {})
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"加载证书清单缓存失败: {e}")
+
+    def _save_cache(self):
+        if not self.cache_path or not self._dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+            tmp_path = f"{self.cache_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'version': self.VERSION, 'config_dir': self.config_dir,
+                           'lineages': self._cache}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.cache_path)
+            self._dirty = False
+        except Exception as e:
+            logger.warning(f"保存证书清单缓存失败: {e}")
+
+    def lineages(self) -> Dict[str, Dict]:
+        """返回所有证书（按名称排序）：域名列表、过期时间、剩余天数、路径和续签参数"""
+        live_dir = os.path.join(self.config_dir, 'live')
+        try:
+            names = sorted(name for name in os.listdir(live_dir)
+                           if os.path.isdir(os.path.join(live_dir, name)))
+        except FileNotFoundError:
+            return {}
+
+        now = time.time()
+        lineages = {}
+        for name in names:
+            info = self._lineage(name)
+            if info is None:
+                continue
+            info = dict(info)
+            info['days_left'] = int((info['not_after'] - now) // 86400)
+            lineages[name] = info
+
+        # 清理已删除证书的缓存
+        for name in set(self._cache) - set(names):
+            del self._cache[name]
+            self._dirty = True
+
+        self._save_cache()
+        return lineages
+
+    def _lineage(self, name: str) -> Optional[Dict]:
+        """读取单个证书（cert.pem 与续签配置未变化时使用缓存）"""
+        cert_path = os.path.join(self.config_dir, 'live', name, 'cert.pem')
+        renewal_path = os.path.join(self.config_dir, 'renewal', f"{name}.conf")
+        try:
+            st = os.stat(cert_path)
+        except OSError:
+            return None
+        try:
+            renewal_mtime = os.stat(renewal_path).st_mtime_ns
+        except OSError:
+            renewal_mtime = None
+
+        key = [st.st_ino, st.st_mtime_ns, st.st_size, renewal_mtime]
+        cached = self._cache.get(name)
+        if cached and cached['key'] == key:
+            return cached['info']
+
+        try:
+            with open(cert_path, 'rb') as f:
+                cert = parse_certificate(f.read())
+        except Exception as e:
+            logger.warning(f"解析证书失败 {cert_path}: {e}")
+            return None
+
+        info = {
+            'domains': cert['domains'],
+            'not_after': cert['not_after'],
+            'expiry': time.strftime('%Y-%m-%d %H:%M:%S+00:00', time.gmtime(cert['not_after'])),
+            'path': os.path.join(self.config_dir, 'live', name, 'fullchain.pem'),
+            'renewal': self._read_renewal_conf(renewal_path) if renewal_mtime is not None else {}
+        }
+        self._cache[name] = {'key': key, 'info': info}
+        self._dirty = True
+        return info
+
+    @staticmethod
+    def _read_renewal_conf(path: str) -> Dict:
+        """读取续签配置中的 [renewalparams]（[[webroot_map]] 放在 webroot_map 键下）"""
+        params = {}
+        section = None
+        try:
+            with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                for line in f:
+                    line = line.strip()
+                    if line.startswith('['):
+                        section = line.strip('[]')
+                    elif section == 'renewalparams' and '=' in line:
+                        key, value = line.split('=', 1)
+                        params[key.strip()] = value.strip()
+                    elif section == 'webroot_map' and '=' in line:
+                        key, value = line.split('=', 1)
+                        params.setdefault('webroot_map', {})[key.strip()] = value.strip()
+        except OSError:
+            pass
+        return params
+
+
+class StateStore:
+    """本地 SQLite 状态库
+
+    记录 server 块、域名与证书的对应关系、申请记录和续签历史。
+    使用 WAL 模式；同步操作在单个事务内批量写入，申请和续签记录先缓存再批量提交。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS config_files (
+            path TEXT PRIMARY KEY, digest TEXT, seen_at REAL);
+        CREATE TABLE IF NOT EXISTS server_blocks (
+            config_file TEXT, block_index INTEGER, server_names TEXT, root_path TEXT,
+            has_ssl INTEGER, listen_80 INTEGER, needs_ssl INTEGER,
+            PRIMARY KEY (config_file, block_index));
+        CREATE INDEX IF NOT EXISTS server_blocks_needs_ssl ON server_blocks (needs_ssl);
+        CREATE TABLE IF NOT EXISTS lineages (
+            name TEXT PRIMARY KEY, domains TEXT, not_after INTEGER, path TEXT, updated_at REAL);
+        CREATE TABLE IF NOT EXISTS domain_lineages (
+            domain TEXT PRIMARY KEY, lineage TEXT);
+        CREATE INDEX IF NOT EXISTS domain_lineages_lineage ON domain_lineages (lineage);
+        CREATE TABLE IF NOT EXISTS attempts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, cert_name TEXT, domains TEXT,
+            started_at REAL, duration REAL, success INTEGER, error TEXT);
+        CREATE INDEX IF NOT EXISTS attempts_cert_name ON attempts (cert_name);
+        CREATE TABLE IF NOT EXISTS renewals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, lineage TEXT,
+            started_at REAL, duration REAL, success INTEGER, error TEXT);
+        CREATE TABLE IF NOT EXISTS failures (
+            domain_set TEXT PRIMARY KEY, failures INTEGER, permanent INTEGER,
+            last_failed REAL, retry_at REAL, error TEXT);
+    """
+
+    EXPORT_TABLES = ['config_files', 'server_blocks', 'lineages', 'domain_lineages', 'attempts', 'renewals',
+                     'failures']
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._attempts: List[Tuple] = []
+        self._renewals: List[Tuple] = []
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """首次使用时打开数据库"""
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def _get_meta(self, key: str) -> Optional[str]:
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def policy_changed(self, policy: str) -> bool:
+        """判定策略的指纹与上次同步时不同"""
+        return self._get_meta('policy') != policy
+
+    def sync_config_files(self, entries: List[Tuple[str, List[Dict], Optional[str]]],
+                          policy_changed: bool) -> Set[str]:
+        """同步一批 (配置文件, server 块, 内容哈希)，返回其中内容有变化（或新出现）的配置文件
+
+        排除规则等策略变化时所有文件都视为有变化。流水线中按批调用，每批一个事务，
+        只查询这一批文件的记录。
+        """
+        conn = self.conn
+        stored = {}
+        paths = [entry[0] for entry in entries]
+        for i in range(0, len(paths), 500):
+            batch = paths[i:i + 500]
+            stored.update(conn.execute(
+                f"SELECT path, digest FROM config_files WHERE path IN ({','.join('?' * len(batch))})", batch))
+        now = time.time()
+        changed = set()
+
+        with conn:
+            for config_file, server_blocks, digest in entries:
+                if not policy_changed and digest is not None and stored.get(config_file) == digest:
+                    continue
+                changed.add(config_file)
+                conn.execute('DELETE FROM server_blocks WHERE config_file = ?', (config_file,))
+                conn.executemany(
+                    'INSERT INTO server_blocks (config_file, block_index, server_names, root_path, '
+                    'has_ssl, listen_80, needs_ssl) VALUES (?, ?, ?, ?, ?, ?, NULL)',
+                    [(config_file, i, json.dumps(block['server_names']), block['root_path'],
+                      int(block['has_ssl']), int(block['listen_80'])) for i, block in enumerate(server_blocks)])
+                conn.execute('INSERT OR REPLACE INTO config_files (path, digest, seen_at) VALUES (?, ?, ?)',
+                             (config_file, digest, now))
+
+        return changed
+
+    def finish_sync(self, policy: str, config_files: List[str], complete: bool = True):
+        """所有批次同步完成后记录策略指纹；complete 为 True 时删除已不再生效的配置文件的记录
+
+        策略指纹最后写入：中途退出时下次运行仍会重新判定全部文件。
+        """
+        conn = self.conn
+        with conn:
+            if self.policy_changed(policy):
+                conn.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', ('policy', policy))
+
+            if complete:
+                current = set(config_files)
+                removed = [(path,) for (path,) in conn.execute('SELECT path FROM config_files')
+                           if path not in current]
+                conn.executemany('DELETE FROM server_blocks WHERE config_file = ?', removed)
+                conn.executemany('DELETE FROM config_files WHERE path = ?', removed)
+
+    def pending_blocks(self) -> Set[Tuple[str, int]]:
+        """上次判定为需要 SSL（或尚未判定）的 server 块 (配置文件, 序号)"""
+        return set(self.conn.execute(
+            'SELECT config_file, block_index FROM server_blocks WHERE needs_ssl IS NULL OR needs_ssl = 1'))
+
+    def update_needs_ssl(self, decisions: List[Tuple[bool, str, int]]):
+        """批量写入 needs_ssl 判定结果 (是否需要, 配置文件, 序号)
+
+        只改写结果有变化的行：判定结果不变时不产生 WAL 写入，关闭数据库时也就不需要检查点。
+        """
+        with self.conn:
+            self.conn.executemany(
+                'UPDATE server_blocks SET needs_ssl = ? WHERE config_file = ? AND block_index = ? '
+                'AND needs_ssl IS NOT ?',
+                [(int(needed), config_file, index, int(needed)) for needed, config_file, index in decisions])
+
+    def sync_lineages(self, lineages: Dict[str, Dict]):
+        """同步证书及域名与证书的对应关系（只写入有变化的证书）"""
+        conn = self.conn
+        stored = {name: (not_after, domains) for name, not_after, domains
+                  in conn.execute('SELECT name, not_after, domains FROM lineages')}
+        now = time.time()
+
+        with conn:
+            for name, info in lineages.items():
+                domains = json.dumps(info['domains'])
+                if stored.get(name) == (info['not_after'], domains):
+                    continue
+                conn.execute('INSERT OR REPLACE INTO lineages (name, domains, not_after, path, updated_at) '
+                             'VALUES (?, ?, ?, ?, ?)', (name, domains, info['not_after'], info.get('path'), now))
+                conn.execute('DELETE FROM domain_lineages WHERE lineage = ?', (name,))
+                conn.executemany('INSERT OR REPLACE INTO domain_lineages (domain, lineage) VALUES (?, ?)',
+                                 [(domain, name) for domain in info['domains']])
+
+            removed = [(name,) for name in set(stored) - set(lineages)]
+            conn.executemany('DELETE FROM lineages WHERE name = ?', removed)
+            conn.executemany('DELETE FROM domain_lineages WHERE lineage = ?', removed)
+
+    def lineages_for(self, domains: List[str]) -> Dict[str, str]:
+        """查询域名所属的证书"""
+        result = {}
+        for start in range(0, len(domains), 500):
+            chunk = domains[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            result.update(self.conn.execute(
+                f'SELECT domain, lineage FROM domain_lineages WHERE domain IN ({placeholders})', chunk))
+        return result
+
+    def certificates_for(self, domains: List[str]) -> Dict[str, Tuple[str, int]]:
+        """查询域名所属的证书及其过期时间 {域名: (证书名, 过期时间)}"""
+        result = {}
+        for start in range(0, len(domains), 500):
+            chunk = domains[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for domain, lineage, not_after in self.conn.execute(
+                    f'SELECT d.domain, d.lineage, l.not_after FROM domain_lineages d '
+                    f'LEFT JOIN lineages l ON l.name = d.lineage WHERE d.domain IN ({placeholders})', chunk):
+                result[domain] = (lineage, not_after)
+        return result
+
+    def iter_domains(self) -> Iterator[Tuple[str, str, Optional[int], Optional[str], Optional[int]]]:
+        """逐行返回所有 server 块中的域名 (域名, 配置文件, 是否需要 SSL, 所属证书, 证书过期时间)"""
+        return self.conn.execute(
+            'SELECT j.value, b.config_file, b.needs_ssl, d.lineage, l.not_after '
+            'FROM server_blocks b, json_each(b.server_names) j '
+            'LEFT JOIN domain_lineages d ON d.domain = j.value '
+            'LEFT JOIN lineages l ON l.name = d.lineage '
+            'ORDER BY b.config_file, b.block_index')
+
+    def record_attempt(self, cert_name: str, domains: List[str], started_at: float, duration: float,
+                       success: bool, error: str = ''):
+        """记录一次证书申请（调用 flush 时批量写入）"""
+        self._attempts.append((cert_name, json.dumps(domains), started_at, duration, int(success), error))
+
+    def record_renewal(self, lineage: str, started_at: float, duration: float, success: bool, error: str = ''):
+        """记录一次续签（调用 flush 时批量写入）"""
+        self._renewals.append((lineage, started_at, duration, int(success), error))
+
+    @staticmethod
+    def _domain_set(domains: List[str]) -> str:
+        return ','.join(sorted(set(domains)))
+
+    def retry_at(self, domains: List[str]) -> Optional[float]:
+        """域名组合的下次重试时间（没有失败记录时返回 None）"""
+        row = self.conn.execute('SELECT retry_at FROM failures WHERE domain_set = ?',
+                                (self._domain_set(domains),)).fetchone()
+        return row[0] if row else None
+
+    def record_failures(self, domain_sets: List[List[str]], permanent: bool, error: str,
+                        base: float, cap: float) -> float:
+        """记录申请失败，按连续失败次数指数退避（base * 2^(n-1)，不超过 cap），返回最早的重试时间"""
+        now = time.time()
+        earliest = now + cap
+        with self.conn:
+            for domains in domain_sets:
+                key = self._domain_set(domains)
+                row = self.conn.execute('SELECT failures FROM failures WHERE domain_set = ?', (key,)).fetchone()
+                failures = (row[0] if row else 0) + 1
+                retry_at = now + min(cap, base * 2 ** min(failures - 1, 32))
+                earliest = min(earliest, retry_at)
+                self.conn.execute('INSERT OR REPLACE INTO failures (domain_set, failures, permanent, last_failed, '
+                                  'retry_at, error) VALUES (?, ?, ?, ?, ?, ?)',
+                                  (key, failures, int(permanent), now, retry_at, error))
+        return earliest
+
+    def clear_failures(self, domain_sets: List[List[str]]):
+        """申请成功后清除失败记录"""
+        with self.conn:
+            self.conn.executemany('DELETE FROM failures WHERE domain_set = ?',
+                                  [(self._domain_set(domains),) for domains in domain_sets])
+
+    def failures(self) -> List[Tuple[str, int, int, float, str]]:
+        """所有失败记录 (域名组合, 连续失败次数, 是否永久性错误, 下次重试时间, 错误信息)"""
+        return self.conn.execute(
+            'SELECT domain_set, failures, permanent, retry_at, error FROM failures ORDER BY retry_at').fetchall()
+
+    def flush(self):
+        """批量写入缓存的申请和续签记录"""
+        if not self._attempts and not self._renewals:
+            return
+        with self.conn:
+            self.conn.executemany('INSERT INTO attempts (cert_name, domains, started_at, duration, success, error) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)', self._attempts)
+            self.conn.executemany('INSERT INTO renewals (lineage, started_at, duration, success, error) '
+                                  'VALUES (?, ?, ?, ?, ?)', self._renewals)
+        self._attempts = []
+        self._renewals = []
+
+    def export(self, out):
+        """把所有表以 JSON 导出（逐行写出，不在内存中构建完整结果）"""
+        self.flush()
+        out.write('{')
+        for i, table in enumerate(self.EXPORT_TABLES):
+            cursor = self.conn.execute(f'SELECT * FROM {table}')
+            columns = [column[0] for column in cursor.description]
+            out.write(f'{"," if i else ""}\n  {json.dumps(table)}: [')
+            for j, row in enumerate(cursor):
+                out.write(f'{"," if j else ""}\n    {json.dumps(dict(zip(columns, row)), ensure_ascii=False)}')
+            out.write('\n  ]')
+        out.write('\n}\n')
+
+
+# 重试也不会成功的错误（DNS 未指向本机、CAA 禁止、域名被拒绝等），需要人工处理
+_PERMANENT_CERTBOT_ERRORS = re.compile(
+    r'NXDOMAIN|DNS problem|no valid (?:A|AAAA) records|unauthorized|rejectedIdentifier|'
+    r'CAA record|\bcaa\b|Invalid response from|incorrectResponse|malformed|policy forbids|noWebroot',
+    re.IGNORECASE)
+# certbot 对每个验证失败的域名输出 "Domain: ..." 一行
+_CERTBOT_FAILED_DOMAIN = re.compile(r'^\s*Domain:\s*(\S+)', re.MULTILINE)
+
+
+def classify_certbot_error(error: str) -> Tuple[bool, Set[str]]:
+    """对 certbot 错误输出分类，返回 (是否为永久性错误, 验证失败的域名)
+
+    超时、速率限制、CA 服务端错误、certbot 锁冲突等视为可重试错误。
+    """
+    permanent = bool(_PERMANENT_CERTBOT_ERRORS.search(error or ''))
+    return permanent, set(_CERTBOT_FAILED_DOMAIN.findall(error or ''))
+
+
+class AcmeError(Exception):
+    """ACME 服务器返回的错误（problem document）"""
+
+    def __init__(self, problem: Dict, status: int = 0, domain: Optional[str] = None):
+        self.problem = problem
+        self.type = problem.get('type', '')
+        detail = problem.get('detail', '')
+        if domain:
+            # 与 certbot 的输出格式一致，失败缓存据此找出验证失败的域名
+            message = f"Domain: {domain}\n  Type:   {self.type.rsplit(':', 1)[-1]}\n  Detail: {detail}"
+        else:
+            message = f"{self.type or f'HTTP {status}'}: {detail}"
+        super().__init__(message)
+
+
+def _b64url(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class AcmeClient:
+    """内置 ACME v2 客户端（RFC 8555，HTTP-01 验证，指定 DNS 后端时支持 DNS-01）
+
+    账户密钥保存在 account_dir 中，多次运行复用同一账户；HTTP 连接通过连接池复用，
+    多个线程可以同时进行各自的订单。证书按 certbot 的目录结构写入 config_dir。
+    依赖 requests 和 cryptography，只在启用时导入。
+    """
+
+    def __init__(self, directory_url: str, account_dir: str, config_dir: str, email: str = '',
+                 verify=True, key_size: int = 2048, pool_size: int = 8, timeout: float = 30,
+                 poll_interval: float = 1, dns_backend: Optional['DnsBackend'] = None,
+                 dns_propagation: float = 0):
+        try:
+            import cryptography  # noqa: F401
+            import requests
+            from requests.adapters import HTTPAdapter
+        except ImportError as e:
+            raise RuntimeError(f"内置 ACME 客户端需要 requests 和 cryptography: {e}")
+
+        self.directory_url = directory_url
+        self.account_dir = account_dir
+        self.config_dir = config_dir
+        self.email = email
+        self.key_size = key_size
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        # 通配符域名和没有 webroot 的域名通过 DNS-01 验证；添加 TXT 记录后等待 dns_propagation 秒再通知 CA
+        self.dns_backend = dns_backend
+        self.dns_propagation = dns_propagation
+
+        self.session = requests.Session()
+        self.session.verify = verify
+        self.session.headers['User-Agent'] = 'ssl-bot'
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._account_lock = threading.Lock()
+        self._nonce_lock = threading.Lock()
+        self._nonces: List[str] = []
+        self._directory: Optional[Dict] = None
+        self._key = None
+        self._jwk: Optional[Dict] = None
+        self._kid: Optional[str] = None
+        self.thumbprint: Optional[str] = None
+
+    @property
+    def directory(self) -> Dict:
+        if self._directory is None:
+            response = self.session.get(self.directory_url, timeout=self.timeout)
+            response.raise_for_status()
+            self._directory = response.json()
+        return self._directory
+
+    def _load_account(self):
+        """加载账户密钥，首次使用时生成密钥并注册账户"""
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ec
+
+        with self._account_lock:
+            if self._kid:
+                return
+            account_path = os.path.join(self.account_dir, 'account.json')
+            try:
+                with open(account_path, 'r') as f:
+                    account = json.load(f)
+                self._key = serialization.load_pem_private_key(account['key'].encode(), None)
+            except FileNotFoundError:
+                account = {}
+                self._key = ec.generate_private_key(ec.SECP256R1())
+
+            numbers = self._key.public_key().public_numbers()
+            self._jwk = {'crv': 'P-256', 'kty': 'EC',
+                         'x': _b64url(numbers.x.to_bytes(32, 'big')),
+                         'y': _b64url(numbers.y.to_bytes(32, 'big'))}
+            self.thumbprint = _b64url(hashlib.sha256(
+                json.dumps(self._jwk, sort_keys=True, separators=(',', ':')).encode()).digest())
+            if account.get('kid'):
+                self._kid = account['kid']
+                return
+
+            payload: Dict = {'termsOfServiceAgreed': True}
+            if self.email:
+                payload['contact'] = [f"mailto:{self.email}"]
+            response = self._post(self.directory['newAccount'], payload, use_jwk=True)
+            self._kid = response.headers['Location']
+
+            os.makedirs(self.account_dir, mode=0o700, exist_ok=True)
+            key_pem = self._key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                              serialization.NoEncryption()).decode()
+            fd = os.open(f"{account_path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'kid': self._kid, 'directory': self.directory_url, 'key': key_pem}, f)
+            os.replace(f"{account_path}.tmp", account_path)
+            logger.info(f"已注册 ACME 账户: {self._kid}")
+
+    def _nonce(self) -> str:
+        with self._nonce_lock:
+            if self._nonces:
+                return self._nonces.pop()
+        response = self.session.head(self.directory['newNonce'], timeout=self.timeout)
+        return response.headers['Replay-Nonce']
+
+    def _post(self, url: str, payload: Optional[Dict], use_jwk: bool = False):
+        """发送 JWS 签名请求（payload 为 None 时为 POST-as-GET），badNonce 时自动重试"""
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.asymmetric import ec
+        from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+
+        for attempt in range(3):
+            protected = {'alg': 'ES256', 'nonce': self._nonce(), 'url': url}
+            if use_jwk:
+                protected['jwk'] = self._jwk
+            else:
+                protected['kid'] = self._kid
+            encoded_protected = _b64url(json.dumps(protected).encode())
+            encoded_payload = '' if payload is None else _b64url(json.dumps(payload).encode())
+            r, s = decode_dss_signature(self._key.sign(f"{encoded_protected}.{encoded_payload}".encode(),
+                                                       ec.ECDSA(hashes.SHA256())))
+            body = {'protected': encoded_protected, 'payload': encoded_payload,
+                    'signature': _b64url(r.to_bytes(32, 'big') + s.to_bytes(32, 'big'))}
+            response = self.session.post(url, data=json.dumps(body), timeout=self.timeout,
+                                         headers={'Content-Type': 'application/jose+json'})
+
+            nonce = response.headers.get('Replay-Nonce')
+            if nonce:
+                with self._nonce_lock:
+                    self._nonces.append(nonce)
+            if response.status_code < 400:
+                return response
+
+            try:
+                problem = response.json()
+            except ValueError:
+                problem = {'detail': response.text[:200]}
+            if problem.get('type') == 'urn:ietf:params:acme:error:badNonce' and attempt < 2:
+                continue
+            raise AcmeError(problem, response.status_code)
+
+    def _poll(self, url: str, resource: Optional[Dict], pending: Tuple[str, ...], deadline: float) -> Dict:
+        """轮询订单或授权，直到状态不再是 pending 中的状态"""
+        while resource is None or resource['status'] in pending:
+            if resource is not None:
+                if time.monotonic() > deadline:
+                    raise AcmeError({'detail': f"等待 CA 处理超时: {url}"})
+                time.sleep(self.poll_interval)
+            resource = self._post(url, None).json()
+        return resource
+
+    def issue(self, domains: List[str], cert_name: str, webroots: Dict[str, str],
+              timeout: Optional[float] = None) -> str:
+        """申请一张证书并写入 certbot 目录结构，返回 live 目录
+
+        webroots 为每个域名写入 HTTP-01 验证文件的根目录；通配符域名和不在 webroots 中的域名
+        使用 DNS-01 验证（需要 dns_backend）。
+        """
+        self._load_account()
+        deadline = time.monotonic() + (timeout or 600)
+
+        response = self._post(self.directory['newOrder'],
+                              {'identifiers': [{'type': 'dns', 'value': domain} for domain in domains]})
+        order_url = response.headers['Location']
+        order = response.json()
+
+        self._authorize(order['authorizations'], webroots, deadline)
+
+        key_pem, csr_der = self._make_csr(domains)
+        order = self._post(order['finalize'], {'csr': _b64url(csr_der)}).json()
+        order = self._poll(order_url, order, ('pending', 'ready', 'processing'), deadline)
+        if order['status'] != 'valid':
+            raise AcmeError(order.get('error') or {'detail': f"订单状态为 {order['status']}"})
+
+        chain = self._post(order['certificate'], None).text
+        return self.write_lineage(cert_name, key_pem, chain, {domain: webroots.get(domain) for domain in domains})
+
+    def _authorize(self, authz_urls: List[str], webroots: Dict[str, str], deadline: float):
+        """先为所有授权写入验证文件或 TXT 记录，再通知 CA 并逐个等待验证结果"""
+        written = []
+        records = []
+        try:
+            ready = []
+            for authz_url in authz_urls:
+                authz = self._post(authz_url, None).json()
+                if authz['status'] == 'valid':
+                    continue
+                domain = authz['identifier']['value']
+                webroot = None if authz.get('wildcard') else webroots.get(domain)
+                if webroot:
+                    challenge = self._find_challenge(authz, 'http-01', domain)
+                    challenge_dir = os.path.join(webroot, '.well-known', 'acme-challenge')
+                    os.makedirs(challenge_dir, exist_ok=True)
+                    token_path = os.path.join(challenge_dir, challenge['token'])
+                    with open(token_path, 'w') as f:
+                        f.write(f"{challenge['token']}.{self.thumbprint}")
+                    os.chmod(token_path, 0o644)
+                    written.append(token_path)
+                elif self.dns_backend:
+                    challenge = self._find_challenge(authz, 'dns-01', domain)
+                    value = _b64url(hashlib.sha256(f"{challenge['token']}.{self.thumbprint}".encode()).digest())
+                    try:
+                        self.dns_backend.add_txt(domain, value)
+                    except DnsUpdateError as e:
+                        raise AcmeError({'type': 'dns', 'detail': f"添加 TXT 记录失败: {e}"}, domain=domain)
+                    records.append((domain, value))
+                else:
+                    raise AcmeError({'type': 'noWebroot', 'detail': "没有可写入验证文件的目录"}, domain=domain)
+                ready.append((authz_url, domain, challenge))
+
+            if records and self.dns_propagation:
+                logger.info(f"等待 {self.dns_propagation} 秒让 {len(records)} 条 TXT 记录生效")
+                time.sleep(self.dns_propagation)
+            for _, _, challenge in ready:
+                self._post(challenge['url'], {})
+
+            for authz_url, domain, _ in ready:
+                authz = self._poll(authz_url, None, ('pending',), deadline)
+                if authz['status'] != 'valid':
+                    errors = [c['error'] for c in authz.get('challenges', []) if c.get('error')]
+                    raise AcmeError(errors[0] if errors else {'detail': f"授权状态为 {authz['status']}"},
+                                    domain=domain)
+        finally:
+            for token_path in written:
+                try:
+                    os.unlink(token_path)
+                except OSError:
+                    pass
+            for domain, value in records:
+                try:
+                    self.dns_backend.remove_txt(domain, value)
+                except DnsUpdateError as e:
+                    logger.warning(f"删除 {domain} 的 TXT 记录失败: {e}")
+
+    @staticmethod
+    def _find_challenge(authz: Dict, kind: str, domain: str) -> Dict:
+        challenge = next((c for c in authz.get('challenges', []) if c['type'] == kind), None)
+        if challenge is None:
+            raise AcmeError({'type': 'unsupportedChallenge', 'detail': f"CA 没有提供 {kind.upper()} 验证"},
+                            domain=domain)
+        return challenge
+
+    def _make_csr(self, domains: List[str]) -> Tuple[bytes, bytes]:
+        """生成证书私钥和 CSR，返回 (私钥 PEM, CSR DER)"""
+        from cryptography import x509
+        from cryptography.x509.oid import NameOID
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+
+        key = rsa.generate_private_key(public_exponent=65537, key_size=self.key_size)
+        # CN 最长 64 个字符，超长时只使用 SAN
+        subject = [x509.NameAttribute(NameOID.COMMON_NAME, domains[0])] if len(domains[0]) <= 64 else []
+        csr = (x509.CertificateSigningRequestBuilder()
+               .subject_name(x509.Name(subject))
+               .add_extension(x509.SubjectAlternativeName([x509.DNSName(domain) for domain in domains]),
+                              critical=False)
+               .sign(key, hashes.SHA256()))
+        key_pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                    serialization.NoEncryption())
+        return key_pem, csr.public_bytes(serialization.Encoding.DER)
+
+    def write_lineage(self, name: str, key_pem: bytes, chain_pem: str,
+                      webroot_map: Optional[Dict[str, str]] = None) -> str:
+        """按 certbot 的目录结构写入证书：archive/ 下新增一个版本，live/ 下的符号链接指向它"""
+        archive_dir = os.path.join(self.config_dir, 'archive', name)
+        live_dir = os.path.join(self.config_dir, 'live', name)
+        os.makedirs(archive_dir, mode=0o700, exist_ok=True)
+        os.makedirs(live_dir, exist_ok=True)
+
+        versions = [int(match.group(1)) for match in
+                    (re.match(r'cert(\d+)\.pem$', entry) for entry in os.listdir(archive_dir)) if match]
+        version = max(versions, default=0) + 1
+
+        certs = [match.group(0).decode() + '\n' for match in _PEM_CERT_RE.finditer(chain_pem.encode())]
+        if not certs:
+            raise AcmeError({'detail': "CA 返回的证书链为空"})
+        files = {
+            'cert': certs[0],
+            'chain': ''.join(certs[1:]),
+            'fullchain': ''.join(certs),
+            'privkey': key_pem.decode(),
+        }
+        for kind, content in files.items():
+            path = os.path.join(archive_dir, f"{kind}{version}.pem")
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600 if kind == 'privkey' else 0o644)
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+        for kind in files:
+            link = os.path.join(live_dir, f"{kind}.pem")
+            if os.path.lexists(f"{link}.tmp"):
+                os.unlink(f"{link}.tmp")
+            os.symlink(os.path.relpath(os.path.join(archive_dir, f"{kind}{version}.pem"), live_dir), f"{link}.tmp")
+            os.replace(f"{link}.tmp", link)
+
+        self._write_renewal_conf(name, archive_dir, live_dir, webroot_map or {})
+        logger.info(f"证书已写入 {live_dir}（版本 {version}）")
+        return live_dir
+
+    def _write_renewal_conf(self, name: str, archive_dir: str, live_dir: str, webroot_map: Dict[str, str]):
+        renewal_dir = os.path.join(self.config_dir, 'renewal')
+        os.makedirs(renewal_dir, exist_ok=True)
+        lines = [f"archive_dir = {archive_dir}"]
+        lines += [f"{kind} = {os.path.join(live_dir, kind + '.pem')}" for kind in ('cert', 'privkey', 'chain', 'fullchain')]
+        lines += ['', '[renewalparams]', 'authenticator = webroot', f"server = {self.directory_url}",
+                  'key_type = rsa', f"rsa_key_size = {self.key_size}"]
+        webroot_map = {domain: path for domain, path in webroot_map.items() if path}
+        if webroot_map:
+            lines += ['[[webroot_map]]'] + [f"{domain} = {path}" for domain, path in webroot_map.items()]
+
+        path = os.path.join(renewal_dir, f"{name}.conf")
+        with open(f"{path}.tmp", 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(f"{path}.tmp", path)
+
+
+class DnsUpdateError(Exception):
+    """DNS 后端未能添加或删除 TXT 记录"""
+
+
+def _dns_wire_name(name: str) -> bytes:
+    """域名的 DNS 报文格式（不压缩）"""
+    return b''.join(bytes([len(label)]) + label for label in
+                    (label.encode('idna') for label in name.rstrip('.').split('.') if label)) + b'\0'
+
+
+class DnsBackend(abc.ABC):
+    """DNS-01 验证使用的 DNS 后端：为 _acme-challenge.<域名> 添加和删除 TXT 记录
+
+    domain 为要验证的域名（通配符证书为去掉 "*." 的域名），与 certbot 手动钩子的 CERTBOT_DOMAIN 一致。
+    同一名称下可能同时存在多条 TXT 记录（如 *.example.com 和 example.com 在同一张证书中），
+    添加时不能覆盖已有的值。
+    """
+
+    @abc.abstractmethod
+    def add_txt(self, domain: str, value: str):
+        """添加一条 TXT 记录，失败时抛出 DnsUpdateError"""
+
+    @abc.abstractmethod
+    def remove_txt(self, domain: str, value: str):
+        """删除添加过的 TXT 记录，失败时抛出 DnsUpdateError"""
+
+    @staticmethod
+    def record_name(domain: str) -> str:
+        return f"_acme-challenge.{domain.rstrip('.')}"
+
+
+class Rfc2136Backend(DnsBackend):
+    """通过 RFC 2136 动态更新（DNS UPDATE over TCP）在权威服务器上增删 TXT 记录
+
+    可选 TSIG 签名（RFC 8945，与 nsupdate -k 使用同样的密钥文件）。区域按 zones 中最长的
+    匹配后缀确定，没有配置时取注册域（公共后缀列表）。
+    """
+
+    # TSIG 算法名称和对应的哈希算法
+    TSIG_ALGORITHMS = {
+        'hmac-md5': ('hmac-md5.sig-alg.reg.int', 'md5'),
+        'hmac-sha1': ('hmac-sha1', 'sha1'),
+        'hmac-sha224': ('hmac-sha224', 'sha224'),
+        'hmac-sha256': ('hmac-sha256', 'sha256'),
+        'hmac-sha384': ('hmac-sha384', 'sha384'),
+        'hmac-sha512': ('hmac-sha512', 'sha512'),
+    }
+    RCODES = {1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP', 5: 'REFUSED', 6: 'YXDOMAIN',
+              7: 'YXRRSET', 8: 'NXRRSET', 9: 'NOTAUTH', 10: 'NOTZONE'}
+    TSIG_FUDGE = 300
+
+    def __init__(self, server: str, port: int = 53, zones: Iterable[str] = (), key_name: Optional[str] = None,
+                 key_secret: Optional[str] = None, key_algorithm: str = 'hmac-sha256', ttl: int = 60,
+                 timeout: float = 10, policy: Optional['DomainPolicy'] = None):
+        if key_algorithm.lower().rstrip('.') not in self.TSIG_ALGORITHMS:
+            raise ValueError(f"不支持的 TSIG 算法: {key_algorithm}")
+        self.server = server
+        self.port = port
+        self.zones = sorted((zone.lower().rstrip('.') for zone in zones), key=len, reverse=True)
+        self.key_name = key_name
+        self.key_secret = base64.b64decode(key_secret) if key_secret else None
+        self.key_algorithm = key_algorithm.lower().rstrip('.')
+        self.ttl = ttl
+        self.timeout = timeout
+        self.policy = policy or DomainPolicy()
+
+    @classmethod
+    def from_config(cls, config: Dict, policy: Optional['DomainPolicy'] = None) -> 'Rfc2136Backend':
+        key_name, key_secret = config.get('tsig_key_name'), config.get('tsig_secret')
+        key_algorithm = config.get('tsig_algorithm', 'hmac-sha256')
+        if config.get('tsig_key_file'):
+            key_name, key_algorithm, key_secret = cls.read_key_file(config['tsig_key_file'])
+        return cls(config.get('server', '127.0.0.1'), int(config.get('port', 53)), config.get('zones') or [],
+                   key_name, key_secret, key_algorithm, int(config.get('ttl', 60)),
+                   float(config.get('timeout', 10)), policy)
+
+    @staticmethod
+    def read_key_file(path: str) -> Tuple[str, str, str]:
+        """读取 BIND 格式的 TSIG 密钥文件（tsig-keygen / ddns-confgen 生成），返回 (名称, 算法, 密钥)"""
+        with open(path, 'r') as f:
+            text = f.read()
+        match = re.search(r'key\s+"?([^"\s{]+)"?\s*\{(.*?)\}\s*;', text, re.DOTALL)
+        algorithm = re.search(r'algorithm\s+"?([\w.-]+)"?\s*;', match.group(2)) if match else None
+        secret = re.search(r'secret\s+"([^"]+)"\s*;', match.group(2)) if match else None
+        if not (match and algorithm and secret):
+            raise ValueError(f"无法解析 TSIG 密钥文件: {path}")
+        return match.group(1), algorithm.group(1), secret.group(1)
+
+    def zone_for(self, domain: str) -> str:
+        domain = domain.lower().rstrip('.')
+        for zone in self.zones:
+            if domain == zone or domain.endswith('.' + zone):
+                return zone
+        return self.policy.registered_domain(domain)
+
+    def add_txt(self, domain: str, value: str):
+        self._update(domain, value, delete=False)
+        logger.info(f"已添加 TXT 记录 {self.record_name(domain)}（{self.server}:{self.port}）")
+
+    def remove_txt(self, domain: str, value: str):
+        self._update(domain, value, delete=True)
+        logger.debug(f"已删除 TXT 记录 {self.record_name(domain)}")
+
+    def build_update(self, domain: str, value: str, delete: bool, message_id: int,
+                     now: Optional[int] = None) -> bytes:
+        """生成 UPDATE 报文：区域段为 domain 所在区域的 SOA，更新段添加或删除一条 TXT 记录"""
+        rdata = bytes([len(value)]) + value.encode()
+        # 删除指定记录时 class 为 NONE、TTL 为 0（RFC 2136 2.5.4）
+        rr_class, ttl = (254, 0) if delete else (1, self.ttl)
+        message = (struct.pack('!HHHHHH', message_id, 5 << 11, 1, 0, 1, 0)
+                   + _dns_wire_name(self.zone_for(domain)) + struct.pack('!HH', 6, 1)
+                   + _dns_wire_name(self.record_name(domain)) + struct.pack('!HHIH', 16, rr_class, ttl, len(rdata))
+                   + rdata)
+        if self.key_name:
+            message = self._sign(message, message_id, int(time.time()) if now is None else now)
+        return message
+
+    def _sign(self, message: bytes, message_id: int, now: int) -> bytes:
+        """追加 TSIG 记录（RFC 8945 4.3）"""
+        import hmac
+        algorithm_name, digest = self.TSIG_ALGORITHMS[self.key_algorithm]
+        key_name = _dns_wire_name(self.key_name.lower())
+        algorithm = _dns_wire_name(algorithm_name)
+        time_signed = struct.pack('!HIH', now >> 32, now & 0xFFFFFFFF, self.TSIG_FUDGE)
+        # MAC 覆盖报文本身和 TSIG 变量（名称、class ANY、TTL 0、算法、时间、error 0、other 长度 0）
+        variables = key_name + struct.pack('!HI', 255, 0) + algorithm + time_signed + struct.pack('!HH', 0, 0)
+        mac = hmac.new(self.key_secret, message + variables, digest).digest()
+        rdata = algorithm + time_signed + struct.pack('!H', len(mac)) + mac + struct.pack('!HHH', message_id, 0, 0)
+        record = key_name + struct.pack('!HHIH', 250, 255, 0, len(rdata)) + rdata
+        arcount = struct.unpack('!H', message[10:12])[0] + 1
+        return message[:10] + struct.pack('!H', arcount) + message[12:] + record
+
+    def _update(self, domain: str, value: str, delete: bool):
+        import socket
+        import secrets
+        message_id = secrets.randbelow(0x10000)
+        message = self.build_update(domain, value, delete, message_id)
+        try:
+            with socket.create_connection((self.server, self.port), timeout=self.timeout) as sock:
+                sock.sendall(struct.pack('!H', len(message)) + message)
+                length = struct.unpack('!H', self._recv(sock, 2))[0]
+                response = self._recv(sock, length)
+        except OSError as e:
+            raise DnsUpdateError(f"连接 DNS 服务器 {self.server}:{self.port} 失败: {e}")
+
+        response_id, flags = struct.unpack('!HH', response[:4])
+        if response_id != message_id:
+            raise DnsUpdateError("DNS 服务器返回的报文 ID 不匹配")
+        rcode = flags & 0xF
+        if rcode:
+            raise DnsUpdateError(f"DNS 服务器拒绝更新 {self.record_name(domain)}: "
+                                 f"{self.RCODES.get(rcode, rcode)}（区域 {self.zone_for(domain)}）")
+
+    @staticmethod
+    def _recv(sock, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise OSError("连接被关闭")
+            data += chunk
+        return data
+
+
+class HookDnsBackend(DnsBackend):
+    """调用外部脚本增删 TXT 记录
+
+    与 certbot 手动钩子的约定相同：环境变量 CERTBOT_DOMAIN 为要验证的域名，
+    CERTBOT_VALIDATION 为 TXT 记录的值，现有的 certbot DNS 钩子脚本可以直接使用。
+    """
+
+    def __init__(self, auth: str, cleanup: Optional[str] = None, timeout: float = 120):
+        self.auth = auth
+        self.cleanup = cleanup
+        self.timeout = timeout
+
+    def add_txt(self, domain: str, value: str):
+        self._run(self.auth, domain, value)
+        logger.info(f"已通过钩子脚本添加 TXT 记录 {self.record_name(domain)}")
+
+    def remove_txt(self, domain: str, value: str):
+        if self.cleanup:
+            self._run(self.cleanup, domain, value)
+
+    def _run(self, command: str, domain: str, value: str):
+        env = dict(os.environ, CERTBOT_DOMAIN=domain.rstrip('.'), CERTBOT_VALIDATION=value)
+        try:
+            subprocess.run(shlex.split(command), env=env, check=True, capture_output=True, text=True,
+                           timeout=self.timeout)
+        except subprocess.CalledProcessError as e:
+            raise DnsUpdateError(f"钩子脚本 {command} 失败（退出码 {e.returncode}）: {(e.stderr or '').strip()}")
+        except (OSError, subprocess.TimeoutExpired) as e:
+            raise DnsUpdateError(f"无法执行钩子脚本 {command}: {e}")
+
+
+def make_dns_backend(wildcard_config: Dict, policy: Optional['DomainPolicy'] = None) -> DnsBackend:
+    """按 wildcard.backend 创建 DNS 后端"""
+    backend = wildcard_config.get('backend', 'rfc2136')
+    if backend == 'rfc2136':
+        return Rfc2136Backend.from_config(wildcard_config.get('rfc2136') or {}, policy)
+    if backend == 'hook':
+        hook_config = wildcard_config.get('hook') or {}
+        if not hook_config.get('auth'):
+            raise ValueError("wildcard.hook.auth 未配置")
+        return HookDnsBackend(hook_config['auth'], hook_config.get('cleanup'), hook_config.get('timeout', 120))
+    raise ValueError(f"不支持的 DNS 后端: {backend}")
+
+
+class NginxSSLInstaller:
+    """把证书写入 Nginx 配置，不经过 certbot 的 nginx 插件
+
+    按解析得到的指令偏移改写 server 块：80 端口的 listen 改为 443 ssl 并加入证书路径；
+    开启 redirect_http 时另写一个 80 端口的 server 块跳转到 HTTPS（保留 ACME 验证路径，
+    续签时仍可使用 HTTP-01 验证）。
+
+    共用验证目录模式（指定 challenge_snippet）下，所有 HTTP server 块 include 同一个
+    验证路径片段，证书都通过同一个 webroot 验证。
+    """
+
+    MARKER = '# managed by ssl-bot'
+    CHALLENGE_LOCATION = '/.well-known/acme-challenge/'
+
+    def __init__(self, reload_coordinator: Optional[ReloadCoordinator] = None, redirect_http: bool = True,
+                 hsts: bool = True, challenge_webroot: Optional[str] = None,
+                 challenge_snippet: Optional[str] = None):
+        self.reload_coordinator = reload_coordinator
+        self.redirect_http = redirect_http
+        self.hsts = hsts
+        self.challenge_webroot = challenge_webroot
+        self.challenge_snippet = challenge_snippet
+        # 同一配置文件可能包含多个分组的 server 块，串行改写
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _replace_file(path: str, text: str):
+        """原子替换文件内容（保留权限）"""
+        tmp_path = f"{path}.ssl-bot.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        try:
+            os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        except FileNotFoundError:
+            os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _serves_http(server: NginxDirective) -> bool:
+        """server 块是否监听 80 端口（没有 listen 时默认监听 80）"""
+        listens = [listen for listen in server.find('listen') if listen.args]
+        return not listens or any(NginxConfigParser._listen_port(listen.args[0]) == 80 for listen in listens)
+
+    def write_challenge_snippet(self) -> bool:
+        """写入共用的验证路径片段，内容有变化时标记需要重载"""
+        content = (f"# 由 ssl-bot 生成：所有 HTTP server 块共用的 ACME HTTP-01 验证路径\n"
+                   f"location ^~ {self.CHALLENGE_LOCATION} {{\n"
+                   f"    root {self.challenge_webroot};\n"
+                   f"    default_type \"text/plain\";\n"
+                   f"    try_files $uri =404;\n"
+                   f"}}\n")
+        try:
+            os.makedirs(os.path.join(self.challenge_webroot, '.well-known', 'acme-challenge'), exist_ok=True)
+            try:
+                with open(self.challenge_snippet, 'r', encoding='utf-8') as f:
+                    if f.read() == content:
+                        return True
+            except FileNotFoundError:
+                pass
+            os.makedirs(os.path.dirname(self.challenge_snippet), exist_ok=True)
+            self._replace_file(self.challenge_snippet, content)
+        except OSError as e:
+            logger.error(f"写入 ACME 验证片段失败 {self.challenge_snippet}: {e}")
+            return False
+
+        logger.info(f"已写入 ACME 验证片段: {self.challenge_snippet}")
+        if self.reload_coordinator:
+            self.reload_coordinator.mark_dirty("更新 ACME 验证片段")
+        return True
+
+    def add_challenge_includes(self, config_files: List[str]) -> Dict[str, str]:
+        """在配置文件的每个 HTTP server 块中 include 验证片段，返回被修改文件的原内容
+
+        已经自带 acme-challenge location 的块不再加入（重复的 location 会导致 nginx -t 失败）。
+        """
+        originals: Dict[str, str] = {}
+        with self._lock:
+            for config_file in config_files:
+                path = os.path.realpath(config_file)
+                if path in originals:
+                    continue
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        text = f.read()
+                    insertions = []
+                    for server in iter_server_directives(text):
+                        if not self._serves_http(server) or self._has_challenge_location(server):
+                            continue
+                        indent = self._indent(text, server.block[0].start) if server.block else '    '
+                        insertions.append((text.index('{', server.start) + 1,
+                                           f"\n{indent}include {self.challenge_snippet}; {self.MARKER}"))
+                    if not insertions:
+                        continue
+                    new_text = text
+                    for offset, line in reversed(insertions):
+                        new_text = new_text[:offset] + line + new_text[offset:]
+                    self._replace_file(path, new_text)
+                    originals[path] = text
+                except Exception as e:
+                    logger.error(f"加入 ACME 验证路径失败 {config_file}: {e}")
+
+        if originals:
+            logger.info(f"已在 {len(originals)} 个配置文件的 HTTP server 块中加入共用的 ACME 验证路径")
+            if self.reload_coordinator:
+                self.reload_coordinator.mark_dirty("加入 ACME 验证路径")
+        return originals
+
+    def restore(self, originals: Dict[str, str]):
+        """还原 add_challenge_includes 修改过的文件"""
+        with self._lock:
+            for path, text in originals.items():
+                try:
+                    self._replace_file(path, text)
+                except OSError as e:
+                    logger.error(f"还原配置文件失败 {path}: {e}")
+
+    def _has_challenge_location(self, server: NginxDirective) -> bool:
+        if any(include.args and include.args[0] == self.challenge_snippet for include in server.find('include')):
+            return True
+        return any(location.args and location.args[-1].startswith(self.CHALLENGE_LOCATION.rstrip('/'))
+                   for location in server.find('location'))
+
+    def install(self, config_file: str, server_names: List[str], live_dir: str,
+                root_path: Optional[str] = None) -> bool:
+        """为 server_names 所在的 server 块启用证书"""
+        # 配置文件可能是 sites-enabled 中的符号链接，改写链接指向的文件
+        path = os.path.realpath(config_file)
+        with self._lock:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    text = f.read()
+                server = self._find_server(text, server_names)
+                if server is None:
+                    logger.error(f"在 {config_file} 中找不到 {server_names} 的 HTTP server 块")
+                    return False
+
+                self._replace_file(path, text[:server.start] + self.render(text, server, live_dir, root_path)
+                                   + text[server.end:])
+            except Exception as e:
+                logger.error(f"写入 SSL 配置失败 {config_file}: {e}")
+                return False
+
+        logger.info(f"已为 {', '.join(server_names)} 写入 SSL 配置: {config_file}")
+        if self.reload_coordinator:
+            self.reload_coordinator.mark_dirty(f"为 {server_names[0]} 启用证书")
+        return True
+
+    def _find_server(self, text: str, server_names: List[str]) -> Optional[NginxDirective]:
+        wanted = set(server_names)
+        for server in iter_server_directives(text):
+            names = {name for directive in server.find('server_name') for name in directive.args}
+            ports = [NginxConfigParser._listen_port(listen.args[0]) for listen in server.find('listen') if listen.args]
+            if wanted <= names and self._serves_http(server) and 443 not in ports:
+                return server
+        return None
+
+    def render(self, text: str, server: NginxDirective, live_dir: str, root_path: Optional[str] = None) -> str:
+        """生成替换原 server 块的文本（启用 SSL 的块，以及可选的跳转块）"""
+        listens = [listen for listen in server.find('listen') if listen.args]
+        http_listens = [listen for listen in listens if NginxConfigParser._listen_port(listen.args[0]) == 80]
+        body_start = text.index('{', server.start) + 1
+        indent = self._indent(text, server.block[0].start) if server.block else '    '
+
+        inserted = []
+        if not listens:
+            # 没有 listen 时 Nginx 默认监听 80，加入 443 后需要显式写出
+            inserted.append(f"listen 443 ssl; {self.MARKER}")
+            if not self.redirect_http:
+                inserted.append("listen 80;")
+        inserted.append(f"ssl_certificate {os.path.join(live_dir, 'fullchain.pem')}; {self.MARKER}")
+        inserted.append(f"ssl_certificate_key {os.path.join(live_dir, 'privkey.pem')}; {self.MARKER}")
+        if self.hsts:
+            inserted.append(f'add_header Strict-Transport-Security "max-age=31536000" always; {self.MARKER}')
+
+        # (起始, 结束, 替换文本)，从后往前应用
+        edits = [(body_start, body_start, ''.join(f"\n{indent}{line}" for line in inserted))]
+        for listen in http_listens:
+            ssl_listen = f"{self._ssl_listen(listen.args)} {self.MARKER}"
+            if self.redirect_http:
+                edits.append((listen.start, listen.end, ssl_listen))
+            else:
+                edits.append((listen.end, listen.end, f"\n{indent}{ssl_listen}"))
+
+        block = text[server.start:server.end]
+        for start, end, replacement in sorted(edits, reverse=True):
+            block = block[:start - server.start] + replacement + block[end - server.start:]
+
+        if self.redirect_http:
+            block += '\n\n' + self._redirect_block(text, server, http_listens, root_path)
+        return block
+
+    @staticmethod
+    def _indent(text: str, offset: int) -> str:
+        line_start = text.rfind('\n', 0, offset) + 1
+        prefix = text[line_start:offset]
+        return prefix if prefix.isspace() else '    '
+
+    @staticmethod
+    def _ssl_listen(args: List[str]) -> str:
+        """把 80 端口的 listen 参数改为 443 ssl"""
+        address = args[0]
+        if address.isdigit():
+            address = '443'
+        elif address.endswith(':80'):
+            address = address[:-3] + ':443'
+        else:
+            address = f"{address}:443"
+        params = ''.join(f" {arg}" for arg in args[1:] if arg != 'ssl')
+        return f"listen {address} ssl{params};"
+
+    def _redirect_block(self, text: str, server: NginxDirective, http_listens: List[NginxDirective],
+                        root_path: Optional[str]) -> str:
+        listens = [text[listen.start:listen.end] for listen in http_listens] or ['listen 80;']
+        names = ' '.join(name for directive in server.find('server_name') for name in directive.args)
+        lines = ['server {'] + [f"    {listen}" for listen in listens] + [f"    server_name {names};"]
+        challenge_root = self.challenge_webroot or root_path
+        if self.challenge_snippet:
+            lines += [f"    include {self.challenge_snippet};"]
+        elif challenge_root:
+            lines += ['', f"    location ^~ {self.CHALLENGE_LOCATION} {{", f"        root {challenge_root};", '    }']
+        lines += ['', '    location / {', '        return 301 https://$host$request_uri;', '    }',
+                  f"}} {self.MARKER}"]
+        return '\n'.join(lines)
+
+
+class SSLCertManager:
+    """SSL 证书管理器"""
+    
+    def __init__(self, config: Dict, reload_coordinator: Optional[ReloadCoordinator] = None,
+                 store: Optional[StateStore] = None, config_path: str = DEFAULT_CONFIG):
+        self.config = config
+        self.config_path = config_path
+        self.reload_coordinator = reload_coordinator
+        self.store = store
+        # --retry-failed：忽略失败退避，本次运行重试所有失败过的域名
+        self.retry_failed = False
+        self.email = config.get('email', 'admin@example.com')
+        self.certbot_config = config.get('certbot') or {}
+        self.policy = DomainPolicy(config.get('exclude_domains', []),
+                                   (config.get('policy') or {}).get('public_suffix_list'))
+        self.inventory = CertificateInventory(
+            self.certbot_config.get('config_dir', '/etc/letsencrypt'),
+            os.path.join(config.get('state_dir', DEFAULT_STATE_DIR), 'cert-inventory.json')
+        )
+        # acme.client 为 builtin 时使用内置 ACME 客户端，不启动 certbot
+        self.acme_config = config.get('acme') or {}
+        self.use_builtin_acme = self.acme_config.get('client', 'certbot') == 'builtin'
+        self._acme_client: Optional[AcmeClient] = None
+        self._acme_lock = threading.Lock()
+        # wildcard.enabled 时同一区域下的子域名合并为一张通配符证书，通过 DNS-01 验证
+        self.wildcard_config = config.get('wildcard') or {}
+        self.wildcard_enabled = bool(self.wildcard_config.get('enabled', False))
+        # challenge.mode 为 shared 时所有证书通过同一个 webroot 验证，certbot 使用 certonly --webroot，
+        # 不再调用 nginx 插件解析和改写配置
+        challenge_config = config.get('challenge') or {}
+        self.shared_challenge = challenge_config.get('mode', 'nginx') == 'shared'
+        nginx_root = (config.get('nginx') or {}).get('config_path', DEFAULT_NGINX_ROOT)
+        self.installer = NginxSSLInstaller(
+            reload_coordinator,
+            redirect_http=self.certbot_config.get('redirect_http', True),
+            hsts=self.certbot_config.get('hsts', True),
+            challenge_webroot=challenge_config.get('webroot', DEFAULT_CHALLENGE_WEBROOT) if self.shared_challenge else None,
+            challenge_snippet=(challenge_config.get('snippet') or os.path.join(nginx_root, DEFAULT_CHALLENGE_SNIPPET)
+                               if self.shared_challenge else None))
+
+    @property
+    def workers(self) -> int:
+        """并发申请数：certbot 持有全局锁默认只用 1 个，内置客户端可同时进行多个订单"""
+        if self.use_builtin_acme:
+            return max(1, int(self.acme_config.get('workers', 8)))
+        return max(1, int(self.certbot_config.get('workers', 1)))
+
+    @property
+    def acme_client(self) -> AcmeClient:
+        """首次使用时创建内置 ACME 客户端（账户和连接池在本次运行内共享）"""
+        with self._acme_lock:
+            if self._acme_client is None:
+                if self.certbot_config.get('test_cert', False):
+                    directory = self.acme_config.get('staging_directory', LETSENCRYPT_STAGING_DIRECTORY)
+                else:
+                    directory = self.acme_config.get('directory', LETSENCRYPT_DIRECTORY)
+                account_dir = os.path.join(self.config.get('state_dir', DEFAULT_STATE_DIR), 'acme',
+                                           hashlib.sha1(directory.encode()).hexdigest()[:12])
+                self._acme_client = AcmeClient(
+                    directory, account_dir, self.inventory.config_dir, self.email,
+                    verify=self.acme_config.get('verify', True),
+                    key_size=self.certbot_config.get('rsa_key_size', 2048),
+                    pool_size=self.workers,
+                    poll_interval=self.acme_config.get('poll_interval', 1),
+                    dns_backend=self.dns_backend if self.wildcard_enabled else None,
+                    dns_propagation=self.wildcard_config.get('propagation_seconds', 0))
+            return self._acme_client
+
+    @cached_property
+    def dns_backend(self) -> DnsBackend:
+        """DNS-01 验证使用的 DNS 后端（wildcard.backend）"""
+        return make_dns_backend(self.wildcard_config, self.policy)
+
+    def run_dns_hook(self, action: str) -> int:
+        """certbot --manual 的验证钩子：按 CERTBOT_DOMAIN 和 CERTBOT_VALIDATION 添加或删除 TXT 记录"""
+        domain, value = os.environ.get('CERTBOT_DOMAIN'), os.environ.get('CERTBOT_VALIDATION')
+        if not domain or not value:
+            logger.error("缺少环境变量 CERTBOT_DOMAIN / CERTBOT_VALIDATION（--dns-hook 由 certbot 调用）")
+            return 1
+        try:
+            if action == 'auth':
+                self.dns_backend.add_txt(domain, value)
+                propagation = self.wildcard_config.get('propagation_seconds', 0)
+                if propagation:
+                    logger.info(f"等待 {propagation} 秒让 TXT 记录生效")
+                    time.sleep(propagation)
+            else:
+                self.dns_backend.remove_txt(domain, value)
+        except (DnsUpdateError, ValueError) as e:
+            logger.error(f"DNS 验证钩子（{action}）失败: {e}")
+            return 1
+        return 0
+    
+    def scan_and_apply(self):
+        """扫描 Nginx 配置并应用 SSL"""
+        logger.info("开始扫描 Nginx 配置...")
+        
+        config_files = self.nginx_parser.find_nginx_configs()
+        
+        total_servers = 0
+        ssl_applied = 0
+        
+        for config_file in config_files:
+            logger.debug(f"解析配置文件: {config_file}")
+            server_blocks = self.nginx_parser.parse_server_blocks(config_file)
+            total_servers += len(server_blocks)
+            
+            for server_block in server_blocks:
+                logger.debug(f"检查 server 块: {server_block['server_names']}")
+                if self.ssl_manager.needs_ssl(server_block):
+                    logger.info(f"发现需要 SSL 的配置: {server_block['server_names']}")
+                    
+                    if self.ssl_manager.apply_ssl(server_block):
+                        ssl_applied += 1
+        
+        logger.info(f"扫描完成，共发现 {total_servers} 个 server 块，为 {ssl_applied} 个服务应用了 SSL")
+        return ssl_applied
+
+    # def needs_ssl(self, server_block: Dict) -> bool:
+    #     """检查服务器块是否需要 SSL"""
+    #     # 如果已有 SSL，跳过
+    #     if server_block['has_ssl']:
+    #         return False
         
-        if domain in invalid_domains:
+    #     # 检查域名是否在排除列表中
+    #     exclude_domains = self.config.get('exclude_domains', [])
+    #     for domain in server_block['server_names']:
+    #         if any(excluded in domain for excluded in exclude_domains):
+    #             return False
+                
+    #     return True
+    
+    def needs_ssl(self, server_block: Dict, check_backoff: bool = True) -> bool:
+        """检查服务器块是否需要 SSL"""
+        # 如果已有 SSL，跳过
+        if server_block['has_ssl']:
+            logger.debug(f"域名 {server_block['server_names']} 已有 SSL 配置，跳过")
             return False
         
-        # 检查是否是本地网络域名
-        if domain.endswith('.local') or domain.endswith('.home') or domain.endswith('.lan'):
+        # 检查是否监听 80 端口（只有 HTTP 服务才需要 SSL）
+        if not server_block.get('listen_80', True):
+            logger.debug(f"域名 {server_block['server_names']} 不监听 80 端口，跳过")
+            return False
+
+        # 只做 HTTPS 跳转的块（如写入证书时生成的跳转块），证书由对应的 443 块使用
+        if server_block.get('redirects_https'):
+            logger.debug(f"域名 {server_block['server_names']} 的 HTTP 请求已跳转到 HTTPS，跳过")
             return False
         
-        # 基本域名格式验证
-        import re
-        domain_pattern = r'^[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?(\.[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*\.[a-zA-Z]{2,}$'
-        
-        return bool(re.match(domain_pattern, domain))
+        # 检查域名是否在排除列表中、是否是有效的公共域名
+        for domain in server_block['server_names']:
+            verdict = self.policy.classify(domain)
+            if verdict == DomainPolicy.EXCLUDED:
+                logger.info(f"跳过排除域名: {domain}")
+                return False
+            if verdict == DomainPolicy.INVALID:
+                logger.info(f"跳过无效域名: {domain}")
+                return False
+
+        # 最近申请失败、仍在退避期内的域名组合不再调用 certbot
+        if check_backoff and self.in_backoff(server_block['server_names']):
+            return False
+                
+        logger.debug(f"发现需要 SSL 的配置: {server_block['server_names']}")
+        return True
+
+    def in_backoff(self, domains: List[str]) -> bool:
+        """域名组合是否处于失败退避期"""
+        if self.retry_failed or not self.store:
+            return False
+        retry_at = self.store.retry_at(domains)
+        if retry_at is None or retry_at <= time.time():
+            return False
+        logger.debug(f"域名 {domains} 申请失败，退避至 "
+                    f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(retry_at))} 后再重试")
+        return True
+
+    def _is_valid_public_domain(self, domain: str) -> bool:
+        """验证是否是有效的公共域名"""
+        return self.policy.is_valid_public_domain(domain)
 
     def apply_ssl(self, server_block: Dict) -> bool:
         """为服务器块申请 SSL 证书"""
+        return self.issue_certificate(server_block['server_names'])
+
+    def apply_group(self, group: Dict, timeout: Optional[float] = None) -> bool:
+        """为规划器生成的 SAN 分组申请一张证书"""
+        return self.try_issue_group(group, timeout)[0]
+
+    def try_issue_group(self, group: Dict, timeout: Optional[float] = None) -> Tuple[bool, str]:
+        """为 SAN 分组申请证书，返回 (是否成功, 失败原因)"""
+        dns_challenge = group.get('challenge') == 'dns-01'
+        if group.get('existing'):
+            # 已有覆盖这些域名的通配符证书，只需写入 Nginx 配置
+            live_dir = os.path.join(self.inventory.config_dir, 'live', group['cert_name'])
+        elif self.use_builtin_acme:
+            webroots = {}
+            if not dns_challenge:
+                for block in group['server_blocks']:
+                    for domain in block['server_names']:
+                        webroots[domain] = self.installer.challenge_webroot or block.get('root_path')
+                # 没有 root 指令的 server 块（如反向代理）没有可写入验证文件的目录，有 DNS 后端时改用 DNS-01
+                missing = [domain for domain, webroot in webroots.items() if not webroot]
+                if missing and not self.wildcard_enabled:
+                    error = '\n'.join(f"Domain: {domain}\n  Type:   noWebroot\n  Detail: server 块没有 root 指令，"
+                                      f"内置 ACME 客户端无法进行 HTTP-01 验证，请启用 challenge.mode: shared"
+                                      for domain in missing)
+                    logger.error(f"无法为 {', '.join(missing)} 申请证书：server 块没有 root 指令，"
+                                 f"使用内置 ACME 客户端时请启用 challenge.mode: shared")
+                    return False, error
+            try:
+                logger.info(f"为域名 {', '.join(group['domains'])} 申请 SSL 证书（内置 ACME 客户端）...")
+                with metrics.span('acme'):
+                    live_dir = self.acme_client.issue(group['domains'], group['cert_name'], webroots, timeout)
+            except Exception as e:
+                logger.error(f"申请 SSL 证书失败: {e}")
+                return False, str(e)
+        elif self.shared_challenge or dns_challenge:
+            # certonly 只签发证书，443 server 块由 ssl-bot 写入
+            success, error = self.try_issue(group['domains'], group['cert_name'], timeout,
+                                            'dns-01' if dns_challenge else 'http-01')
+            if not success:
+                return False, error
+            live_dir = os.path.join(self.inventory.config_dir, 'live', group['cert_name'])
+        else:
+            return self.try_issue(group['domains'], group['cert_name'], timeout)
+
+        failed = [block['server_names'][0] for block in group['server_blocks']
+                  if not self.installer.install(block['config_file'], block['server_names'], live_dir,
+                                                block.get('root_path'))]
+        if failed:
+            return False, f"证书已签发，但写入 Nginx 配置失败: {', '.join(failed)}"
+        logger.info(f"{group['domains'][0]} 的证书已{'启用' if group.get('existing') else '签发并写入 Nginx 配置'}")
+        return True, ''
+
+    def _certbot_command(self) -> List[str]:
+        """certbot 可执行文件（certbot.command 可指向其他路径或测试用的替身脚本）"""
+        return shlex.split(self.certbot_config.get('command', 'certbot'))
+
+    def issue_certificate(self, domains: List[str], cert_name: Optional[str] = None,
+                          timeout: Optional[float] = None) -> bool:
+        """调用一次 certbot 为多个域名申请同一张（SAN）证书"""
+        return self.try_issue(domains, cert_name, timeout)[0]
+
+    def try_issue(self, domains: List[str], cert_name: Optional[str] = None,
+                  timeout: Optional[float] = None, challenge: str = 'http-01') -> Tuple[bool, str]:
+        """申请证书，返回 (是否成功, 失败原因)"""
         try:
-            domains = server_block['server_names']
             primary_domain = domains[0]
             
             logger.info(f"为域名 {', '.join(domains)} 申请 SSL 证书...")
             
             # 构建 certbot 命令
-            cmd = [
-                'certbot', '--nginx', '--non-interactive', '--agree-tos',
-                '--email', self.email, '--redirect', '--hsts'
-            ]
+            if challenge == 'dns-01':
+                # TXT 记录由 certbot 回调 ssl-bot --dns-hook 通过配置的 DNS 后端写入
+                hook = ' '.join(shlex.quote(arg) for arg in (sys.executable, os.path.abspath(__file__),
+                                                             '--config', self.config_path, '--dns-hook'))
+                cmd = self._certbot_command() + [
+                    'certonly', '--manual', '--preferred-challenges', 'dns',
+                    '--manual-auth-hook', f"{hook} auth", '--manual-cleanup-hook', f"{hook} cleanup",
+                    '--non-interactive', '--agree-tos', '--email', self.email
+                ]
+            elif self.shared_challenge:
+                cmd = self._certbot_command() + [
+                    'certonly', '--webroot', '-w', self.installer.challenge_webroot,
+                    '--non-interactive', '--agree-tos', '--email', self.email
+                ]
+            else:
+                cmd = self._certbot_command() + [
+                    '--nginx', '--non-interactive', '--agree-tos', '--email', self.email
+                ]
+                if self.certbot_config.get('redirect_http', True):
+                    cmd.append('--redirect')
+                if self.certbot_config.get('hsts', True):
+                    cmd.append('--hsts')
+            if self.certbot_config.get('test_cert', False):
+                cmd.append('--test-cert')
+            if self.certbot_config.get('rsa_key_size'):
+                cmd.extend(['--rsa-key-size', str(self.certbot_config['rsa_key_size'])])
+            if cert_name:
+                cmd.extend(['--cert-name', cert_name])
             
             # 添加所有域名
             for domain in domains:
                 cmd.extend(['-d', domain])
             
             # 执行 certbot 命令
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+            metrics.inc('certbot_invocations')
+            with metrics.span('certbot'):
+                result = subprocess.run(cmd, capture_output=True, text=True, check=True, timeout=timeout)
             
             if result.returncode == 0:
                 logger.info(f"成功为 {primary_domain} 申请 SSL 证书")
-                return True
+                return True, ''
             else:
                 logger.error(f"申请 SSL 证书失败: {result.stderr}")
-                return False
+                return False, result.stderr
                 
         except subprocess.CalledProcessError as e:
+            metrics.inc('certbot_failures')
             logger.error(f"Certbot 执行失败: {e.stderr}")
-            return False
+            return False, e.stderr or ''
+        except subprocess.TimeoutExpired:
+            metrics.inc('certbot_failures')
+            logger.error(f"Certbot 执行超时（{timeout} 秒）: {primary_domain}")
+            return False, f"timeout after {timeout}s"
         except Exception as e:
             logger.error(f"申请 SSL 证书时发生错误: {e}")
-            return False
+            return False, str(e)
     
     def renew_certificates(self) -> bool:
-        """续签所有证书"""
+        """续签进入续签窗口的证书（按过期时间先后逐个续签）"""
+        try:
+            logger.info("开始续签 SSL 证书...")
+
+            lineages = self.inventory.lineages()
+            metrics.set_certificates(lineages)
+            queue = self.renewal_queue(lineages)
+            if not queue:
+                logger.info(f"{len(lineages)} 张证书都不需要续签")
+                return True
+
+            logger.info(f"{len(queue)}/{len(lineages)} 张证书需要续签")
+            failed = []
+            with metrics.span('renew'):
+                for item in queue:
+                    started_at = time.time()
+                    success = self.renew_lineage(item['name'], lineages[item['name']])
+                    if self.store:
+                        self.store.record_renewal(item['name'], started_at, time.time() - started_at, success)
+                    if not success:
+                        failed.append(item['name'])
+
+            # 只有证书确实更新了才重新加载 Nginx
+            renewed_lineages = self.inventory.lineages()
+            metrics.set_certificates(renewed_lineages)
+            if self.store:
+                self.store.sync_lineages(renewed_lineages)
+                self.store.flush()
+            changed = [item['name'] for item in queue
+                       if item['name'] in renewed_lineages
+                       and renewed_lineages[item['name']]['not_after'] != item['not_after']]
+            metrics.inc('renewals', len(changed))
+            metrics.inc('renewal_failures', len(failed))
+            if changed:
+                logger.info(f"SSL 证书续签成功: {', '.join(changed)}")
+                if self.reload_coordinator:
+                    self.reload_coordinator.mark_dirty("续签证书")
+                else:
+                    subprocess.run(['systemctl', 'reload', 'nginx'], check=True)
+                    logger.info("Nginx 重新加载配置")
+
+            if failed:
+                logger.error(f"续签失败: {', '.join(failed)}")
+            return not failed
+                
+        except Exception as e:
+            logger.error(f"续签证书失败: {e}")
+            return False
+
+    def renewal_queue(self, lineages: Optional[Dict[str, Dict]] = None,
+                      now: Optional[float] = None) -> List[Dict]:
+        """按过期时间排序的续签队列
+
+        剩余时间不超过 renew_window_days 加上该证书固定的抖动天数时进入队列，
+        抖动由证书名决定（0 ~ renew_jitter_days），同一批签发的证书会分散到不同日期续签。
+        """
+        if lineages is None:
+            lineages = self.inventory.lineages()
+        now = now or time.time()
+        window_days = self.certbot_config.get('renew_window_days', 30)
+        jitter_days = self.certbot_config.get('renew_jitter_days', 5)
+
+        queue = []
+        for name, info in lineages.items():
+            threshold = (window_days + self._renewal_jitter(name, jitter_days)) * 86400
+            if info['not_after'] - now <= threshold:
+                queue.append({'name': name, 'not_after': info['not_after'], 'domains': info['domains']})
+
+        queue.sort(key=lambda item: (item['not_after'], item['name']))
+        return queue
+
+    @staticmethod
+    def _renewal_jitter(name: str, jitter_days: float) -> float:
+        """证书名对应的固定抖动天数"""
+        fraction = int(hashlib.sha1(name.encode()).hexdigest()[:8], 16) / 0xffffffff
+        return fraction * jitter_days
+
+    def renew_lineage(self, name: str, lineage: Optional[Dict] = None) -> bool:
+        """只续签指定证书"""
+        if self.use_builtin_acme:
+            return self._renew_builtin(name, lineage or self.inventory.lineages()[name])
+
+        cmd = self._certbot_command() + [
+            'renew', '--cert-name', name, '--force-renewal', '--quiet',
+            # 抖动已由续签队列处理，不需要 certbot 再随机等待
+            '--no-random-sleep-on-renew'
+        ]
+        try:
+            logger.info(f"续签证书: {name}")
+            metrics.inc('certbot_invocations')
+            with metrics.span('certbot'):
+                subprocess.run(cmd, capture_output=True, text=True, check=True,
+                               timeout=self.certbot_config.get('job_timeout', 600))
+            return True
+        except subprocess.CalledProcessError as e:
+            metrics.inc('certbot_failures')
+            logger.error(f"续签证书 {name} 失败: {e.stderr}")
+            return False
+        except subprocess.TimeoutExpired:
+            metrics.inc('certbot_failures')
+            logger.error(f"续签证书 {name} 超时")
+            return False
+    
+    def prepare_challenges(self, config_files: List[str]) -> bool:
+        """共用验证目录模式：在申请前让这些配置文件中的 HTTP server 块 include 验证片段，
+        并立即重载 Nginx；配置测试失败时还原改动并返回 False"""
+        if not self.shared_challenge:
+            return True
+        if not self.installer.write_challenge_snippet():
+            return False
+        originals = self.installer.add_challenge_includes(config_files)
+        if self.reload_coordinator and not self.reload_coordinator.flush():
+            self.installer.restore(originals)
+            return False
+        return True
+
+    def _renew_builtin(self, name: str, lineage: Dict) -> bool:
+        """用内置 ACME 客户端重新签发同一组域名（live/ 下的链接指向新版本，Nginx 配置不变）"""
+        webroot_map = lineage.get('renewal', {}).get('webroot_map', {})
+        webroots = {domain: self.installer.challenge_webroot or webroot_map.get(domain)
+                    for domain in lineage['domains']}
+        try:
+            logger.info(f"续签证书: {name}（内置 ACME 客户端）")
+            with metrics.span('acme'):
+                self.acme_client.issue(lineage['domains'], name, webroots, self.certbot_config.get('job_timeout', 600))
+            return True
+        except Exception as e:
+            logger.error(f"续签证书 {name} 失败: {e}")
+            return False
+
+    def get_certificate_status(self) -> Dict:
+        """获取证书状态（直接读取本地证书文件，不调用 certbot）"""
+        try:
+            lineages = self.inventory.lineages()
+            metrics.set_certificates(lineages)
+            return lineages
+            
+        except Exception as e:
+            logger.error(f"获取证书状态失败: {e}")
+            return {}
+
+class PublicSuffixList:
+    """公共后缀列表（https://publicsuffix.org）
+
+    规则按后缀存入集合，查找时从最长的后缀开始逐级比较，每个域名只需几次集合查找。
+    支持通配规则（*.ck）和例外规则（!www.ck）；没有匹配的规则时按默认规则 * 取顶级域。
+    国际化域名规则同时保存 Unicode 和 Punycode（xn--）两种形式，查找时不必转换域名。
+    """
+
+    def __init__(self, rules: Iterable[str] = ()):
+        self.rules: Set[str] = set()
+        self.wildcards: Set[str] = set()
+        self.exceptions: Set[str] = set()
+        for rule in rules:
+            if rule.startswith('!'):
+                target, rule = self.exceptions, rule[1:]
+            elif rule.startswith('*.'):
+                target, rule = self.wildcards, rule[2:]
+            else:
+                target = self.rules
+            target.add(rule)
+            if not rule.isascii():
+                target.add(self._to_ascii(rule))
+
+    @classmethod
+    def parse(cls, lines: Iterable[str]) -> 'PublicSuffixList':
+        """解析 public_suffix_list.dat 格式的内容（每行第一个字段为规则，// 开头为注释）"""
+        rules = []
+        for line in lines:
+            line = line.strip()
+            if line and not line.startswith('//'):
+                rules.append(line.split()[0].lower())
+        return cls(rules)
+
+    @classmethod
+    def load(cls, path: Optional[str] = None) -> 'PublicSuffixList':
+        """读取指定的列表文件；未指定时依次尝试 PUBLIC_SUFFIX_LIST_PATHS"""
+        for candidate in [path] if path else PUBLIC_SUFFIX_LIST_PATHS:
+            try:
+                with open(candidate, 'r', encoding='utf-8') as f:
+                    psl = cls.parse(f)
+                logger.debug(f"读取公共后缀列表 {candidate}: {len(psl.rules)} 条规则")
+                return psl
+            except OSError as e:
+                logger.debug(f"无法读取公共后缀列表 {candidate}: {e}")
+        logger.warning("未找到公共后缀列表，注册域按最后两级计算")
+        return cls()
+
+    def public_suffix(self, domain: str) -> str:
+        """域名的公共后缀（如 www.example.co.uk 的 co.uk）"""
+        domain = domain.lower().rstrip('.')
+        # 按 "." 的位置逐级取后缀，不拆分和拼接标签
+        start = 0
+        while True:
+            suffix = domain[start:]
+            dot = domain.find('.', start)
+            parent = domain[dot + 1:] if dot != -1 else None
+            if suffix in self.exceptions:
+                return parent
+            if dot == -1 or suffix in self.rules or parent in self.wildcards:
+                return suffix
+            start = dot + 1
+
+    def registered_domain(self, domain: str) -> Optional[str]:
+        """注册域：公共后缀再加一级（如 www.example.co.uk 的 example.co.uk）；域名本身是公共后缀时返回 None"""
+        domain = domain.lower().rstrip('.')
+        suffix = self.public_suffix(domain)
+        if domain == suffix or not domain.endswith('.' + suffix):
+            return None
+        head = domain[:-len(suffix) - 1]
+        return f"{head[head.rfind('.') + 1:]}.{suffix}"
+
+    @staticmethod
+    def _to_ascii(rule: str) -> str:
+        """逐个标签转换为 Punycode（列表中的规则已经是规范化的小写形式）"""
+        return '.'.join(label if label.isascii() else 'xn--' + label.encode('punycode').decode('ascii')
+                        for label in rule.split('.'))
+
+
+@lru_cache(maxsize=None)
+def public_suffix_list(path: Optional[str] = None) -> PublicSuffixList:
+    """按路径缓存的公共后缀列表（首次使用时读取）"""
+    return PublicSuffixList.load(path)
+
+
+def registered_domain(domain: str, psl: Optional[PublicSuffixList] = None) -> str:
+    """域名的注册域（按公共后缀列表计算，用于 SAN 分组和速率限制）；域名本身是公共后缀时返回其自身"""
+    return (psl or public_suffix_list()).registered_domain(domain) or domain.lower().rstrip('.')
+
+
+# RFC 1035 主机名格式，顶级域至少两个字母
+_DOMAIN_RE = re.compile(r'^[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?'
+                        r'(\.[a-zA-Z0-9]([a-zA-Z0-9-]{0,61}[a-zA-Z0-9])?)*\.[a-zA-Z]{2,}$')
+
+
+class DomainPolicy:
+    """编译后的域名策略：排除列表、公共域名校验和注册域
+
+    exclude_domains 中的普通条目按子串匹配（与原来的判断一致），以 "." 或 "*." 开头的条目
+    只匹配该域名的子域名。全部条目在构造时合并成前缀树再编译成一个正则，每个位置只沿树的
+    一条分支比较，耗时与条目数量基本无关。判定结果按域名缓存。
+    """
+
+    ALLOWED = 'allowed'
+    EXCLUDED = 'excluded'
+    INVALID = 'invalid'
+
+    # 保留和示例域名，不可能申请到证书
+    INVALID_DOMAINS = frozenset([
+        'localhost', 'localdomain', 'example.com', 'test.com',
+        'invalid.com', 'example.org', 'test.org', 'example.net'
+    ])
+    # 本地网络域名
+    LOCAL_SUFFIXES = ('.local', '.home', '.lan')
+
+    def __init__(self, exclude_domains: Iterable[str] = (), public_suffix_list_path: Optional[str] = None):
+        substrings, suffixes = set(), set()
+        for entry in exclude_domains or []:
+            entry = str(entry).strip().lower()
+            if entry.startswith(('*.', '.')):
+                suffixes.add(entry.lstrip('*').lstrip('.'))
+            elif entry:
+                substrings.add(entry)
+
+        patterns = []
+        if substrings:
+            patterns.append(self._trie_pattern(substrings))
+        if suffixes:
+            patterns.append(rf"\.{self._trie_pattern(suffixes)}$")
+        self._exclude_re = re.compile('|'.join(patterns)) if patterns else None
+        self.public_suffix_list_path = public_suffix_list_path
+        self._verdicts: Dict[str, str] = {}
+
+    @staticmethod
+    def _trie_pattern(words: Iterable[str]) -> str:
+        r"""把一组字面量合并成前缀树形式的正则（如 test.、tenant1.、tenant2. 合并为 te(?:nant(?:1\.|2\.)|st\.)）"""
+        trie: Dict[str, Dict] = {}
+        for word in words:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = {}
+
+        def emit(node: Dict[str, Dict]) -> str:
+            branches, leaves = [], []
+            for char in sorted(key for key in node if key):
+                child = emit(node[char])
+                if child:
+                    branches.append(re.escape(char) + child)
+                else:
+                    leaves.append(re.escape(char))
+            if leaves:
+                branches.append(leaves[0] if len(leaves) == 1 else f"[{''.join(leaves)}]")
+            if not branches:
+                return ''
+            pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+            # 某个条目在这里结束，后面的部分可有可无
+            if '' in node:
+                pattern = f"(?:{pattern})?"
+            return pattern
+
+        return f"(?:{emit(trie)})"
+
+    @cached_property
+    def psl(self) -> PublicSuffixList:
+        return public_suffix_list(self.public_suffix_list_path)
+
+    def is_excluded(self, domain: str) -> bool:
+        """域名是否在排除列表中"""
+        return self._exclude_re is not None and self._exclude_re.search(domain.lower()) is not None
+
+    def is_valid_public_domain(self, domain: str) -> bool:
+        """是否是有效的公共域名"""
+        domain = domain.lower()
+        if domain in self.INVALID_DOMAINS or domain.endswith(self.LOCAL_SUFFIXES):
+            return False
+        return _DOMAIN_RE.match(domain) is not None
+
+    def classify(self, domain: str) -> str:
+        """判定域名：ALLOWED、EXCLUDED 或 INVALID"""
+        verdict = self._verdicts.get(domain)
+        if verdict is None:
+            lower = domain.lower()
+            if self._exclude_re is not None and self._exclude_re.search(lower):
+                verdict = self.EXCLUDED
+            elif lower in self.INVALID_DOMAINS or lower.endswith(self.LOCAL_SUFFIXES) or not _DOMAIN_RE.match(lower):
+                verdict = self.INVALID
+            else:
+                verdict = self.ALLOWED
+            self._verdicts[domain] = verdict
+        return verdict
+
+    def registered_domain(self, domain: str) -> str:
+        return registered_domain(domain, self.psl)
+
+
+class IssuancePlanner:
+    """证书申请规划器
+
+    把需要证书的 server 块按配置文件或注册域分组，打包成 SAN 证书，
+    每张证书只调用一次 certbot。同一个 server 块的域名总是在同一张证书里。
+
+    wildcard_min > 0 时，域名都在同一区域（区域本身或其直接子域名）的 server 块按区域归并，
+    不同的子域名达到 wildcard_min 个、或 wildcard_lineages 中已有该区域的通配符证书时，
+    这些 server 块共用一张 *.区域 证书（DNS-01 验证）。
+    """
+
+    # Let's Encrypt 单张证书最多 100 个域名
+    MAX_NAMES_LIMIT = 100
+
+    def __init__(self, max_names: int = MAX_NAMES_LIMIT, group_by: str = "config_file",
+                 policy: Optional[DomainPolicy] = None, wildcard_min: int = 0,
+                 wildcard_lineages: Optional[Dict[str, Dict]] = None):
+        self.max_names = max(1, min(max_names, self.MAX_NAMES_LIMIT))
+        if group_by not in ('config_file', 'registered_domain', 'none'):
+            raise ValueError(f"不支持的分组方式: {group_by}")
+        self.group_by = group_by
+        self.policy = policy or DomainPolicy()
+        self.wildcard_min = wildcard_min
+        # 区域 -> 现有通配符证书 {'name': 证书名, 'domains': [...]}
+        self.wildcard_lineages = wildcard_lineages or {}
+
+    @classmethod
+    def from_config(cls, config: Dict, policy: Optional[DomainPolicy] = None,
+                    wildcard_lineages: Optional[Dict[str, Dict]] = None) -> 'IssuancePlanner':
+        """按 certbot 和 wildcard 配置创建规划器"""
+        certbot_config = config.get('certbot') or {}
+        wildcard_config = config.get('wildcard') or {}
+        wildcard_min = 0
+        if wildcard_config.get('enabled', False):
+            wildcard_min = max(1, int(wildcard_config.get('min_subdomains', 5)))
+        return cls(max_names=certbot_config.get('max_names_per_cert', cls.MAX_NAMES_LIMIT),
+                   group_by=certbot_config.get('group_by', 'config_file'),
+                   policy=policy, wildcard_min=wildcard_min, wildcard_lineages=wildcard_lineages)
+
+    def group_key(self, server_block: Dict) -> str:
+        """server 块所属的分组"""
+        if self.group_by == 'config_file':
+            return server_block['config_file']
+        if self.group_by == 'registered_domain':
+            return self.policy.registered_domain(server_block['server_names'][0])
+        return server_block['server_names'][0]
+
+    def wildcard_zone(self, server_names: List[str]) -> Optional[str]:
+        """server 块的域名都是同一区域本身或其直接子域名时返回该区域（公共后缀不能作为区域）"""
+        candidates = [name.partition('.')[2] for name in server_names] + server_names
+        for zone in dict.fromkeys(candidates):
+            if (zone and all(name == zone or name.partition('.')[2] == zone for name in server_names)
+                    and self.policy.psl.registered_domain(zone)):
+                return zone
+        return None
+
+    def _consolidate(self, server_blocks: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """把可以共用通配符证书的 server 块归并，返回 (通配符证书任务, 其余 server 块)"""
+        zones: Dict[str, List[Dict]] = {}
+        rest = []
+        for server_block in server_blocks:
+            zone = self.wildcard_zone(server_block['server_names'])
+            if zone:
+                zones.setdefault(zone, []).append(server_block)
+            else:
+                rest.append(server_block)
+
+        jobs = []
+        for zone, blocks in zones.items():
+            names = {name for block in blocks for name in block['server_names']}
+            lineage = self.wildcard_lineages.get(zone)
+            if lineage is None and len(names - {zone}) < self.wildcard_min:
+                rest.extend(blocks)
+                continue
+
+            domains = [f"*.{zone}"] + ([zone] if zone in names else [])
+            existing = lineage is not None and set(domains) <= set(lineage['domains'])
+            jobs.append({
+                # 现有证书缺少区域本身时，用同一个证书名重新签发
+                'cert_name': lineage['name'] if lineage else f"wildcard.{zone}",
+                'group': f"*.{zone}",
+                'domains': lineage['domains'] if existing else domains,
+                'challenge': 'dns-01',
+                'existing': existing,
+                'server_blocks': [{
+                    'config_file': block['config_file'],
+                    'server_names': block['server_names'],
+                    'root_path': block.get('root_path')
+                } for block in blocks]
+            })
+        return jobs, rest
+
+    def plan(self, server_blocks: Iterable[Dict]) -> List[Dict]:
+        """生成申请计划，返回的每一项对应一张证书（一次 certbot 调用）"""
+        return list(self.iter_plan(server_blocks))
+
+    def iter_plan(self, server_blocks: Iterable[Dict]) -> Iterator[Dict]:
+        """逐张生成申请计划，每张证书在其域名确定后立即生成
+
+        按配置文件分组时同一文件的 server 块是相邻的（解析结果按文件依次到达），
+        文件变化时上一组的证书就已确定；其他分组方式下，证书在域名数达到上限
+        或全部 server 块到达后确定。可能合并为通配符证书的 server 块（及其所在的组）留到最后处理。
+        """
+        streaming = self.group_by == 'config_file'
+        groups: Dict[str, Dict] = {}
+        held: List[Dict] = []
+        held_keys: Set[str] = set()
+        previous = None
+        count = jobs = 0
+
+        for server_block in server_blocks:
+            count += 1
+            key = self.group_key(server_block)
+            if self.wildcard_min > 0 and self.wildcard_zone(server_block['server_names']):
+                held.append(server_block)
+                held_keys.add(key)
+                continue
+
+            if streaming and key != previous and previous not in held_keys and previous in groups:
+                jobs += 1
+                yield groups.pop(previous)
+            previous = key
+            full = self._pack(groups, key, server_block)
+            if full:
+                jobs += 1
+                yield full
+
+        if held:
+            wildcard_jobs, server_blocks_left = self._consolidate(held)
+            if wildcard_jobs:
+                logger.info(f"通配符证书: {sum(len(job['server_blocks']) for job in wildcard_jobs)} 个 server 块"
+                            f"合并为 {len(wildcard_jobs)} 张")
+            for job in wildcard_jobs:
+                jobs += 1
+                yield job
+            for server_block in server_blocks_left:
+                full = self._pack(groups, self.group_key(server_block), server_block)
+                if full:
+                    jobs += 1
+                    yield full
+
+        jobs += len(groups)
+        yield from groups.values()
+        logger.info(f"证书规划: {count} 个 server 块合并为 {jobs} 张证书")
+
+    def _pack(self, groups: Dict[str, Dict], key: str, server_block: Dict) -> Optional[Dict]:
+        """把 server 块加入所在组的当前证书；域名数超过上限时为该组新建一张证书，返回已满的那张"""
+        names = list(dict.fromkeys(server_block['server_names']))
+        if len(names) > self.max_names:
+            logger.warning(f"server 块域名超过 {self.max_names} 个，只申请前 {self.max_names} 个: {names[0]}")
+            names = names[:self.max_names]
+
+        full = None
+        current = groups.get(key)
+        if current is not None:
+            new_names = [name for name in names if name not in current['domains']]
+            if len(current['domains']) + len(new_names) > self.max_names:
+                full, current = current, None
+
+        if current is None:
+            current = {'cert_name': names[0], 'group': key, 'domains': [], 'server_blocks': []}
+            groups[key] = current
+            new_names = names
+
+        current['domains'].extend(new_names)
+        current['server_blocks'].append({
+            'config_file': server_block['config_file'],
+            'server_names': server_block['server_names'],
+            'root_path': server_block.get('root_path')
+        })
+        return full
+
+
+class TokenBucket:
+    """令牌桶：最多 capacity 个令牌，每 period 秒匀速补满"""
+
+    def __init__(self, capacity: int, period: float, tokens: Optional[float] = None,
+                 updated: Optional[float] = None):
+        self.capacity = capacity
+        self.period = period
+        self.tokens = capacity if tokens is None else tokens
+        self.updated = time.time() if updated is None else updated
+
+    def _refill(self, now: float):
+        elapsed = max(0.0, now - self.updated)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.capacity / self.period)
+        self.updated = now
+
+    def available(self, now: Optional[float] = None) -> bool:
+        self._refill(now or time.time())
+        return self.tokens >= 1
+
+    def take(self):
+        self.tokens -= 1
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def is_full(self) -> bool:
+        return self.tokens >= self.capacity
+
+    def to_dict(self) -> Dict:
+        return {'tokens': self.tokens, 'updated': self.updated}
+
+
+class IssuanceScheduler:
+    """证书申请调度器
+
+    在有界线程池中执行申请计划，按注册域和全局两级令牌桶遵守 ACME 速率限制。
+    预算用尽的任务记入队列，下次运行时优先处理。
+    """
+
+    # Let's Encrypt 默认限制：每个注册域每周 50 张证书，每个账户每 3 小时 300 个新订单
+    DEFAULT_RATE_LIMITS = {
+        'per_registered_domain': {'limit': 50, 'period': 7 * 86400},
+        'global': {'limit': 300, 'period': 3 * 3600},
+    }
+    # 申请失败后的退避：可重试错误从 1 小时起，永久性错误从 1 天起，每次失败翻倍，最长 7 天
+    DEFAULT_FAILURE_BACKOFF = {'base': 3600, 'permanent_base': 86400, 'cap': 7 * 86400}
+
+    def __init__(self, ssl_manager: 'SSLCertManager', certbot_config: Dict, state_path: str,
+                 store: Optional[StateStore] = None):
+        self.ssl_manager = ssl_manager
+        self.store = store
+        # certbot 持有全局锁，同时运行多个 certbot 会互相等待，因此默认只用一个工作线程；
+        # 内置 ACME 客户端默认同时进行多个订单
+        self.workers = ssl_manager.workers
+        self.job_timeout = certbot_config.get('job_timeout', 600)
+        self.state_path = state_path
+
+        # 逐项与默认值合并：只覆盖 limit 或 period 时另一项仍使用默认值
+        rate_limits = certbot_config.get('rate_limits') or {}
+        self.domain_limit = self._with_defaults(self.DEFAULT_RATE_LIMITS['per_registered_domain'],
+                                                rate_limits.get('per_registered_domain'))
+        self.global_limit = self._with_defaults(self.DEFAULT_RATE_LIMITS['global'], rate_limits.get('global'))
+        self.failure_backoff = self._with_defaults(self.DEFAULT_FAILURE_BACKOFF,
+                                                   certbot_config.get('failure_backoff'))
+
+        self.global_bucket = TokenBucket(self.global_limit['limit'], self.global_limit['period'])
+        self.domain_buckets: Dict[str, TokenBucket] = {}
+        self.queue: List[str] = []
+        self.load_state()
+
+    @staticmethod
+    def _with_defaults(defaults: Dict, overrides: Optional[Dict]) -> Dict:
+        """用配置覆盖默认值（未填写或为空的项保留默认值）"""
+        return {**defaults, **{key: value for key, value in (overrides or {}).items() if value is not None}}
+
+    def load_state(self):
+        """加载令牌桶和上次遗留的队列"""
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(f"加载申请调度状态失败: {e}")
+            return
+
+        buckets = state.get('buckets', {})
+        if 'global' in buckets:
+            self.global_bucket = TokenBucket(self.global_limit['limit'], self.global_limit['period'],
+                                             **buckets['global'])
+        for domain, bucket in buckets.get('domains', {}).items():
+            self.domain_buckets[domain] = TokenBucket(self.domain_limit['limit'], self.domain_limit['period'],
+                                                      **bucket)
+        self.queue = state.get('queue', [])
+
+    def save_state(self):
+        """原子写入调度状态（已补满的注册域令牌桶不再保存）"""
+        state = {
+            'buckets': {
+                'global': self.global_bucket.to_dict(),
+                'domains': {domain: bucket.to_dict() for domain, bucket in self.domain_buckets.items()
+                            if not bucket.is_full()}
+            },
+            'queue': self.queue
+        }
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = f"{self.state_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.state_path)
+        except Exception as e:
+            logger.warning(f"保存申请调度状态失败: {e}")
+
+    def _domain_bucket(self, domain: str) -> TokenBucket:
+        if domain not in self.domain_buckets:
+            self.domain_buckets[domain] = TokenBucket(self.domain_limit['limit'], self.domain_limit['period'])
+        return self.domain_buckets[domain]
+
+    def _order(self, plan: Iterable[Dict]) -> List[Dict]:
+        """上次因预算不足而推迟的任务排在最前面，已不在计划中的任务丢弃"""
+        priority = {cert_name: i for i, cert_name in enumerate(self.queue)}
+        return sorted(plan, key=lambda job: priority.get(job['cert_name'], len(priority)))
+
+    def _admit(self, job: Dict) -> Optional[List[TokenBucket]]:
+        """检查并扣除令牌（证书中每个注册域各扣一个），预算不足时返回 None"""
+        now = time.time()
+        buckets = [self._domain_bucket(domain)
+                   for domain in sorted({self.ssl_manager.policy.registered_domain(name) for name in job['domains']})]
+        if not self.global_bucket.available(now) or not all(bucket.available(now) for bucket in buckets):
+            return None
+
+        self.global_bucket.take()
+        for bucket in buckets:
+            bucket.take()
+        return buckets
+
+    def run(self, plan: Iterable[Dict]) -> int:
+        """执行申请计划，返回成功应用 SSL 的 server 块数
+
+        计划可以是逐张生成的迭代器：任务到达即提交，已完成的任务按提交顺序在主线程中收取；
+        未完成的任务超过工作线程数的两倍时等待最早的任务，上游的解析和判定也随之暂停。
+        """
+        # 有上次推迟的任务时需要完整的计划来排序
+        jobs = self._order(plan) if self.queue else plan
+        deferred = []
+        ssl_applied = 0
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            running: deque = deque()
+            for job in jobs:
+                # 使用现有证书的任务不向 CA 申请，不占用速率预算
+                buckets = [] if job.get('existing') else self._admit(job)
+                if buckets is None:
+                    deferred.append(job)
+                    continue
+                running.append((job, buckets, executor.submit(self._issue, job)))
+                while running and (running[0][2].done() or len(running) > self.workers * 2):
+                    ssl_applied += self._collect(*running.popleft())
+            while running:
+                ssl_applied += self._collect(*running.popleft())
+
+        if deferred:
+            logger.warning(f"ACME 速率预算不足，{len(deferred)} 张证书推迟到下次运行")
+        if self.store:
+            self.store.flush()
+        self.queue = [job['cert_name'] for job in deferred]
+        self.save_state()
+        return ssl_applied
+
+    def _collect(self, job: Dict, buckets: List[TokenBucket], future) -> int:
+        """在主线程中记录任务结果，返回成功应用 SSL 的 server 块数"""
+        success, error, started_at, duration = future.result()
+        if self.store:
+            self.store.record_attempt(job['cert_name'], job['domains'], started_at, duration, success, error)
+            self._record_outcome(job, success, error)
+        if success:
+            return len(job['server_blocks'])
+        metrics.inc('issuance_failures')
+        # 申请失败不计入注册域的证书数量（新订单仍计入全局限制）
+        for bucket in buckets:
+            bucket.refund()
+        return 0
+
+    def _record_outcome(self, job: Dict, success: bool, error: str):
+        """更新失败缓存
+
+        certbot 指明了验证失败的域名时，只有包含这些域名的 server 块进入退避，
+        同组的其他 server 块下次运行时（不再与失败域名合并）重新申请。
+        """
+        domain_sets = [block['server_names'] for block in job['server_blocks']]
+        if success:
+            self.store.clear_failures(domain_sets)
+            return
+
+        permanent, failed_domains = classify_certbot_error(error)
+        if failed_domains:
+            domain_sets = [names for names in domain_sets if failed_domains & set(names)] or domain_sets
+        base = self.failure_backoff['permanent_base' if permanent else 'base']
+        retry_at = self.store.record_failures(domain_sets, permanent, error[-2000:], base, self.failure_backoff['cap'])
+        kind = "永久性错误" if permanent else "可重试错误"
+        logger.warning(f"证书 {job['cert_name']} 申请失败（{kind}），{len(domain_sets)} 个 server 块退避至 "
+                       f"{time.strftime('%Y-%m-%d %H:%M', time.localtime(retry_at))}")
+
+    def _issue(self, job: Dict) -> Tuple[bool, str, float, float]:
+        """在工作线程中申请证书，返回 (是否成功, 失败原因, 开始时间, 耗时)"""
+        started_at = time.time()
+        success, error = self.ssl_manager.try_issue_group(job, self.job_timeout)
+        return success, error, started_at, time.time() - started_at
+
+
+class PreflightError(Exception):
+    """预检暂时无法完成（DNS 超时、SERVFAIL、Nginx 无法连接等），本次运行推迟申请"""
+
+
+class SystemResolver:
+    """使用系统解析器（getaddrinfo）查询 A/AAAA 记录"""
+
+    def __init__(self, timeout: float = 5):
+        self.timeout = timeout
+
+    async def resolve(self, domain: str) -> Set[str]:
+        """返回域名的所有地址；域名不存在或没有地址记录时返回空集合"""
+        import asyncio
+        import socket
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await asyncio.wait_for(
+                loop.getaddrinfo(domain, None, type=socket.SOCK_STREAM), self.timeout)
+        except socket.gaierror as e:
+            if e.errno in (socket.EAI_NONAME, getattr(socket, 'EAI_NODATA', socket.EAI_NONAME)):
+                return set()
+            raise PreflightError(f"DNS 查询失败: {e}")
+        except asyncio.TimeoutError:
+            raise PreflightError("DNS 查询超时")
+        return {info[4][0] for info in infos}
+
+
+class _DnsProtocol:
+    """asyncio 数据报协议（按接口实现而不继承，导入本模块时不必加载 asyncio）"""
+
+    def __init__(self, query_id: int, future: 'asyncio.Future'):
+        self.query_id = query_id
+        self.future = future
+
+    def connection_made(self, transport):
+        pass
+
+    def connection_lost(self, exc: Optional[Exception]):
+        pass
+
+    def datagram_received(self, data: bytes, addr):
+        if len(data) >= 2 and struct.unpack('!H', data[:2])[0] == self.query_id and not self.future.done():
+            self.future.set_result(data)
+
+    def error_received(self, exc: Exception):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+class UdpResolver:
+    """直接向指定 DNS 服务器发送 UDP 查询（可指向权威服务器或测试用的本地 DNS）"""
+
+    QTYPES = (1, 28)  # A, AAAA
+
+    def __init__(self, server: str, port: int = 53, timeout: float = 2):
+        self.server = server
+        self.port = port
+        self.timeout = timeout
+
+    async def resolve(self, domain: str) -> Set[str]:
+        """并发查询 A 和 AAAA 记录"""
+        import asyncio
+        results = await asyncio.gather(*(self._query(domain, qtype) for qtype in self.QTYPES))
+        return set().union(*results)
+
+    async def _query(self, domain: str, qtype: int) -> Set[str]:
+        import asyncio
+        import secrets
+        loop = asyncio.get_running_loop()
+        query_id = secrets.randbelow(0x10000)
+        question = b''.join(bytes([len(label)]) + label.encode('idna')
+                            for label in domain.rstrip('.').split('.')) + b'\0'
+        packet = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + question + struct.pack('!HH', qtype, 1)
+
+        future = loop.create_future()
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: _DnsProtocol(query_id, future), remote_addr=(self.server, self.port))
+        try:
+            transport.sendto(packet)
+            response = await asyncio.wait_for(future, self.timeout)
+        except (asyncio.TimeoutError, OSError) as e:
+            raise PreflightError(f"DNS 查询失败（{self.server}:{self.port}）: {str(e) or '超时'}")
+        finally:
+            transport.close()
+        return self._parse_response(response, qtype)
+
+    def _parse_response(self, data: bytes, qtype: int) -> Set[str]:
+        import socket
+        _, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', data[:12])
+        rcode = flags & 0xF
+        if rcode == 3:  # NXDOMAIN
+            return set()
+        if rcode:
+            raise PreflightError(f"DNS 服务器返回错误码 {rcode}")
+
+        offset = 12
+        for _ in range(qdcount):
+            offset = self._skip_name(data, offset) + 4
+        addresses = set()
+        for _ in range(ancount):
+            offset = self._skip_name(data, offset)
+            rtype, _, _, rdlength = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            if rtype == qtype:
+                addresses.add(socket.inet_ntop(socket.AF_INET if qtype == 1 else socket.AF_INET6,
+                                               data[offset:offset + rdlength]))
+            offset += rdlength
+        return addresses
+
+    @staticmethod
+    def _skip_name(data: bytes, offset: int) -> int:
+        while True:
+            length = data[offset]
+            if length >= 0xC0:  # 压缩指针
+                return offset + 2
+            if length == 0:
+                return offset + 1
+            offset += length + 1
+
+
+class PreflightChecker:
+    """申请前预检
+
+    并发解析所有候选域名的 A/AAAA 记录并与本机地址比较，可选地通过 127.0.0.1 上的
+    Nginx 取回写入验证目录（共用验证目录或 server 块的 root 目录）的 HTTP-01 探测文件。
+    确定会失败的 server 块记入失败缓存（按永久性错误退避），暂时无法判断的只推迟到下次运行。
+    只有在 preflight.addresses 中明确配置了本机地址时，解析到其他地址才算确定失败；
+    自动探测的地址可能不完整（NAT、负载均衡），此时只推迟。
+    """
+
+    CHALLENGE_PATH = '.well-known/acme-challenge'
+
+    def __init__(self, preflight_config: Dict, store: Optional[StateStore] = None,
+                 failure_backoff: Optional[Dict] = None, resolver=None,
+                 challenge_webroot: Optional[str] = None):
+        self.store = store
+        self.failure_backoff = failure_backoff or IssuanceScheduler.DEFAULT_FAILURE_BACKOFF
+        self.concurrency = max(1, int(preflight_config.get('concurrency', 64)))
+        self.timeout = preflight_config.get('timeout', 5)
+        self.http_probe = preflight_config.get('http_probe', False)
+        self.http_port = preflight_config.get('http_port', 80)
+        self.resolver = resolver or self._make_resolver(preflight_config.get('resolver', 'system'))
+        self.challenge_webroot = challenge_webroot
+        self.explicit_addresses = bool(preflight_config.get('addresses'))
+        self.addresses = set(preflight_config.get('addresses') or []) or self._host_addresses()
+
+    def _make_resolver(self, spec: str):
+        """resolver 为 system 时使用系统解析器，否则为 DNS 服务器地址（host 或 host:port）"""
+        if not spec or spec == 'system':
+            return SystemResolver(self.timeout)
+        host, _, port = spec.rpartition(':') if spec.count(':') == 1 else (spec, '', '')
+        return UdpResolver(host or spec, int(port or 53), self.timeout)
+
+    @staticmethod
+    def _host_addresses() -> Set[str]:
+        """本机的公网地址（只有私有地址时返回空集合，此时只检查域名能否解析）"""
+        import socket
+        import ipaddress
+        addresses = set()
+        # 对 UDP 套接字 connect 不会发送数据，只用来取得出口地址
+        for family, target in ((socket.AF_INET, '8.8.8.8'), (socket.AF_INET6, '2001:4860:4860::8888')):
+            try:
+                with socket.socket(family, socket.SOCK_DGRAM) as sock:
+                    sock.connect((target, 53))
+                    addresses.add(sock.getsockname()[0])
+            except OSError:
+                pass
+        try:
+            addresses.update(info[4][0] for info in socket.getaddrinfo(socket.gethostname(), None))
+        except OSError:
+            pass
+        return {address for address in addresses if ipaddress.ip_address(address.split('%')[0]).is_global}
+
+    def run(self, server_blocks: List[Dict]) -> List[Dict]:
+        """返回通过预检的 server 块"""
+        return list(self.iter_run(server_blocks))
+
+    def iter_run(self, server_blocks: Iterable[Dict]) -> Iterator[Dict]:
+        """逐批预检，生成通过预检的 server 块（批内并发查询，内存中只保留一批）"""
+        import asyncio
+        started = time.time()
+        passed = failed = deferred = 0
+        for chunk in iter_chunks(server_blocks, PREFLIGHT_CHUNK_BLOCKS):
+            if not (passed or failed or deferred) and not self.addresses:
+                logger.info("无法确定本机公网地址（可在 preflight.addresses 中配置），预检只检查域名能否解析")
+            results = asyncio.run(self._check_blocks(chunk))
+
+            failures = []
+            for server_block, (ok, definite, reason) in zip(chunk, results):
+                if ok:
+                    passed += 1
+                elif definite:
+                    logger.warning(f"预检失败，跳过 {server_block['server_names']}: {reason}")
+                    failures.append((server_block['server_names'], reason))
+                else:
+                    logger.info(f"预检暂时无法完成，推迟 {server_block['server_names']}: {reason}")
+                    deferred += 1
+
+            if self.store and failures:
+                for domains, reason in failures:
+                    self.store.record_failures([domains], True, f"preflight: {reason}",
+                                               self.failure_backoff['permanent_base'], self.failure_backoff['cap'])
+            failed += len(failures)
+            yield from (server_block for server_block, result in zip(chunk, results) if result[0])
+
+        if passed or failed or deferred:
+            logger.info(f"预检完成（{time.time() - started:.2f} 秒）: {passed} 个通过，"
+                        f"{failed} 个失败，{deferred} 个推迟")
+
+    async def _check_blocks(self, server_blocks: List[Dict]) -> List[Tuple[bool, bool, str]]:
+        import asyncio
+        semaphore = asyncio.Semaphore(self.concurrency)
+        domains = sorted({domain for block in server_blocks for domain in block['server_names']})
+        lookups = await asyncio.gather(*(self._guarded(semaphore, self._check_domain(domain))
+                                         for domain in domains))
+        dns_results = dict(zip(domains, lookups))
+        return await asyncio.gather(*(self._check_block(semaphore, block, dns_results)
+                                      for block in server_blocks))
+
+    @staticmethod
+    async def _guarded(semaphore: 'asyncio.Semaphore', coro):
+        async with semaphore:
+            return await coro
+
+    async def _check_domain(self, domain: str) -> Tuple[bool, bool, str]:
+        """返回 (是否通过, 失败是否确定, 原因)"""
+        try:
+            resolved = await self.resolver.resolve(domain)
+        except PreflightError as e:
+            return False, False, f"{domain}: {e}"
+        if not resolved:
+            return False, True, f"{domain} 没有 A/AAAA 记录"
+        if self.addresses and not resolved & self.addresses:
+            return False, self.explicit_addresses, f"{domain} 解析到 {', '.join(sorted(resolved))}，不是本机地址"
+        return True, True, ''
+
+    async def _check_block(self, semaphore: 'asyncio.Semaphore', server_block: Dict,
+                           dns_results: Dict[str, Tuple[bool, bool, str]]) -> Tuple[bool, bool, str]:
+        failures = [dns_results[domain] for domain in server_block['server_names'] if not dns_results[domain][0]]
+        if failures:
+            # 任一域名确定失败时整个块都会失败；否则按暂时性失败推迟
+            definite = [failure for failure in failures if failure[1]]
+            return (definite or failures)[0]
+        # 探测申请时实际使用的验证目录；没有 root 指令又未启用共用验证目录时不探测
+        webroot = self.challenge_webroot or server_block.get('root_path')
+        if self.http_probe and webroot:
+            return await self._probe_block(semaphore, server_block, webroot)
+        return True, True, ''
+
+    async def _probe_block(self, semaphore: 'asyncio.Semaphore', server_block: Dict,
+                           webroot: str) -> Tuple[bool, bool, str]:
+        """在验证目录写入探测文件，通过本机 Nginx 按各个 Host 取回并比对"""
+        import secrets
+        token = secrets.token_urlsafe(24)
+        challenge_dir = os.path.join(webroot, self.CHALLENGE_PATH)
+        token_path = os.path.join(challenge_dir, f"ssl-bot-preflight-{token}")
+        try:
+            os.makedirs(challenge_dir, exist_ok=True)
+            with open(token_path, 'w') as f:
+                f.write(token)
+        except OSError as e:
+            logger.debug(f"无法写入探测文件 {token_path}，跳过 HTTP 探测: {e}")
+            return True, True, ''
+
+        try:
+            for domain in server_block['server_names']:
+                async with semaphore:
+                    result = await self._fetch(domain, f"/{self.CHALLENGE_PATH}/ssl-bot-preflight-{token}")
+                if result is None:
+                    return False, False, f"无法连接 127.0.0.1:{self.http_port}"
+                status, body = result
+                if status != 200 or body.strip() != token:
+                    return False, True, f"通过 Nginx 取回 {domain} 的探测文件失败（HTTP {status}）"
+            return True, True, ''
+        finally:
+            try:
+                os.unlink(token_path)
+            except OSError:
+                pass
+
+    async def _fetch(self, host: str, path: str) -> Optional[Tuple[int, str]]:
+        """向 127.0.0.1 发送带 Host 头的 HTTP/1.0 请求，返回 (状态码, 正文)"""
+        import asyncio
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection('127.0.0.1', self.http_port), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        try:
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {host}\r\nUser-Agent: ssl-bot-preflight\r\n\r\n".encode())
+            await writer.drain()
+            response = await asyncio.wait_for(reader.read(), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        finally:
+            writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        try:
+            status = int(head.split(b' ', 2)[1])
+        except (IndexError, ValueError):
+            status = 0
+        return status, body.decode(errors='replace')
+
+
+class InotifyWatcher:
+    """基于 inotify 的目录监视器（通过 ctypes 调用 libc，不需要额外依赖）"""
+
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+                  IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+    _EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self._fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+        self._directories: Dict[int, str] = {}
+
+    def watch(self, directory: str):
+        """监视目录（重复添加同一目录不会产生新的监视）"""
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            logger.warning(f"无法监视目录 {directory}")
+            return
+        self._directories[wd] = directory
+
+    def read(self, timeout: Optional[float]) -> Tuple[Set[str], bool]:
+        """等待变更，返回 (变更的路径, 是否需要全量重新校验)"""
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set(), False
+
         try:
-            logger.info("开始续签 SSL 证书...")
-            
-            # 测试续签（dry run）
-            test_cmd = ['certbot', 'renew', '--dry-run']
-            test_result = subprocess.run(test_cmd, capture_output=True, text=True)
-            
-            if test_result.returncode == 0:
-                # 实际续签
-                renew_cmd = ['certbot', 'renew', '--quiet']
-                renew_result = subprocess.run(renew_cmd, capture_output=True, text=True, check=True)
-                
-                if renew_result.returncode == 0:
-                    logger.info("SSL 证书续签成功")
-                    
-                    # 重新加载 Nginx
-                    subprocess.run(['systemctl', 'reload', 'nginx'], check=True)
-                    logger.info("Nginx 重新加载配置")
-                    
-                    return True
-            else:
-                logger.error("续签测试失败，跳过实际续签")
-                return False
-                
-        except Exception as e:
-            logger.error(f"续签证书失败: {e}")
-            return False
-    
-    def get_certificate_status(self) -> Dict:
-        """获取证书状态"""
-        try:
-            cmd = ['certbot', 'certificates']
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            
-            certificates = {}
-            lines = result.stdout.split('\n')
-            
-            current_domain = None
-            for line in lines:
-                if 'Certificate Name:' in line:
-                    current_domain = line.split(':')[1].strip()
-                    certificates[current_domain] = {}
-                elif 'Domains:' in line and current_domain:
-                    domains = line.split(':')[1].strip()
-                    certificates[current_domain]['domains'] = domains
-                elif 'Expiry Date:' in line and current_domain:
-                    expiry = line.split(':')[1].strip()
-                    certificates[current_domain]['expiry'] = expiry
-                elif 'Certificate Path:' in line and current_domain:
-                    path = line.split(':')[1].strip()
-                    certificates[current_domain]['path'] = path
-            
-            return certificates
-            
-        except Exception as e:
-            logger.error(f"获取证书状态失败: {e}")
-            return {}
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set(), False
+
+        paths = set()
+        rescan_all = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self._EVENT_HEADER.unpack_from(data, offset)
+            offset += self._EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & self.IN_Q_OVERFLOW:
+                rescan_all = True
+                continue
+            directory = self._directories.get(wd)
+            if directory is None:
+                continue
+            paths.add(os.path.join(directory, os.fsdecode(name)) if name else directory)
+            if mask & (self.IN_DELETE_SELF | self.IN_MOVE_SELF):
+                # 目录本身被删除或移动，监视已失效
+                del self._directories[wd]
+                rescan_all = True
+
+        return paths, rescan_all
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher:
+    """不支持 inotify 时的替代方案：按固定间隔触发全量校验（扫描索引保证只解析变化的文件）"""
+
+    def __init__(self, interval: float = 5):
+        self.interval = interval
+
+    def watch(self, directory: str):
+        pass
+
+    def read(self, timeout: Optional[float]) -> Tuple[Set[str], bool]:
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        return set(), True
+
+    def close(self):
+        pass
+
+
+# --format 输出的字段（所有记录类型共用）
+RECORD_FIELDS = ['type', 'domain', 'lineage', 'expiry', 'days_left', 'enabled', 'ssl', 'needs_ssl',
+                 'retry_at', 'source']
+
+
+def make_record(record_type: str, **fields) -> Dict:
+    """生成一条包含全部字段的记录，过期时间为 epoch 秒时同时计算剩余天数"""
+    record = {field: fields.get(field) for field in RECORD_FIELDS}
+    record['type'] = record_type
+    if record['expiry'] is not None and record['days_left'] is None:
+        record['days_left'] = int((record['expiry'] - time.time()) // 86400)
+    return record
+
+
+class RecordWriter:
+    """逐条输出记录（ndjson / json / csv），不在内存中缓存结果"""
+
+    FORMATS = ('ndjson', 'json', 'csv')
+
+    def __init__(self, out, fmt: str, fields: List[str] = RECORD_FIELDS):
+        self.out = out
+        self.fmt = fmt
+        self.count = 0
+        self._csv = None
+        if fmt == 'csv':
+            self._csv = csv.DictWriter(out, fieldnames=fields, extrasaction='ignore', lineterminator='\n')
+            self._csv.writeheader()
+        elif fmt == 'json':
+            out.write('[')
+
+    def write(self, record: Dict):
+        if self._csv:
+            self._csv.writerow({key: int(value) if isinstance(value, bool) else value
+                                for key, value in record.items()})
+        elif self.fmt == 'json':
+            self.out.write(f'{"," if self.count else ""}\n  {json.dumps(record, ensure_ascii=False)}')
+        else:
+            self.out.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.count += 1
+        # 逐行格式每条记录立即输出，下游可以边读边处理
+        if self.fmt != 'json':
+            self.out.flush()
+
+    def close(self):
+        if self.fmt == 'json':
+            self.out.write('\n]\n' if self.count else ']\n')
+        self.out.flush()
+
+    def write_all(self, records: Iterator[Dict]) -> int:
+        try:
+            for record in records:
+                self.write(record)
+        finally:
+            self.close()
+        return self.count
+
 
 class SSLBot:
     """SSL Bot 主类"""
     
-    def __init__(self):
-        self.config = self.load_config()
-        self.nginx_parser = NginxConfigParser()
-        self.ssl_manager = SSLCertManager(self.config)
+    def __init__(self, rebuild_index: bool = False, jobs: Optional[int] = None, config_path: str = DEFAULT_CONFIG,
+                 command: str = 'scan'):
+        self.config_path = config_path
+        self.rebuild_index = rebuild_index
+        self.jobs = jobs or os.cpu_count() or 1
+        # 运行指标按命令分别写入文件
+        self.command = command
+
+    # 各组件在首次使用时才创建，只用到其中一部分的命令不必加载全部
+    @cached_property
+    def config(self) -> Dict:
+        return self.load_config()
+
+    @cached_property
+    def nginx_parser(self) -> NginxConfigParser:
+        nginx_config = self.config.get('nginx') or {}
+        scan_index = ScanIndex(nginx_config.get('scan_index', DEFAULT_SCAN_INDEX), rebuild=self.rebuild_index)
+        return NginxConfigParser(config_path=nginx_config.get('config_path', DEFAULT_NGINX_ROOT), index=scan_index,
+                                 discovery=nginx_config.get('discovery', 'include'), jobs=self.jobs)
+
+    @cached_property
+    def reload_coordinator(self) -> ReloadCoordinator:
+        return ReloadCoordinator((self.config.get('nginx') or {}).get('reload_checkpoint', 0))
+
+    @cached_property
+    def store(self) -> StateStore:
+        return StateStore(os.path.join(self.config.get('state_dir', DEFAULT_STATE_DIR), 'state.db'))
+
+    @cached_property
+    def ssl_manager(self) -> SSLCertManager:
+        return SSLCertManager(self.config, self.reload_coordinator, self.store, self.config_path)
     
     def load_config(self) -> Dict:
         """加载配置文件"""
-        config_path = "/opt/ssl-bot/config.yaml"
+        config_path = self.config_path
         default_config = {
             'email': 'admin@example.com',
             'exclude_domains': ['localhost', 'test', 'staging'],
@@ -488,14 +4007,20 @@ class SSLBot:
         
         try:
             if os.path.exists(config_path):
-                with open(config_path, 'r') as f:
-                    user_config = yaml.safe_load(f) or {}
+                user_config = self._read_config_file(config_path)
                 # 合并配置
                 default_config.update(user_config)
         except Exception as e:
             logger.error(f"加载配置文件失败: {e}")
             
         return default_config
+
+    @staticmethod
+    def _read_config_file(config_path: str) -> Dict:
+        """读取 YAML 配置（有 libyaml 时使用 C 实现的解析器）"""
+        import yaml
+        with open(config_path, 'r') as f:
+            return yaml.load(f, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)) or {}
     
     def scan_and_apply(self):
         """扫描 Nginx 配置并应用 SSL"""
@@ -504,28 +4029,262 @@ class SSLBot:
         config_files = self.nginx_parser.find_nginx_configs()
         logger.info(f"找到 {len(config_files)} 个配置文件")
         
-        ssl_applied = 0
-        
-        for config_file in config_files:
-            server_blocks = self.nginx_parser.parse_server_blocks(config_file)
-            
-            for server_block in server_blocks:
-                if self.ssl_manager.needs_ssl(server_block):
-                    logger.info(f"发现需要 SSL 的配置: {server_block['server_names']}")
-                    
-                    if self.ssl_manager.apply_ssl(server_block):
-                        ssl_applied += 1
+        ssl_applied = self.apply_config_files(config_files)
         
         logger.info(f"扫描完成，共为 {ssl_applied} 个服务应用了 SSL")
         return ssl_applied
+
+    def apply_config_files(self, config_files: List[str], complete: bool = True) -> int:
+        """为指定配置文件中需要 SSL 的 server 块申请证书"""
+        certbot_config = self.config.get('certbot') or {}
+        state_path = os.path.join(self.config.get('state_dir', DEFAULT_STATE_DIR), 'issuance-state.json')
+        scheduler = IssuanceScheduler(self.ssl_manager, certbot_config, state_path, self.store)
+        preflight_config = self.config.get('preflight') or {}
+        preflight = None
+        if preflight_config.get('enabled', False):
+            preflight = PreflightChecker(preflight_config, self.store, scheduler.failure_backoff,
+                                         challenge_webroot=self.ssl_manager.installer.challenge_webroot)
+        plan = self.iter_plan(config_files, complete, preflight)
+        # 共用验证目录模式下，验证路径必须在调用 ACME 之前生效，需要先得到完整的计划
+        if self.ssl_manager.shared_challenge:
+            plan = list(plan)
+            if plan and not self.ssl_manager.prepare_challenges(
+                    sorted({block['config_file'] for job in plan for block in job['server_blocks']})):
+                logger.error("无法启用共用的 ACME 验证路径，本次不申请证书")
+                return 0
+        # 其他情况下计划逐张生成，解析、判定、规划与申请交替进行
+        with metrics.span('issue'):
+            ssl_applied = scheduler.run(plan)
+        if ssl_applied:
+            self.store.sync_lineages(self.ssl_manager.get_certificate_status())
+        return ssl_applied
+
+    def plan(self, config_files: Optional[List[str]] = None, complete: bool = True,
+             preflight: Optional[PreflightChecker] = None) -> List[Dict]:
+        """生成证书申请计划（不调用 certbot）；指定 preflight 时先剔除预检不通过的 server 块"""
+        return list(self.iter_plan(config_files, complete, preflight))
+
+    def iter_plan(self, config_files: Optional[List[str]] = None, complete: bool = True,
+                  preflight: Optional[PreflightChecker] = None) -> Iterator[Dict]:
+        """逐张生成申请计划中的证书：解析、判定、预检和规划串成一条流水线，按需向前推进"""
+        pending = self.iter_pending_server_blocks(config_files, complete)
+        if preflight:
+            pending = metrics.timed('preflight', preflight.iter_run(pending))
+
+        wildcard_lineages = self._wildcard_lineages() if self.ssl_manager.wildcard_enabled else None
+        planner = IssuancePlanner.from_config(self.config, self.ssl_manager.policy, wildcard_lineages)
+        return metrics.timed('plan', planner.iter_plan(pending))
+
+    def pending_server_blocks(self, config_files: Optional[List[str]] = None,
+                              complete: bool = True) -> List[ServerBlock]:
+        """需要 SSL 的 server 块"""
+        return list(self.iter_pending_server_blocks(config_files, complete))
+
+    def iter_pending_server_blocks(self, config_files: Optional[List[str]] = None,
+                                   complete: bool = True) -> Iterator[ServerBlock]:
+        """逐个生成需要 SSL 的 server 块
+
+        借助状态库只对内容有变化的配置文件重新判定，未变化的文件只复查上次需要 SSL 的块。
+        配置文件按批解析、同步到状态库并判定，全部 server 块不会同时留在内存中。
+        """
+        if config_files is None:
+            config_files = self.nginx_parser.find_nginx_configs()
+        return metrics.timed('judge', self._judge_config_files(config_files, complete))
+
+    def _judge_config_files(self, config_files: List[str], complete: bool) -> Iterator[ServerBlock]:
+        policy = self._policy_fingerprint()
+        policy_changed = self.store.policy_changed(policy)
+        previously_pending = self.store.pending_blocks()
+        index = self.nginx_parser.index
+
+        # include 发现过程中已经解析过的文件在这里直接命中扫描索引
+        parsed = metrics.timed('parse', self.nginx_parser.iter_config_files(config_files))
+        changed_files = judged = backoff = covered = 0
+        for chunk in iter_chunks(parsed, PIPELINE_CHUNK_FILES):
+            changed = self.store.sync_config_files(
+                [(config_file, server_blocks, index.digest(config_file)) for config_file, server_blocks in chunk],
+                policy_changed)
+            changed_files += len(changed)
+
+            pending = []
+            decisions = []
+            for config_file, server_blocks in chunk:
+                file_changed = config_file in changed
+                for i, server_block in enumerate(server_blocks):
+                    if not file_changed and (config_file, i) not in previously_pending:
+                        continue
+                    # 退避期内的块仍记为需要 SSL，退避结束后会被重新选中
+                    needed = self.ssl_manager.needs_ssl(server_block, check_backoff=False)
+                    decisions.append((needed, config_file, i))
+                    if not needed:
+                        continue
+                    if self.ssl_manager.in_backoff(server_block['server_names']):
+                        backoff += 1
+                    elif self._covered_by_lineage(server_block['server_names']):
+                        covered += 1
+                    else:
+                        pending.append(server_block)
+
+            self.store.update_needs_ssl(decisions)
+            judged += len(decisions)
+            yield from pending
+
+        self.store.finish_sync(policy, config_files, complete)
+        self.nginx_parser.save_index()
+        logger.info(f"{changed_files} 个配置文件有变化，判定了 {judged} 个 server 块")
+        if backoff:
+            logger.info(f"{backoff} 个 server 块处于失败退避期，已跳过（--retry-failed 可立即重试）")
+        if covered:
+            logger.info(f"{covered} 个 server 块的域名已有证书（如 HTTPS 跳转块），已跳过")
+
+    def _wildcard_lineages(self) -> Dict[str, Dict]:
+        """现有的未过期通配符证书，按区域索引"""
+        now = time.time()
+        zones = {}
+        for name, lineage in self.ssl_manager.get_certificate_status().items():
+            if lineage['not_after'] <= now:
+                continue
+            for domain in lineage['domains']:
+                if domain.startswith('*.'):
+                    zones.setdefault(domain[2:], {'name': name, 'domains': lineage['domains']})
+        return zones
+
+    def _covered_by_lineage(self, domains: List[str]) -> bool:
+        """域名是否都已包含在现有证书中"""
+        return len(self.store.lineages_for(domains)) == len(set(domains))
+
+    def _policy_fingerprint(self) -> str:
+        """影响 needs_ssl 判定的配置的指纹"""
+        # engine 在判定规则本身变化时递增，让已保存的判定结果失效
+        policy = {'exclude_domains': self.config.get('exclude_domains', []), 'engine': 3}
+        return hashlib.sha1(json.dumps(policy, sort_keys=True).encode()).hexdigest()
     
     def renew(self):
         """续签证书"""
         return self.ssl_manager.renew_certificates()
+
+    def finish(self) -> bool:
+        """运行结束：统一重载 Nginx，输出统计并写入运行指标"""
+        self.store.flush()
+        result = self.reload_coordinator.flush()
+        self.reload_coordinator.report()
+        summary = metrics.summary()
+        if summary:
+            logger.info(f"各阶段耗时: {summary}")
+        textfile_dir = (self.config.get('metrics') or {}).get('textfile_dir')
+        if textfile_dir:
+            metrics.write_textfile(textfile_dir, self.command)
+        return result
+
+    def run_daemon(self):
+        """守护进程模式：监视 Nginx 配置目录，新增的 server 块在几秒内申请证书
+
+        inotify 事件经过去抖后只重新校验、解析发生变化的文件；
+        每隔 scan_interval 秒仍会执行一次全量扫描作为兜底。
+        """
+        daemon_config = self.config.get('daemon') or {}
+        debounce = daemon_config.get('debounce', 2)
+        scan_interval = self.config.get('scan_interval', 86400)
+
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify 不可用，改为每 {daemon_config.get('poll_interval', 5)} 秒轮询: {e}")
+            watcher = PollingWatcher(daemon_config.get('poll_interval', 5))
+
+        stopping = []
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *_: stopping.append(True))
+
+        logger.info(f"守护进程启动（去抖 {debounce} 秒，全量扫描间隔 {scan_interval} 秒）")
+        index = self.nginx_parser.index
+        next_full_scan = 0.0
+        try:
+            while not stopping:
+                now = time.time()
+                if now >= next_full_scan:
+                    # 全量扫描：所有文件都重新校验
+                    index.invalidate()
+                    self.scan_and_apply()
+                    self.finish()
+                    next_full_scan = now + scan_interval
+                    self._update_watches(watcher)
+                    continue
+
+                # 每秒醒来一次检查退出信号
+                changed, rescan_all = watcher.read(min(next_full_scan - now, 1.0))
+                if not changed and not rescan_all:
+                    continue
+
+                # 去抖：持续收集事件，直到安静 debounce 秒（最多等待 10 倍去抖时间）
+                deadline = time.time() + debounce * 10
+                while not stopping and time.time() < deadline:
+                    more, more_rescan_all = watcher.read(debounce)
+                    if not more and not more_rescan_all:
+                        break
+                    changed |= more
+                    rescan_all = rescan_all or more_rescan_all
+
+                self._apply_changes(changed, rescan_all)
+                self._update_watches(watcher)
+        finally:
+            watcher.close()
+            logger.info("守护进程退出")
+
+    def _apply_changes(self, changed: Set[str], rescan_all: bool):
+        """增量处理变更：只有变化的文件会被重新解析，只为其中的 server 块申请证书"""
+        index = self.nginx_parser.index
+        changed_real = {os.path.realpath(path) for path in changed}
+        index.invalidate(None if rescan_all else changed | changed_real)
+
+        config_files = self.nginx_parser.find_nginx_configs()
+        if rescan_all:
+            affected = config_files
+        else:
+            affected = [config_file for config_file in config_files if config_file in changed_real]
+
+        logger.info(f"检测到 {len(changed)} 个路径变更，{len(affected)} 个生效的配置文件受影响")
+        if affected:
+            ssl_applied = self.apply_config_files(affected, complete=rescan_all)
+            logger.info(f"增量扫描完成，为 {ssl_applied} 个服务应用了 SSL")
+        else:
+            self.nginx_parser.save_index()
+        self.finish()
+
+    def _update_watches(self, watcher):
+        """按当前生效的配置更新监视目录"""
+        config_files = self.nginx_parser.find_nginx_configs()
+        for directory in self.nginx_parser.watch_directories(config_files):
+            watcher.watch(directory)
     
-    def status(self):
-        """显示状态"""
+    def iter_status(self) -> Iterator[Dict]:
+        """逐条生成状态记录：证书、各 server 块中的域名、失败退避中的域名组合"""
+        certificates = self.ssl_manager.get_certificate_status()
+        self.store.sync_lineages(certificates)
+        for name, info in certificates.items():
+            yield make_record('lineage', domain=' '.join(info.get('domains', [])), lineage=name,
+                              expiry=info['not_after'], days_left=info.get('days_left'), ssl=True,
+                              source=info.get('path'))
+        del certificates
+
+        # 只重新判定有变化的文件，然后直接从状态库逐行读取
+        for _ in self.iter_pending_server_blocks():
+            pass
+        for domain, config_file, needs_ssl, lineage, not_after in self.store.iter_domains():
+            yield make_record('domain', domain=domain, lineage=lineage, expiry=not_after, enabled=True,
+                              ssl=lineage is not None, needs_ssl=bool(needs_ssl), source=config_file)
+
+        for domain_set, count, permanent, retry_at, error in self.store.failures():
+            yield make_record('failure', domain=domain_set, needs_ssl=True, retry_at=int(retry_at))
+
+    def status(self, fmt: str = 'text'):
+        """显示状态（fmt 为 ndjson/json/csv 时逐条输出机器可读记录）"""
+        if fmt != 'text':
+            RecordWriter(sys.stdout, fmt).write_all(self.iter_status())
+            return
+
         certificates = self.ssl_manager.get_certificate_status()
+        self.store.sync_lineages(certificates)
         
         print("SSL Bot 状态报告")
         print("=" * 50)
@@ -533,33 +4292,116 @@ class SSLBot:
         if certificates:
             for domain, info in certificates.items():
                 print(f"域名: {domain}")
-                print(f"  包含: {info.get('domains', 'N/A')}")
-                print(f"  过期: {info.get('expiry', 'N/A')}")
+                print(f"  包含: {' '.join(info.get('domains', [])) or 'N/A'}")
+                print(f"  过期: {info.get('expiry', 'N/A')} (剩余 {info.get('days_left', 'N/A')} 天)")
                 print(f"  路径: {info.get('path', 'N/A')}")
                 print("-" * 30)
         else:
             print("未找到 SSL 证书")
         
-        # 扫描当前需要 SSL 的配置
-        config_files = self.nginx_parser.find_nginx_configs()
-        needs_ssl = []
-        
-        for config_file in config_files:
-            server_blocks = self.nginx_parser.parse_server_blocks(config_file)
-            for server_block in server_blocks:
-                if self.ssl_manager.needs_ssl(server_block):
-                    needs_ssl.extend(server_block['server_names'])
-        
+        # 扫描当前需要 SSL 的配置（只重新判定有变化的文件）
+        needs_ssl = set()
+        for server_block in self.iter_pending_server_blocks():
+            needs_ssl.update(server_block['server_names'])
+
         if needs_ssl:
-            print(f"\n需要 SSL 的域名: {', '.join(set(needs_ssl))}")
+            print(f"\n需要 SSL 的域名: {', '.join(needs_ssl)}")
+
+        failures = self.store.failures()
+        if failures:
+            print("\n申请失败（退避中）的域名:")
+            for domain_set, count, permanent, retry_at, error in failures:
+                kind = "永久性错误" if permanent else "可重试错误"
+                retry = time.strftime('%Y-%m-%d %H:%M', time.localtime(retry_at))
+                print(f"  - {domain_set}: 连续失败 {count} 次（{kind}），{retry} 后重试")
+
+    def fleet_roots(self, patterns: Optional[List[str]] = None) -> List[str]:
+        """多租户扫描的配置根目录（命令行给出的优先，否则使用 fleet.roots），支持通配符"""
+        patterns = patterns or (self.config.get('fleet') or {}).get('roots') or []
+        roots = []
+        for pattern in patterns:
+            roots.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+        return list(dict.fromkeys(os.path.normpath(root) for root in roots))
+
+    def fleet(self, patterns: Optional[List[str]] = None) -> Dict:
+        """并发扫描多个 Nginx 配置根目录，返回各根目录的报告和合并的申请计划（只读，不申请证书）
+
+        每个根目录使用单独的扫描索引（state_dir/fleet/ 下），在进程池中各自串行解析。
+        """
+        roots = self.fleet_roots(patterns)
+        index_dir = os.path.join(self.config.get('state_dir', DEFAULT_STATE_DIR), 'fleet')
+        index_paths = [os.path.join(index_dir, f"{hashlib.sha1(root.encode()).hexdigest()[:16]}.json")
+                       for root in roots]
+        logger.info(f"多租户扫描: {len(roots)} 个配置根目录，{min(self.jobs, len(roots) or 1)} 个进程")
+
+        with metrics.span('fleet'):
+            reports = None
+            if self.jobs > 1 and len(roots) > 1:
+                try:
+                    from concurrent.futures import ProcessPoolExecutor
+                    with ProcessPoolExecutor(max_workers=min(self.jobs, len(roots))) as executor:
+                        reports = list(executor.map(_scan_fleet_root, [self.config] * len(roots), roots, index_paths))
+                except Exception as e:
+                    logger.warning(f"并行扫描失败，改为串行扫描: {e}")
+            if reports is None:
+                reports = [_scan_fleet_root(self.config, root, index_path)
+                           for root, index_path in zip(roots, index_paths)]
+
+        plan = [dict(job, root=report['root']) for report in reports for job in report.pop('plan')]
+        summary = {key: sum(report[key] for report in reports)
+                   for key in ('config_files', 'server_blocks', 'ssl', 'needs_ssl')}
+        metrics.inc('config_files_scanned', summary['config_files'])
+        failed = [report['root'] for report in reports if report['error']]
+        if failed:
+            logger.error(f"{len(failed)} 个配置根目录扫描失败: {', '.join(failed)}")
+        logger.info(f"多租户扫描完成: {summary['server_blocks']} 个 server 块，{summary['needs_ssl']} 个需要 SSL，"
+                    f"规划 {len(plan)} 张证书")
+        return dict(roots=len(roots), certificates=len(plan), errors=len(failed), **summary,
+                    reports=reports, plan=plan)
+
+
+def _scan_fleet_root(config: Dict, root: str, index_path: str) -> Dict:
+    """进程池任务：扫描一个配置根目录，返回报告和该根目录的申请计划"""
+    started = time.perf_counter()
+    report = {'root': root, 'config_files': 0, 'server_blocks': 0, 'ssl': 0, 'needs_ssl': 0,
+              'certificates': 0, 'error': None, 'plan': []}
+    try:
+        if not os.path.isdir(root):
+            raise FileNotFoundError(f"配置根目录不存在: {root}")
+        parser = NginxConfigParser(root, ScanIndex(index_path), (config.get('nginx') or {}).get('discovery', 'include'))
+        config_files = parser.find_nginx_configs()
+        # 各租户的证书和失败记录不在本机，只按域名策略判定
+        ssl_manager = SSLCertManager(config)
+        counts = {'server_blocks': 0, 'ssl': 0, 'needs_ssl': 0}
+
+        def pending() -> Iterator[ServerBlock]:
+            for _, server_blocks in parser.iter_config_files(config_files):
+                for block in server_blocks:
+                    counts['server_blocks'] += 1
+                    counts['ssl'] += int(block.has_ssl)
+                    if ssl_manager.needs_ssl(block, check_backoff=False):
+                        counts['needs_ssl'] += 1
+                        yield block
+
+        plan = list(IssuancePlanner.from_config(config, ssl_manager.policy).iter_plan(pending()))
+        parser.save_index()
+        report.update(config_files=len(config_files), certificates=len(plan), plan=plan, **counts)
+    except Exception as e:
+        logger.error(f"扫描配置根目录 {root} 失败: {e}")
+        report['error'] = str(e)
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
 
 
 class DomainManager:
     """域名管理器"""
     
-    def __init__(self, config: Dict):
+    def __init__(self, config: Dict, nginx_parser: Optional[NginxConfigParser] = None,
+                 reload_coordinator: Optional[ReloadCoordinator] = None, store: Optional[StateStore] = None):
         self.config = config
-        self.nginx_parser = NginxConfigParser()
+        self.nginx_parser = nginx_parser or NginxConfigParser()
+        self.reload_coordinator = reload_coordinator
+        self.store = store
     
     def setup_domain(self, domain: str, service_type: str = "static", **kwargs) -> bool:
         """设置新域名，支持多种服务类型"""
@@ -567,22 +4409,22 @@ class DomainManager:
             logger.info(f"设置域名: {domain} (服务类型: {service_type})")
             
             if service_type == "static":
-                webroot = kwargs.get('webroot', f"/var/www/{domain}/html")
+                webroot = kwargs.get('webroot') or f"/var/www/{domain}/html"
                 return self.create_static_site(domain, webroot)
                 
             elif service_type == "php":
-                webroot = kwargs.get('webroot', f"/var/www/{domain}/html")
-                php_version = kwargs.get('php_version', '8.1')
+                webroot = kwargs.get('webroot') or f"/var/www/{domain}/html"
+                php_version = kwargs.get('php_version') or '8.1'
                 return self.create_php_site(domain, webroot, php_version)
                 
-            elif service_type == "reverse_proxy":
-                backend_url = kwargs.get('backend_url', 'http://localhost:8080')
-                app_path = kwargs.get('app_path', '/')
+            elif service_type in ("reverse_proxy", "proxy"):
+                backend_url = kwargs.get('backend_url') or 'http://localhost:8080'
+                app_path = kwargs.get('app_path') or '/'
                 return self.create_reverse_proxy(domain, backend_url, app_path)
                 
             elif service_type == "tomcat":
-                tomcat_url = kwargs.get('tomcat_url', 'http://localhost:8080')
-                app_path = kwargs.get('app_path', '/')
+                tomcat_url = kwargs.get('tomcat_url') or kwargs.get('backend_url') or 'http://localhost:8080'
+                app_path = kwargs.get('app_path') or '/'
                 return self.create_tomcat_proxy(domain, tomcat_url, app_path)
                 
             else:
@@ -593,10 +4435,44 @@ class DomainManager:
             logger.error(f"设置域名失败 {domain}: {e}")
             return False
     
+    def create_static_site(self, domain: str, webroot: str) -> bool:
+        """创建静态网站（网站目录和 Nginx 配置）"""
+        self.create_web_directory(domain, webroot)
+        return self._write_nginx_config(domain, self._render_static_site(domain, webroot))
+
+    def create_php_site(self, domain: str, webroot: str, php_version: str = "8.1") -> bool:
+        """创建 PHP 网站（网站目录和 Nginx 配置）"""
+        self.create_web_directory(domain, webroot)
+        return self._write_nginx_config(domain, self._render_php_site(domain, webroot, php_version))
+
+    def render_site_config(self, domain: str, service_type: str = "static", webroot: Optional[str] = None,
+                           backend_url: Optional[str] = None, app_path: Optional[str] = None,
+                           php_version: Optional[str] = None) -> str:
+        """生成站点的 Nginx 配置（不写入文件），不支持的服务类型抛出 ValueError"""
+        if service_type == "static":
+            return self._render_static_site(domain, webroot or f"/var/www/{domain}/html")
+        if service_type == "php":
+            return self._render_php_site(domain, webroot or f"/var/www/{domain}/html", php_version or "8.1")
+        if service_type in ("reverse_proxy", "proxy"):
+            return self._render_reverse_proxy(domain, backend_url or "http://localhost:8080", app_path or "/")
+        if service_type == "tomcat":
+            return self._render_tomcat_proxy(domain, backend_url or "http://localhost:8080", app_path or "/")
+        raise ValueError(f"不支持的服务类型: {service_type}")
+
+    def site_config_path(self, domain: str) -> str:
+        """站点配置文件路径（sites-available/<域名>）"""
+        return os.path.join(self.nginx_parser.sites_available, domain)
+
     def create_reverse_proxy(self, domain: str, backend_url: str, app_path: str = "/") -> bool:
         """创建反向代理配置"""
         try:
-            config_content = f'''
+            return self._write_nginx_config(domain, self._render_reverse_proxy(domain, backend_url, app_path))
+        except Exception as e:
+            logger.error(f"创建反向代理配置失败: {e}")
+            return False
+
+    def _render_reverse_proxy(self, domain: str, backend_url: str, app_path: str = "/") -> str:
+        return f'''
 server {{
     listen 80;
     listen [::]:80;
@@ -628,20 +4504,21 @@ server {{
     }}
 }}
 '''
-            return self._write_nginx_config(domain, config_content)
-            
-        except Exception as e:
-            logger.error(f"创建反向代理配置失败: {e}")
-            return False
     
     def create_tomcat_proxy(self, domain: str, tomcat_url: str, app_path: str = "/") -> bool:
         """创建 Tomcat 专用代理配置"""
         try:
-            # 确保 URL 以 / 结尾
-            if not tomcat_url.endswith('/'):
-                tomcat_url += '/'
-                
-            config_content = f'''
+            return self._write_nginx_config(domain, self._render_tomcat_proxy(domain, tomcat_url, app_path))
+        except Exception as e:
+            logger.error(f"创建 Tomcat 代理配置失败: {e}")
+            return False
+
+    def _render_tomcat_proxy(self, domain: str, tomcat_url: str, app_path: str = "/") -> str:
+        # 确保 URL 以 / 结尾
+        if not tomcat_url.endswith('/'):
+            tomcat_url += '/'
+
+        return f'''
 server {{
     listen 80;
     listen [::]:80;
@@ -672,27 +4549,25 @@ server {{
     }}
 }}
 '''
-            return self._write_nginx_config(domain, config_content)
-            
-        except Exception as e:
-            logger.error(f"创建 Tomcat 代理配置失败: {e}")
-            return False
     
     def _write_nginx_config(self, domain: str, config_content: str) -> bool:
         """写入 Nginx 配置并启用站点"""
         try:
-            config_path = f"/etc/nginx/sites-available/{domain}"
+            config_path = self.site_config_path(domain)
             with open(config_path, 'w') as f:
                 f.write(config_content)
             
             # 启用站点
-            enabled_path = f"/etc/nginx/sites-enabled/{domain}"
+            enabled_path = os.path.join(self.nginx_parser.sites_enabled, domain)
             if not os.path.exists(enabled_path):
                 os.symlink(config_path, enabled_path)
             
             logger.info(f"Nginx 配置创建成功: {domain}")
             
-            # 重载 Nginx
+            # 重载 Nginx（有协调器时在运行结束时统一重载）
+            if self.reload_coordinator:
+                self.reload_coordinator.mark_dirty(f"写入 {domain} 配置")
+                return True
             return self.reload_nginx()
             
         except Exception as e:
@@ -724,6 +4599,25 @@ server {{
     
     def create_web_directory(self, domain: str, webroot: str):
         """创建网站目录"""
+        self.create_web_directories([(domain, webroot)])
+
+    def create_web_directories(self, sites: List[Tuple[str, str]]):
+        """批量创建网站目录 (域名, 网站根目录)，所有目录只调用一次 chown 和 chmod"""
+        for domain, webroot in sites:
+            self._write_index_page(domain, webroot)
+
+        # 设置权限（参数过多时分批）
+        parents = sorted({os.path.dirname(webroot) for _, webroot in sites})
+        for start in range(0, len(parents), 500):
+            chunk = parents[start:start + 500]
+            subprocess.run(["chown", "-R", "www-data:www-data", *chunk], check=True)
+            subprocess.run(["chmod", "-R", "755", *chunk], check=True)
+
+        for _, webroot in sites:
+            logger.info(f"创建网站目录: {webroot}")
+
+    @staticmethod
+    def _write_index_page(domain: str, webroot: str):
         os.makedirs(webroot, exist_ok=True)
         
         # 创建默认页面
@@ -741,17 +4635,59 @@ server {{
     <p>SSL 证书将自动申请和安装</p>
 </body>
 </html>''')
-        
-        # 设置权限
-        subprocess.run(["chown", "-R", "www-data:www-data", os.path.dirname(webroot)], check=True)
-        subprocess.run(["chmod", "-R", "755", os.path.dirname(webroot)], check=True)
-        
-        logger.info(f"创建网站目录: {webroot}")
     
     def create_nginx_config(self, domain: str, webroot: str) -> bool:
         """创建 Nginx 配置"""
         try:
-            config_content = fr'''
+            config_content = self._render_static_site(domain, webroot)
+            # 写入配置文件
+            config_path = self.site_config_path(domain)
+            with open(config_path, 'w') as f:
+                f.write(config_content)
+            
+            # 启用站点
+            enabled_path = os.path.join(self.nginx_parser.sites_enabled, domain)
+            if not os.path.exists(enabled_path):
+                os.symlink(config_path, enabled_path)
+            
+            logger.info(f"Nginx 配置创建成功: {domain}")
+            return True
+            
+        except Exception as e:
+            logger.error(f"创建 Nginx 配置失败: {e}")
+            return False
+
+    def _render_php_site(self, domain: str, webroot: str, php_version: str = "8.1") -> str:
+        return fr'''
+server {{
+    listen 80;
+    listen [::]:80;
+    server_name {domain};
+    root {webroot};
+    index index.php index.html index.htm;
+    
+    # 安全头
+    add_header X-Frame-Options "SAMEORIGIN" always;
+    add_header X-XSS-Protection "1; mode=block" always;
+    add_header X-Content-Type-Options "nosniff" always;
+    
+    location / {{
+        try_files $uri $uri/ /index.php?$query_string;
+    }}
+    
+    location ~ \.php$ {{
+        include snippets/fastcgi-php.conf;
+        fastcgi_pass unix:/run/php/php{php_version}-fpm.sock;
+    }}
+    
+    location ~ /\.ht {{
+        deny all;
+    }}
+}}
+'''
+
+    def _render_static_site(self, domain: str, webroot: str) -> str:
+        return fr'''
 server {{
     listen 80;
     listen [::]:80;
@@ -778,61 +4714,207 @@ server {{
     }}
 }}
 '''
-            # 写入配置文件
-            config_path = f"/etc/nginx/sites-available/{domain}"
-            with open(config_path, 'w') as f:
-                f.write(config_content)
-            
-            # 启用站点
-            enabled_path = f"/etc/nginx/sites-enabled/{domain}"
-            if not os.path.exists(enabled_path):
-                os.symlink(config_path, enabled_path)
-            
-            logger.info(f"Nginx 配置创建成功: {domain}")
-            return True
-            
-        except Exception as e:
-            logger.error(f"创建 Nginx 配置失败: {e}")
-            return False
     
+    # 批量文件中的列名别名
+    FIELD_ALIASES = {'type': 'service_type', 'service': 'service_type', 'backend': 'backend_url',
+                     'root': 'webroot', 'path': 'app_path'}
+
+    def load_domain_list(self, path: str) -> List[Dict]:
+        """读取批量域名文件
+
+        CSV（带表头，# 开头的行为注释）或 YAML（列表，或 domains 键下的列表），
+        每项包含 domain 和可选的 service_type、backend_url、webroot、app_path、php_version。
+        """
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            if os.path.splitext(path)[1].lower() in ('.yaml', '.yml'):
+                import yaml
+                data = yaml.safe_load(f) or []
+                if isinstance(data, dict):
+                    data = data.get('domains') or []
+                rows = [{'domain': item} if isinstance(item, str) else dict(item) for item in data]
+            else:
+                rows = list(csv.DictReader(line for line in f if line.strip() and not line.lstrip().startswith('#')))
+
+        entries = []
+        for row in rows:
+            entry = {}
+            for key, value in row.items():
+                if key is None or value is None or value == '':
+                    continue
+                key = key.strip().lower()
+                entry[self.FIELD_ALIASES.get(key, key)] = str(value).strip()
+            entries.append(entry)
+        return entries
+
+    def add_domains_from(self, path: str) -> Optional[List[str]]:
+        """从文件批量添加域名，返回新写入的配置文件（失败时返回 None）"""
+        try:
+            entries = self.load_domain_list(path)
+        except Exception as e:
+            logger.error(f"读取域名文件失败 {path}: {e}")
+            return None
+        return self.add_domains(entries)
+
+    def add_domains(self, entries: List[Dict]) -> Optional[List[str]]:
+        """批量添加域名
+
+        先生成所有配置，再逐个原子写入并启用，最后只执行一次 nginx -t 和重载；
+        配置测试失败时删除本次写入的所有文件和新建的网站目录（已存在的目录保留）。
+        已有配置的域名跳过。
+        """
+        rendered = []
+        seen = set()
+        for entry in entries:
+            domain = entry.get('domain', '').strip().lower()
+            if not domain or domain in seen:
+                continue
+            seen.add(domain)
+            if os.path.exists(self.site_config_path(domain)):
+                logger.info(f"域名 {domain} 已有配置，跳过")
+                continue
+            service_type = entry.get('service_type', 'static')
+            try:
+                content = self.render_site_config(domain, service_type, entry.get('webroot'), entry.get('backend_url'),
+                                                  entry.get('app_path'), entry.get('php_version'))
+            except ValueError as e:
+                logger.error(f"跳过域名 {domain}: {e}")
+                continue
+            webroot = entry.get('webroot') or f"/var/www/{domain}/html"
+            rendered.append((domain, content, webroot if service_type in ('static', 'php') else None))
+
+        if not rendered:
+            logger.info("没有需要添加的域名")
+            return []
+
+        logger.info(f"批量添加 {len(rendered)} 个域名...")
+        written: List[str] = []
+        # 本次新建的最上层目录，回滚时整体删除
+        created_dirs = sorted({self._missing_ancestor(webroot) for _, _, webroot in rendered if webroot} - {None})
+        try:
+            with metrics.span('web_directories'):
+                self.create_web_directories([(domain, webroot) for domain, _, webroot in rendered if webroot])
+            with metrics.span('write_sites'):
+                for domain, content, _ in rendered:
+                    config_path = self.site_config_path(domain)
+                    with open(f"{config_path}.tmp", 'w') as f:
+                        f.write(content)
+                    os.replace(f"{config_path}.tmp", config_path)
+                    written.append(config_path)
+                for domain, _, _ in rendered:
+                    enabled_path = os.path.join(self.nginx_parser.sites_enabled, domain)
+                    if not os.path.lexists(enabled_path):
+                        os.symlink(self.site_config_path(domain), enabled_path)
+        except Exception as e:
+            logger.error(f"批量写入 Nginx 配置失败: {e}")
+            self._remove_sites(written, created_dirs)
+            return None
+
+        # 所有站点只测试和重载一次
+        if self.reload_coordinator:
+            self.reload_coordinator.mark_dirty(f"批量添加 {len(written)} 个域名")
+            reloaded = self.reload_coordinator.flush()
+        else:
+            reloaded = self.reload_nginx()
+        if not reloaded:
+            logger.error("Nginx 配置测试失败，已撤销本次添加的所有站点")
+            self._remove_sites(written, created_dirs)
+            return None
+
+        logger.info(f"批量添加完成: {len(written)} 个域名")
+        return [os.path.realpath(config_path) for config_path in written]
+
+    def _remove_sites(self, config_paths: List[str], directories: Iterable[str] = ()):
+        """删除站点配置及其 sites-enabled 链接，以及本次新建的网站目录"""
+        for config_path in config_paths:
+            enabled_path = os.path.join(self.nginx_parser.sites_enabled, os.path.basename(config_path))
+            for path in (enabled_path, config_path):
+                try:
+                    if os.path.lexists(path):
+                        os.unlink(path)
+                except OSError as e:
+                    logger.error(f"删除 {path} 失败: {e}")
+        for directory in directories:
+            shutil.rmtree(directory, onerror=lambda _, path, exc: logger.error(f"删除 {path} 失败: {exc[1]}"))
+
+    @staticmethod
+    def _missing_ancestor(path: str) -> Optional[str]:
+        """path 及其上级目录中不存在的最上层目录（path 已存在时返回 None）"""
+        path = os.path.abspath(path)
+        top = None
+        while not os.path.lexists(path):
+            top = path
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        return top
+
     def reload_nginx(self) -> bool:
         """重载 Nginx 配置"""
-        try:
-            # 测试配置
-            subprocess.run(["nginx", "-t"], check=True, capture_output=True)
-            # 重载
-            subprocess.run(["systemctl", "reload", "nginx"], check=True)
-            logger.info("Nginx 重载成功")
-            return True
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Nginx 重载失败: {e}")
-            return False
+        with metrics.span('nginx_reload'):
+            try:
+                # 测试配置
+                metrics.inc('nginx_tests')
+                subprocess.run(["nginx", "-t"], check=True, capture_output=True)
+                # 重载
+                subprocess.run(["systemctl", "reload", "nginx"], check=True)
+                metrics.inc('nginx_reloads')
+                logger.info("Nginx 重载成功")
+                return True
+            except subprocess.CalledProcessError as e:
+                metrics.inc('nginx_reload_failures')
+                logger.error(f"Nginx 重载失败: {e}")
+                return False
     
     def list_domains(self) -> List[Dict]:
         """列出所有已配置的域名"""
-        domains = []
-        sites_available = "/etc/nginx/sites-available"
-        
-        if os.path.exists(sites_available):
-            for file in os.listdir(sites_available):
-                if file not in ['default', '000-default']:
-                    config_file = os.path.join(sites_available, file)
-                    with open(config_file, 'r') as f:
-                        content = f.read()
-                        # 提取 server_name
-                        import re
-                        match = re.search(r'server_name\s+([^;]+);', content)
-                        if match:
-                            server_names = match.group(1).strip().split()
-                            for name in server_names:
-                                if name not in ['_', 'localhost'] and not name.startswith('~'):
-                                    domains.append({
-                                        'domain': name,
-                                        'config_file': config_file,
-                                        'enabled': os.path.exists(f"/etc/nginx/sites-enabled/{file}")
-                                    })
-        
-        return domains
+        return list(self.iter_domains())
+
+    def iter_domains(self) -> Iterator[Dict]:
+        """逐个站点文件生成域名记录（所属证书和过期时间从状态库查询）"""
+        sites_available = self.nginx_parser.sites_available
+        try:
+            entries = os.scandir(sites_available)
+        except FileNotFoundError:
+            return
+
+        try:
+            with entries:
+                for entry in entries:
+                    if entry.name in ['default', '000-default'] or not entry.is_file():
+                        continue
+                    enabled = os.path.exists(os.path.join(self.nginx_parser.sites_enabled, entry.name))
+                    names = self._read_server_names(entry.path)
+                    certificates = self.store.certificates_for(names) if self.store and names else {}
+                    for name in names:
+                        lineage, not_after = certificates.get(name, (None, None))
+                        yield make_record('domain', domain=name, lineage=lineage, expiry=not_after,
+                                          enabled=enabled, ssl=lineage is not None, source=entry.path)
+        finally:
+            self.nginx_parser.save_index()
+
+    def _read_server_names(self, config_file: str) -> List[str]:
+        """读取配置文件中的 server_name（未变化的文件使用扫描索引）"""
+        index = self.nginx_parser.index
+        cached = index.get(config_file, 'listed_names')
+        if cached is not None:
+            return cached
+
+        st = os.stat(config_file)
+        with open(config_file, 'r') as f:
+            content = f.read()
+
+        names = []
+        # 提取 server_name
+        match = re.search(r'server_name\s+([^;]+);', content)
+        if match:
+            server_names = match.group(1).strip().split()
+            for name in server_names:
+                if name not in ['_', 'localhost'] and not name.startswith('~'):
+                    names.append(name)
+
+        index.put(config_file, 'listed_names', names, st)
+        return names
     
 def main():
     parser = argparse.ArgumentParser(description='SSL Bot - 自动 SSL 证书和域名管理')
@@ -840,40 +4922,110 @@ def main():
     parser.add_argument('--renew', action='store_true', help='续签证书')
     parser.add_argument('--status', action='store_true', help='显示状态')
     parser.add_argument('--add-domain', type=str, help='添加新域名')
+    parser.add_argument('--add-domains-from', type=str, metavar='FILE',
+                        help='从 CSV/YAML 文件批量添加域名（domain, service_type, backend_url, webroot）')
     parser.add_argument('--service-type', type=str, choices=['static', 'php', 'proxy', 'tomcat'], 
                        default='static', help='服务类型')
     parser.add_argument('--backend-url', type=str, help='后端服务地址（用于代理）')
     parser.add_argument('--app-path', type=str, default='/', help='应用路径（用于代理）')
     parser.add_argument('--list-domains', action='store_true', help='列出所有域名')
+    parser.add_argument('--rebuild-index', action='store_true', help='丢弃并重建 Nginx 配置扫描索引')
+    parser.add_argument('--plan', action='store_true', help='输出证书申请计划（JSON，不申请证书）')
+    parser.add_argument('--fleet', type=str, nargs='*', metavar='ROOT',
+                        help='多租户扫描：并发扫描多个 Nginx 配置根目录（默认 fleet.roots，支持通配符），'
+                             '输出各根目录的报告和合并的申请计划（JSON，不申请证书）')
+    parser.add_argument('--export', action='store_true', help='以 JSON 导出状态库')
+    parser.add_argument('--daemon', action='store_true', help='守护进程模式：监视 Nginx 配置变更并自动申请证书')
+    parser.add_argument('--retry-failed', action='store_true', help='忽略失败退避，立即重试申请失败的域名')
+    parser.add_argument('--format', choices=['text', *RecordWriter.FORMATS], default='text',
+                        help='--status / --list-domains 的输出格式（ndjson/json/csv 逐条流式输出，日志改写到 stderr）')
+    parser.add_argument('--config', type=str, default=DEFAULT_CONFIG, metavar='FILE',
+                        help=f'配置文件路径（默认 {DEFAULT_CONFIG}）')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='并行解析配置文件的进程数（默认 CPU 核数）')
+    parser.add_argument('--profile', type=str, metavar='FILE',
+                        help='用 cProfile 记录本次运行，结果写入 FILE（python3 -m pstats FILE 查看）')
+    parser.add_argument('--dns-hook', choices=['auth', 'cleanup'], help=argparse.SUPPRESS)
     args = parser.parse_args()
+
+    # certbot --manual 的 DNS-01 验证钩子，只操作 TXT 记录
+    if args.dns_hook:
+        setup_logging(stream=sys.stderr)
+        return SSLBot(config_path=args.config, command='dns_hook').ssl_manager.run_dns_hook(args.dns_hook)
+
+    # 输出 JSON/记录时标准输出只保留数据，日志改写到 stderr
+    machine_output = args.format != 'text' or args.plan or args.export or args.fleet is not None
+    setup_logging(stream=sys.stderr if machine_output else sys.stdout)
     
-    bot = SSLBot()
-    
-    if args.scan_and_apply:
+    commands = ['daemon', 'scan_and_apply', 'export', 'plan', 'renew', 'status', 'add_domain', 'add_domains_from',
+                'list_domains']
+    command = 'fleet' if args.fleet is not None else next((name for name in commands if getattr(args, name)), 'help')
+    bot = SSLBot(rebuild_index=args.rebuild_index, jobs=args.jobs, config_path=args.config, command=command)
+    if args.retry_failed:
+        bot.ssl_manager.retry_failed = True
+
+    if not args.profile:
+        return _run_command(bot, args, parser)
+
+    import cProfile
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(_run_command, bot, args, parser)
+    finally:
+        profiler.dump_stats(args.profile)
+        logger.info(f"性能分析结果已写入 {args.profile}")
+
+
+def _run_command(bot: SSLBot, args, parser):
+    """执行命令行指定的操作"""
+    if args.daemon:
+        bot.run_daemon()
+    elif args.scan_and_apply:
         bot.scan_and_apply()
+    elif args.export:
+        bot.store.export(sys.stdout)
+    elif args.fleet is not None:
+        print(json.dumps(bot.fleet(args.fleet), ensure_ascii=False, indent=2))
+    elif args.plan:
+        print(json.dumps(bot.plan(), ensure_ascii=False, indent=2))
     elif args.renew:
         bot.renew()
     elif args.status:
-        bot.status()
+        bot.status(args.format)
     elif args.add_domain:
-        domain_manager = DomainManager(bot.config)
+        domain_manager = DomainManager(bot.config, bot.nginx_parser, bot.reload_coordinator, bot.store)
         if domain_manager.setup_domain(
             args.add_domain, 
             args.service_type,
             backend_url=args.backend_url,
             app_path=args.app_path
         ):
-            # 自动为新域名申请 SSL
-            bot.scan_and_apply()
+            # 新站点生效后只为它申请 SSL，不扫描整个配置树
+            if bot.reload_coordinator.flush():
+                bot.apply_config_files([os.path.realpath(domain_manager.site_config_path(args.add_domain))],
+                                       complete=False)
+    elif args.add_domains_from:
+        domain_manager = DomainManager(bot.config, bot.nginx_parser, bot.reload_coordinator, bot.store)
+        config_files = domain_manager.add_domains_from(args.add_domains_from)
+        if config_files:
+            # 只为新添加的 server 块申请证书
+            bot.apply_config_files(config_files, complete=False)
     elif args.list_domains:
-        domain_manager = DomainManager(bot.config)
-        domains = domain_manager.list_domains()
-        print("已配置的域名:")
-        for domain_info in domains:
-            status = "已启用" if domain_info['enabled'] else "未启用"
-            print(f"  - {domain_info['domain']} ({status})")
+        domain_manager = DomainManager(bot.config, bot.nginx_parser, bot.reload_coordinator, bot.store)
+        if args.format != 'text':
+            RecordWriter(sys.stdout, args.format).write_all(domain_manager.iter_domains())
+        else:
+            print("已配置的域名:")
+            for domain_info in domain_manager.iter_domains():
+                status = "已启用" if domain_info['enabled'] else "未启用"
+                if domain_info.get('lineage'):
+                    status += f"，证书: {domain_info['lineage']}"
+                print(f"  - {domain_info['domain']} ({status})")
     else:
         parser.print_help()
 
+    # 本次运行的所有变更只重载一次 Nginx
+    bot.finish()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+SSL Bot 库入口
+
+ssl-bot.py 的文件名带连字符，不能直接 import。本模块按路径加载它并以 ssl_bot 的名字注册，
+其他程序可以直接使用其中的类：
+
+    from ssl_bot import NginxConfigParser, SSLCertManager, DomainManager
+
+导入时不读取配置、不配置日志、不访问 /etc 和 /var 下的任何文件。
+
+也可以代替 ssl-bot.py 作为命令行入口（python3 ssl_bot.py --status）：直接运行 ssl-bot.py 时
+解释器每次都要重新编译整个脚本，经本模块加载则使用 __pycache__ 中的字节码，启动更快。
+"""
+
+import os
+import sys
+import importlib.util
+
+_spec = importlib.util.spec_from_file_location(
+    'ssl_bot', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ssl-bot.py'))
+_module = importlib.util.module_from_spec(_spec)
+# 用真正的模块替换本模块，类的 __module__ 为 ssl_bot，进程池可以按名字 pickle
+sys.modules['ssl_bot'] = _module
+_spec.loader.exec_module(_module)
+
+if __name__ == '__main__':
+    sys.exit(_module.main())
@@ -0,0 +1,87 @@
+"""测试公共夹具：加载 ssl_bot，生成 Nginx 配置树、桩程序和指向临时目录的配置文件"""
+
+import os
+import sys
+import json
+import textwrap
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import ssl_bot  # noqa: E402
+
+# certbot 桩程序：把参数按 JSON 逐行记入日志后成功退出
+CERTBOT_STUB = '''#!{python}
+import sys, json
+with open({log!r}, 'a') as f:
+    f.write(json.dumps(sys.argv[1:]) + '\\n')
+'''
+
+
+def server_block(*names: str, root: str = None, listen: str = '80') -> str:
+    """生成一个 server 块"""
+    lines = [f"    listen {listen};", f"    server_name {' '.join(names)};"]
+    if root:
+        lines.append(f"    root {root};")
+    return 'server {\n' + '\n'.join(lines) + '\n}\n'
+
+
+@pytest.fixture
+def nginx_tree(tmp_path):
+    """返回写入站点文件的函数：write(文件名, 内容)，nginx.conf include sites-enabled/*"""
+    root = tmp_path / 'nginx'
+    (root / 'sites-enabled').mkdir(parents=True)
+    (root / 'nginx.conf').write_text('events {}\nhttp {\n    include sites-enabled/*;\n}\n')
+
+    def write(name: str, content: str):
+        (root / 'sites-enabled' / name).write_text(textwrap.dedent(content))
+
+    write.root = str(root)
+    return write
+
+
+@pytest.fixture
+def stub_bin(tmp_path, monkeypatch):
+    """certbot / nginx / systemctl 桩程序，返回 certbot 调用记录的读取函数"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    log = tmp_path / 'certbot.log'
+    (bin_dir / 'certbot').write_text(CERTBOT_STUB.format(python=sys.executable, log=str(log)))
+    for name in ('nginx', 'systemctl'):
+        (bin_dir / name).write_text('#!/bin/sh\nexit 0\n')
+    for path in bin_dir.iterdir():
+        path.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}")
+
+    def calls():
+        if not log.exists():
+            return []
+        return [json.loads(line) for line in log.read_text().splitlines()]
+
+    calls.certbot = str(bin_dir / 'certbot')
+    return calls
+
+
+@pytest.fixture
+def make_bot(tmp_path, nginx_tree, stub_bin):
+    """按给定的配置（与默认的测试配置逐节合并）创建 SSLBot"""
+    def make(**overrides) -> 'ssl_bot.SSLBot':
+        config = {
+            'email': 'admin@example.com',
+            'exclude_domains': ['localhost'],
+            'state_dir': str(tmp_path / 'state'),
+            'nginx': {'config_path': nginx_tree.root, 'scan_index': str(tmp_path / 'state' / 'index.json')},
+            'certbot': {'command': stub_bin.certbot, 'config_dir': str(tmp_path / 'letsencrypt')},
+            'preflight': {'enabled': False},
+        }
+        for key, value in overrides.items():
+            if isinstance(value, dict) and isinstance(config.get(key), dict):
+                config[key] = {**config[key], **value}
+            else:
+                config[key] = value
+        path = tmp_path / 'config.yaml'
+        path.write_text(json.dumps(config))
+        return ssl_bot.SSLBot(config_path=str(path))
+
+    return make
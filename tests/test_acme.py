@@ -0,0 +1,372 @@
+"""内置 ACME 客户端：用本地模拟 CA（与 Pebble 相同的 RFC 8555 流程）检查签发、账户复用、并发订单、
+certbot 兼容的证书目录结构和续签"""
+
+import os
+import json
+import base64
+import hashlib
+import datetime
+import threading
+import http.server
+
+import pytest
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+
+from conftest import server_block
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+class MockCA:
+    """模拟 ACME CA：校验 JWS 签名和 nonce，HTTP-01 验证直接读取 webroots 中对应域名目录下的验证文件"""
+
+    def __init__(self, webroots, concurrent_orders: int = 1):
+        self.webroots = webroots
+        self.lock = threading.Lock()
+        self.nonces = set()
+        self.accounts = {}   # kid -> 公钥
+        self.thumbprints = {}  # JWK 指纹 -> kid
+        self.orders = {}
+        self.authzs = {}
+        self.certs = {}
+        self.issued = []
+        self.registrations = 0
+        # 前 concurrent_orders 个订单在创建后互相等待，客户端串行下单时会超时失败
+        self.barrier = threading.Barrier(concurrent_orders, timeout=10) if concurrent_orders > 1 else None
+
+        self.key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Mock ACME CA')])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.root = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                     .public_key(self.key.public_key()).serial_number(x509.random_serial_number())
+                     .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=30))
+                     .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+                     .sign(self.key, hashes.SHA256()))
+
+        ca = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path == '/directory':
+                    base = ca.url
+                    self.reply(200, {'newNonce': f"{base}/nonce", 'newAccount': f"{base}/account",
+                                     'newOrder': f"{base}/order"})
+                else:
+                    self.reply(404, {'detail': 'not found'})
+
+            def do_HEAD(self):
+                self.reply(200, None)
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                try:
+                    status, payload, headers = ca.handle(self.path, json.loads(body))
+                except AcmeProblem as e:
+                    status, payload, headers = e.status, {'type': f"urn:ietf:params:acme:error:{e.kind}",
+                                                          'detail': str(e)}, {}
+                self.reply(status, payload, headers)
+
+            def reply(self, status, payload, headers=None):
+                data = payload.encode() if isinstance(payload, str) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Replay-Nonce', ca.new_nonce())
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(0 if payload is None else len(data)))
+                self.end_headers()
+                if payload is not None and self.command != 'HEAD':
+                    self.wfile.write(data)
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def new_nonce(self) -> str:
+        nonce = b64encode(os.urandom(16))
+        with self.lock:
+            self.nonces.add(nonce)
+        return nonce
+
+    def verify(self, path: str, jws: dict):
+        """校验 JWS，返回 (保护头, 载荷, 公钥)"""
+        protected = json.loads(b64decode(jws['protected']))
+        with self.lock:
+            if protected.get('nonce') not in self.nonces:
+                raise AcmeProblem('badNonce', 'nonce 无效或已使用')
+            self.nonces.discard(protected['nonce'])
+        if protected.get('url') != self.url + path or protected.get('alg') != 'ES256':
+            raise AcmeProblem('malformed', '保护头中的 url 或 alg 不正确')
+        if 'jwk' in protected:
+            jwk = protected['jwk']
+            key = ec.EllipticCurvePublicNumbers(int.from_bytes(b64decode(jwk['x']), 'big'),
+                                                int.from_bytes(b64decode(jwk['y']), 'big'),
+                                                ec.SECP256R1()).public_key()
+        else:
+            key = self.accounts.get(protected.get('kid'))
+            if key is None:
+                raise AcmeProblem('accountDoesNotExist', '账户不存在')
+        signature = b64decode(jws['signature'])
+        key.verify(encode_dss_signature(int.from_bytes(signature[:32], 'big'), int.from_bytes(signature[32:], 'big')),
+                   f"{jws['protected']}.{jws['payload']}".encode(), ec.ECDSA(hashes.SHA256()))
+        payload = json.loads(b64decode(jws['payload'])) if jws['payload'] else None
+        return protected, payload, key
+
+    def handle(self, path: str, jws: dict):
+        protected, payload, key = self.verify(path, jws)
+        if path == '/account':
+            jwk = protected['jwk']
+            thumbprint = b64encode(hashlib.sha256(json.dumps(
+                {k: jwk[k] for k in ('crv', 'kty', 'x', 'y')}, sort_keys=True, separators=(',', ':')).encode()).digest())
+            with self.lock:
+                if thumbprint in self.thumbprints:
+                    return 200, {'status': 'valid'}, {'Location': self.thumbprints[thumbprint]}
+                self.registrations += 1
+                kid = f"{self.url}/acct/{self.registrations}"
+                self.accounts[kid] = key
+                self.thumbprints[thumbprint] = kid
+            return 201, {'status': 'valid', 'contact': payload.get('contact', [])}, {'Location': kid}
+        kid = protected['kid']
+
+        if path == '/order':
+            return self.new_order(kid, [identifier['value'] for identifier in payload['identifiers']])
+        kind, _, name = path.strip('/').partition('/')
+        if kind == 'authz':
+            authz = self.authzs[name]
+            return 200, self.authz_json(authz), {}
+        if kind == 'chall':
+            return self.validate(name, self.authzs[name])
+        if kind == 'orders':
+            return 200, self.order_json(self.orders[name]), {}
+        if kind == 'finalize':
+            return self.finalize(self.orders[name], payload)
+        if kind == 'cert':
+            return 200, self.certs[name], {'Content-Type': 'application/pem-certificate-chain'}
+        raise AcmeProblem('malformed', f"未知路径 {path}")
+
+    def new_order(self, kid, domains):
+        order_id = b64encode(os.urandom(8))
+        authz_ids = []
+        with self.lock:
+            for domain in domains:
+                authz_id = b64encode(os.urandom(8))
+                self.authzs[authz_id] = {'domain': domain, 'status': 'pending', 'kid': kid,
+                                         'token': b64encode(os.urandom(16))}
+                authz_ids.append(authz_id)
+            self.orders[order_id] = {'id': order_id, 'domains': domains, 'authzs': authz_ids, 'status': 'pending'}
+        if self.barrier:
+            try:
+                self.barrier.wait()
+            except threading.BrokenBarrierError:
+                pass
+        return 201, self.order_json(self.orders[order_id]), {'Location': f"{self.url}/orders/{order_id}"}
+
+    def order_json(self, order):
+        if order['status'] == 'pending' and all(self.authzs[a]['status'] == 'valid' for a in order['authzs']):
+            order['status'] = 'ready'
+        result = {'status': order['status'], 'identifiers': [{'type': 'dns', 'value': d} for d in order['domains']],
+                  'authorizations': [f"{self.url}/authz/{a}" for a in order['authzs']],
+                  'finalize': f"{self.url}/finalize/{order['id']}"}
+        if order['status'] == 'valid':
+            result['certificate'] = f"{self.url}/cert/{order['id']}"
+        return result
+
+    def authz_json(self, authz):
+        challenges = [{'type': kind, 'url': f"{self.url}/chall/{name}", 'token': authz['token'], 'status': authz['status']}
+                      for kind, name in (('http-01', self.authz_id(authz)), ('dns-01', 'unused'))]
+        if authz.get('error'):
+            challenges[0]['error'] = authz['error']
+        return {'status': authz['status'], 'identifier': {'type': 'dns', 'value': authz['domain']},
+                'challenges': challenges}
+
+    def authz_id(self, authz):
+        return next(key for key, value in self.authzs.items() if value is authz)
+
+    def validate(self, name, authz):
+        """HTTP-01：按域名找到应当写入验证文件的目录，检查 key authorization"""
+        thumbprint = next(t for t, kid in self.thumbprints.items() if kid == authz['kid'])
+        expected = f"{authz['token']}.{thumbprint}"
+        path = os.path.join(self.webroots.get(authz['domain'], '/nonexistent'), '.well-known', 'acme-challenge',
+                            authz['token'])
+        try:
+            with open(path) as f:
+                content = f.read()
+        except OSError:
+            content = None
+        if content == expected:
+            authz['status'] = 'valid'
+        else:
+            authz['status'] = 'invalid'
+            authz['error'] = {'type': 'urn:ietf:params:acme:error:unauthorized',
+                              'detail': f"{path} 的内容不正确: {content!r}"}
+        return 200, {'type': 'http-01', 'status': 'processing', 'token': authz['token']}, {}
+
+    def finalize(self, order, payload):
+        csr = x509.load_der_x509_csr(b64decode(payload['csr']))
+        names = csr.extensions.get_extension_for_class(x509.SubjectAlternativeName).value.get_values_for_type(x509.DNSName)
+        if sorted(names) != sorted(order['domains']) or self.order_json(order)['status'] != 'ready':
+            raise AcmeProblem('badCSR', 'CSR 与订单不符或订单未就绪', 403)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (x509.CertificateBuilder().subject_name(csr.subject).issuer_name(self.root.subject)
+                .public_key(csr.public_key()).serial_number(x509.random_serial_number())
+                .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=90))
+                .add_extension(x509.SubjectAlternativeName([x509.DNSName(n) for n in names]), critical=False)
+                .sign(self.key, hashes.SHA256()))
+        pem = lambda c: c.public_bytes(serialization.Encoding.PEM).decode()  # noqa: E731
+        with self.lock:
+            self.certs[order['id']] = pem(cert) + pem(self.root)
+            self.issued.append(cert)
+            order['status'] = 'valid'
+        return 200, self.order_json(order), {}
+
+
+class AcmeProblem(Exception):
+    def __init__(self, kind, detail, status=400):
+        super().__init__(detail)
+        self.kind = kind
+        self.status = status
+
+
+SITES = ['alpha.io', 'beta.io', 'gamma.io']
+
+
+@pytest.fixture
+def sites(tmp_path, nginx_tree):
+    """每个站点一个带 root 的 server 块，返回 域名 -> root"""
+    roots = {}
+    for name in SITES:
+        roots[name] = str(tmp_path / 'www' / name)
+        os.makedirs(roots[name])
+        nginx_tree(f"{name}.conf", server_block(name, root=roots[name]))
+    return roots
+
+
+@pytest.fixture
+def mock_ca(sites):
+    cas = []
+
+    def start(webroots=None, concurrent_orders=1):
+        ca = MockCA(sites if webroots is None else webroots, concurrent_orders)
+        cas.append(ca)
+        return ca
+
+    yield start
+    for ca in cas:
+        ca.close()
+
+
+def builtin_bot(make_bot, ca, **overrides):
+    return make_bot(acme={'client': 'builtin', 'directory': f"{ca.url}/directory", 'poll_interval': 0.01,
+                          'workers': 4}, certbot=dict(overrides.pop('certbot', {}), group_by='none'), **overrides)
+
+
+def test_issue_and_lineage_layout(make_bot, stub_bin, mock_ca, sites, nginx_tree, tmp_path):
+    ca = mock_ca()
+    bot = builtin_bot(make_bot, ca)
+    assert bot.scan_and_apply() == len(SITES)
+    # 不启动 certbot
+    assert stub_bin() == []
+    assert len(ca.issued) == len(SITES)
+
+    config_dir = tmp_path / 'letsencrypt'
+    for name in SITES:
+        live = config_dir / 'live' / name
+        for kind in ('cert', 'chain', 'fullchain', 'privkey'):
+            assert os.readlink(live / f"{kind}.pem") == f"../../archive/{name}/{kind}1.pem"
+        assert oct((config_dir / 'archive' / name / 'privkey1.pem').stat().st_mode & 0o777) == '0o600'
+        cert = x509.load_pem_x509_certificate((live / 'cert.pem').read_bytes())
+        assert cert.issuer == ca.root.subject
+        assert (live / 'fullchain.pem').read_text() == (live / 'cert.pem').read_text() + (live / 'chain.pem').read_text()
+
+        renewal = (config_dir / 'renewal' / f"{name}.conf").read_text()
+        assert f"archive_dir = {config_dir / 'archive' / name}" in renewal
+        assert f"server = {ca.url}/directory" in renewal
+        assert f"[[webroot_map]]\n{name} = {sites[name]}" in renewal
+        # 验证文件用完即删
+        assert os.listdir(os.path.join(sites[name], '.well-known', 'acme-challenge')) == []
+
+        site = (tmp_path / 'nginx' / 'sites-enabled' / f"{name}.conf").read_text()
+        assert f"ssl_certificate {live / 'fullchain.pem'};" in site
+
+    # 证书清单按 certbot 的目录结构读取
+    lineages = bot.ssl_manager.inventory.lineages()
+    assert sorted(lineages) == SITES
+    assert lineages['alpha.io']['domains'] == ['alpha.io']
+
+
+def test_account_key_is_reused(make_bot, stub_bin, mock_ca, sites, nginx_tree, tmp_path):
+    ca = mock_ca()
+    builtin_bot(make_bot, ca).scan_and_apply()
+    account_files = list((tmp_path / 'state' / 'acme').glob('*/account.json'))
+    assert len(account_files) == 1
+    assert oct(account_files[0].stat().st_mode & 0o777) == '0o600'
+
+    # 新的进程（新的 SSLBot）使用保存的账户，不再注册
+    nginx_tree('delta.conf', server_block('delta.io', root=sites['alpha.io']))
+    ca.webroots['delta.io'] = sites['alpha.io']
+    assert builtin_bot(make_bot, ca).scan_and_apply() == 1
+    assert ca.registrations == 1
+    assert len(ca.accounts) == 1
+    assert len(ca.issued) == len(SITES) + 1
+
+
+def test_concurrent_orders(make_bot, stub_bin, mock_ca, sites):
+    # 模拟 CA 要求三个订单同时存在才返回，串行下单会在 10 秒后失败
+    ca = mock_ca(concurrent_orders=len(SITES))
+    assert builtin_bot(make_bot, ca).scan_and_apply() == len(SITES)
+    assert not ca.barrier.broken
+
+
+def test_renewal(make_bot, stub_bin, mock_ca, sites, tmp_path):
+    ca = mock_ca()
+    bot = builtin_bot(make_bot, ca)
+    bot.scan_and_apply()
+    live = tmp_path / 'letsencrypt' / 'live' / 'alpha.io'
+    first = x509.load_pem_x509_certificate((live / 'cert.pem').read_bytes())
+    site = (tmp_path / 'nginx' / 'sites-enabled' / 'alpha.io.conf').read_text()
+
+    # 续签使用 renewal 配置中的 webroot_map，live/ 下的链接指向新版本，Nginx 配置不变
+    assert bot.ssl_manager.renew_lineage('alpha.io')
+    for kind in ('cert', 'chain', 'fullchain', 'privkey'):
+        assert os.readlink(live / f"{kind}.pem") == f"../../archive/alpha.io/{kind}2.pem"
+    second = x509.load_pem_x509_certificate((live / 'cert.pem').read_bytes())
+    assert second.serial_number != first.serial_number
+    assert (tmp_path / 'letsencrypt' / 'archive' / 'alpha.io' / 'cert1.pem').exists()
+    assert (tmp_path / 'nginx' / 'sites-enabled' / 'alpha.io.conf').read_text() == site
+    assert ca.registrations == 1
+
+
+def test_block_without_root_requires_shared_challenge(make_bot, stub_bin, mock_ca, sites, nginx_tree, tmp_path):
+    nginx_tree('proxy.conf', server_block('proxy.io'))
+    ca = mock_ca(webroots=dict(sites, **{'proxy.io': str(tmp_path / 'challenge')}))
+    bot = builtin_bot(make_bot, ca)
+    assert bot.scan_and_apply() == len(SITES)
+    # 没有 root 指令的块不向 CA 下单，记入失败缓存（永久性错误）
+    assert all('proxy.io' not in order['domains'] for order in ca.orders.values())
+    [(domain_set, count, permanent, retry_at, error)] = bot.store.failures()
+    assert (domain_set, permanent) == ('proxy.io', 1)
+    assert 'challenge.mode: shared' in error
+
+    # 启用共用验证目录后验证文件写入 challenge.webroot
+    bot = builtin_bot(make_bot, ca, challenge={'mode': 'shared', 'webroot': str(tmp_path / 'challenge')})
+    bot.store.clear_failures([['proxy.io']])
+    assert bot.scan_and_apply() == 1
+    assert (tmp_path / 'letsencrypt' / 'live' / 'proxy.io' / 'cert.pem').exists()
@@ -0,0 +1,81 @@
+"""守护进程：轮询或 inotify 通知后只重新解析变化的文件"""
+
+import os
+import signal
+
+import pytest
+
+import ssl_bot
+
+from conftest import server_block
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """记录实际读取解析的配置文件（文件名）"""
+    files = []
+    read = ssl_bot.NginxConfigParser._read_config_file
+
+    def counting(self, config_file):
+        files.append(os.path.basename(config_file))
+        return read(self, config_file)
+
+    monkeypatch.setattr(ssl_bot.NginxConfigParser, '_read_config_file', counting)
+    return files
+
+
+@pytest.fixture
+def handlers(monkeypatch):
+    """记录守护进程注册的信号处理函数（不替换测试进程的信号处理）"""
+    registered = {}
+    monkeypatch.setattr(ssl_bot.signal, 'signal', lambda signum, handler: registered.__setitem__(signum, handler))
+    return registered
+
+
+def test_polling_reparses_only_new_file(make_bot, stub_bin, nginx_tree, parsed, handlers, monkeypatch):
+    nginx_tree('a.conf', server_block('a.example.com'))
+    nginx_tree('b.conf', server_block('b.example.com'))
+    reads = []
+
+    class ScriptedWatcher(ssl_bot.PollingWatcher):
+        """第一次等待时写入新站点，第二次等待时发送 SIGTERM"""
+
+        def read(self, timeout):
+            reads.append(list(parsed))
+            parsed.clear()
+            if len(reads) == 1:
+                nginx_tree('c.conf', server_block('c.example.com'))
+            else:
+                handlers[signal.SIGTERM](signal.SIGTERM, None)
+            return super().read(timeout)
+
+    def no_inotify():
+        raise OSError('inotify 不可用')
+
+    monkeypatch.setattr(ssl_bot, 'InotifyWatcher', no_inotify)
+    monkeypatch.setattr(ssl_bot, 'PollingWatcher', ScriptedWatcher)
+    bot = make_bot(daemon={'debounce': 0, 'poll_interval': 0})
+    bot.run_daemon()
+
+    # 启动时的全量扫描解析所有文件；轮询触发的全量校验只解析新文件，之后没有变化
+    first, second = reads
+    assert sorted(first) == ['a.conf', 'b.conf', 'nginx.conf']
+    assert second == ['c.conf']
+    assert parsed == []
+    # 新站点在轮询后申请证书（桩程序不生成证书，已有站点也会再次申请）
+    assert 'c.example.com' in [args[args.index('-d') + 1] for args in stub_bin()]
+
+
+def test_changed_paths_reparse_only_those_files(make_bot, stub_bin, nginx_tree, parsed):
+    nginx_tree('a.conf', server_block('a.example.com'))
+    nginx_tree('b.conf', server_block('b.example.com'))
+    bot = make_bot()
+    bot.scan_and_apply()
+    parsed.clear()
+
+    # inotify 报告的路径：只有该文件被重新校验和解析
+    path = os.path.join(nginx_tree.root, 'sites-enabled', 'b.conf')
+    nginx_tree('b.conf', server_block('b.example.com', 'www.b.example.com'))
+    bot._apply_changes({path}, False)
+    assert parsed == ['b.conf']
+    assert stub_bin()[-1].count('-d') == 2
@@ -0,0 +1,191 @@
+"""RFC 2136 DNS 后端：用本地 TCP DNS UPDATE 桩服务器检查 TSIG 签名和 TXT 记录的增删"""
+
+import hmac
+import time
+import base64
+import socket
+import struct
+import threading
+
+import pytest
+
+import ssl_bot
+
+KEY_NAME = 'ssl-bot.'
+SECRET = base64.b64encode(b'0123456789abcdef0123456789abcdef').decode()
+# TSIG 算法的 DNS 名称 -> hashlib 名称
+ALGORITHMS = {name: digest for name, digest in ssl_bot.Rfc2136Backend.TSIG_ALGORITHMS.values()}
+NOERROR, REFUSED, NOTAUTH, NOTZONE = 0, 5, 9, 10
+
+
+def read_name(data: bytes, offset: int):
+    labels = []
+    while data[offset]:
+        labels.append(data[offset + 1:offset + 1 + data[offset]].decode().lower())
+        offset += data[offset] + 1
+    return '.'.join(labels), offset + 1
+
+
+def read_record(data: bytes, offset: int):
+    name, offset = read_name(data, offset)
+    rtype, rclass, ttl, rdlength = struct.unpack('!HHIH', data[offset:offset + 10])
+    offset += 10
+    return (name, rtype, rclass, ttl, data[offset:offset + rdlength]), offset + rdlength
+
+
+class UpdateServer:
+    """只接受 TSIG 签名的 UPDATE 报文的权威服务器，TXT 记录保存在 records 中"""
+
+    def __init__(self, zones, key_name=KEY_NAME, secret=SECRET):
+        self.zones = zones
+        self.key_name = key_name.rstrip('.')
+        self.secret = base64.b64decode(secret)
+        self.records = {}
+        self.sock = socket.create_server(('127.0.0.1', 0))
+        self.sock.settimeout(0.1)
+        self.stop = threading.Event()
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while not self.stop.is_set():
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(5)
+            with conn:
+                length = struct.unpack('!H', conn.recv(2, socket.MSG_WAITALL))[0]
+                message = conn.recv(length, socket.MSG_WAITALL)
+                response = struct.pack('!HHHHHH', struct.unpack('!H', message[:2])[0],
+                                       0x8000 | (5 << 11) | self.handle(message), 0, 0, 0, 0)
+                conn.sendall(struct.pack('!H', len(response)) + response)
+
+    def handle(self, message: bytes) -> int:
+        message_id, flags, zocount, prcount, upcount, adcount = struct.unpack('!HHHHHH', message[:12])
+        assert (flags >> 11) & 0xF == 5 and zocount == 1
+        zone, offset = read_name(message, 12)
+        assert struct.unpack('!HH', message[offset:offset + 4]) == (6, 1)
+        offset += 4
+        updates = []
+        for _ in range(prcount + upcount):
+            record, offset = read_record(message, offset)
+            updates.append(record)
+        if adcount != 1:
+            return REFUSED
+        tsig_start = offset
+        (key_name, rtype, rclass, ttl, rdata), _ = read_record(message, offset)
+        if rtype != 250 or key_name != self.key_name:
+            return NOTAUTH
+        if not self.verify(message[:10] + struct.pack('!H', adcount - 1) + message[12:tsig_start],
+                           message[tsig_start:], message_id):
+            return NOTAUTH
+        if zone not in self.zones:
+            return NOTAUTH
+
+        for name, rtype, rclass, ttl, rdata in updates:
+            if rtype != 16 or not (name == zone or name.endswith('.' + zone)):
+                return NOTZONE
+        for name, rtype, rclass, ttl, rdata in updates:
+            value = rdata[1:1 + rdata[0]].decode()
+            if rclass == 1:
+                self.records.setdefault(name, set()).add(value)
+            elif rclass == 254:
+                self.records.get(name, set()).discard(value)
+                if not self.records.get(name):
+                    self.records.pop(name, None)
+        return NOERROR
+
+    def verify(self, unsigned: bytes, record: bytes, message_id: int) -> bool:
+        """按 RFC 8945 4.3 重新计算 MAC 并检查时间和原始 ID"""
+        key_name, offset = read_name(record, 0)
+        offset += 10  # type、class、TTL、rdlength
+        algorithm, offset = read_name(record, offset)
+        high, low, fudge, mac_size = struct.unpack('!HIHH', record[offset:offset + 10])
+        time_signed = (high << 32) | low
+        mac = record[offset + 10:offset + 10 + mac_size]
+        original_id, error, other = struct.unpack('!HHH', record[offset + 10 + mac_size:offset + 16 + mac_size])
+        variables = (ssl_bot._dns_wire_name(key_name) + struct.pack('!HI', 255, 0)
+                     + ssl_bot._dns_wire_name(algorithm) + record[offset:offset + 8] + struct.pack('!HH', error, 0))
+        expected = hmac.new(self.secret, unsigned + variables, ALGORITHMS[algorithm]).digest()
+        return (hmac.compare_digest(mac, expected) and original_id == message_id and other == 0
+                and abs(time.time() - time_signed) <= fudge)
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.sock.close()
+
+
+@pytest.fixture
+def dns_server():
+    server = UpdateServer({'example.com', 'dev.example.com'})
+    yield server
+    server.close()
+
+
+def backend(server, **kwargs):
+    config = {'server': '127.0.0.1', 'port': server.port, 'zones': ['example.com', 'dev.example.com'],
+              'tsig_key_name': KEY_NAME, 'tsig_secret': SECRET, **kwargs}
+    return ssl_bot.Rfc2136Backend.from_config(config)
+
+
+@pytest.mark.parametrize('algorithm', ['hmac-sha256', 'hmac-sha512', 'hmac-md5'])
+def test_add_and_remove_txt(dns_server, algorithm):
+    dns = backend(dns_server, tsig_algorithm=algorithm)
+    # 通配符证书和区域本身的验证值在同一名称下，添加时不能互相覆盖
+    dns.add_txt('example.com', 'first')
+    dns.add_txt('example.com', 'second')
+    assert dns_server.records == {'_acme-challenge.example.com': {'first', 'second'}}
+
+    dns.remove_txt('example.com', 'first')
+    assert dns_server.records == {'_acme-challenge.example.com': {'second'}}
+    dns.remove_txt('example.com', 'second')
+    assert dns_server.records == {}
+
+
+def test_longest_matching_zone(dns_server, monkeypatch):
+    dns = backend(dns_server)
+    zones = []
+    handle = dns_server.handle
+    monkeypatch.setattr(dns_server, 'handle', lambda message: zones.append(read_name(message, 12)[0])
+                        or handle(message))
+    dns.add_txt('api.dev.example.com', 'token')
+    assert zones == ['dev.example.com']
+    assert dns_server.records == {'_acme-challenge.api.dev.example.com': {'token'}}
+
+
+def test_key_file(dns_server, tmp_path):
+    key_file = tmp_path / 'ssl-bot.key'
+    key_file.write_text(f'key "{KEY_NAME}" {{\n\talgorithm hmac-sha256;\n\tsecret "{SECRET}";\n}};\n')
+    backend(dns_server, tsig_key_name=None, tsig_secret=None, tsig_key_file=str(key_file)).add_txt('example.com', 'v')
+    assert dns_server.records == {'_acme-challenge.example.com': {'v'}}
+
+
+@pytest.mark.parametrize('overrides, rcode', [
+    ({'tsig_secret': base64.b64encode(b'wrong').decode()}, 'NOTAUTH'),
+    ({'tsig_key_name': 'other.'}, 'NOTAUTH'),
+    ({'tsig_key_name': None, 'tsig_secret': None}, 'REFUSED'),
+])
+def test_rejected_update(dns_server, overrides, rcode):
+    with pytest.raises(ssl_bot.DnsUpdateError, match=rcode):
+        backend(dns_server, **overrides).add_txt('example.com', 'token')
+    assert dns_server.records == {}
+
+
+def test_unknown_zone(dns_server):
+    with pytest.raises(ssl_bot.DnsUpdateError, match='NOTAUTH.*example.org'):
+        backend(dns_server).add_txt('www.example.org', 'token')
+
+
+def test_backend_must_implement_both_methods():
+    with pytest.raises(TypeError):
+        ssl_bot.DnsBackend()
+
+    class AddOnly(ssl_bot.DnsBackend):
+        def add_txt(self, domain, value):
+            pass
+
+    with pytest.raises(TypeError):
+        AddOnly()
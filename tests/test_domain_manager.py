@@ -0,0 +1,64 @@
+"""批量添加域名：nginx -t 失败时撤销本次写入的站点和新建的网站目录"""
+
+import os
+
+import pytest
+
+import ssl_bot
+
+
+@pytest.fixture
+def manager(make_bot, stub_bin, nginx_tree, tmp_path):
+    os.makedirs(os.path.join(nginx_tree.root, 'sites-available'))
+    # chown www-data 需要 root 权限，用桩程序代替
+    for name in ('chown', 'chmod'):
+        path = tmp_path / 'bin' / name
+        path.write_text('#!/bin/sh\nexit 0\n')
+        path.chmod(0o755)
+    bot = make_bot()
+    return ssl_bot.DomainManager(bot.config, bot.nginx_parser, bot.reload_coordinator, bot.store)
+
+
+def fail_nginx_test(tmp_path):
+    (tmp_path / 'bin' / 'nginx').write_text('#!/bin/sh\n[ "$1" = "-t" ] && exit 1\nexit 0\n')
+
+
+def entries(tmp_path):
+    return [
+        {'domain': 'a.example.com', 'webroot': str(tmp_path / 'www' / 'a.example.com' / 'html')},
+        {'domain': 'b.example.com', 'service_type': 'php', 'webroot': str(tmp_path / 'www' / 'b.example.com' / 'html')},
+        {'domain': 'c.example.com', 'service_type': 'proxy', 'backend_url': 'http://127.0.0.1:9000'},
+        # 已存在的网站目录：回滚时保留
+        {'domain': 'd.example.com', 'webroot': str(tmp_path / 'shared' / 'html')},
+    ]
+
+
+def test_rollback_when_nginx_test_fails(manager, nginx_tree, tmp_path):
+    (tmp_path / 'shared' / 'html').mkdir(parents=True)
+    (tmp_path / 'shared' / 'html' / 'keep.txt').write_text('keep')
+    (tmp_path / 'www').mkdir()
+    # 批量添加前已有的站点不受影响
+    existing = os.path.join(nginx_tree.root, 'sites-available', 'old.example.com')
+    with open(existing, 'w') as f:
+        f.write(ssl_bot.DomainManager({}, manager.nginx_parser).render_site_config('old.example.com', 'proxy'))
+    fail_nginx_test(tmp_path)
+
+    assert manager.add_domains(entries(tmp_path) + [{'domain': 'old.example.com'}]) is None
+    assert os.listdir(os.path.join(nginx_tree.root, 'sites-available')) == ['old.example.com']
+    assert os.listdir(os.path.join(nginx_tree.root, 'sites-enabled')) == []
+    assert os.listdir(tmp_path / 'www') == []
+    assert sorted(os.listdir(tmp_path / 'shared' / 'html')) == ['index.html', 'keep.txt']
+
+
+def test_add_domains(manager, nginx_tree, tmp_path):
+    written = manager.add_domains(entries(tmp_path))
+    sites_available = os.path.join(nginx_tree.root, 'sites-available')
+    assert sorted(written) == [os.path.realpath(os.path.join(sites_available, f"{name}.example.com"))
+                               for name in 'abcd']
+    for name in 'abcd':
+        link = os.path.join(nginx_tree.root, 'sites-enabled', f"{name}.example.com")
+        assert os.readlink(link) == os.path.join(sites_available, f"{name}.example.com")
+    assert (tmp_path / 'www' / 'a.example.com' / 'html' / 'index.html').exists()
+
+    # 已有配置的域名跳过
+    assert manager.add_domains(entries(tmp_path)[:1]) == []
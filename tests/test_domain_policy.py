@@ -0,0 +1,141 @@
+"""公共后缀列表的规则处理和排除列表的前缀树正则"""
+
+import os
+import random
+
+import pytest
+
+import ssl_bot
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RULES = """
+// ===BEGIN ICANN DOMAINS===
+com
+uk
+co.uk
+jp
+kawasaki.jp
+*.kawasaki.jp
+!city.kawasaki.jp
+cn
+公司.cn
+// ===BEGIN PRIVATE DOMAINS===
+io
+github.io
+"""
+
+
+@pytest.fixture(scope='module', params=['inline', 'snapshot'])
+def psl(request):
+    """规则表中的几条规则，以及随 ssl-bot 发布的完整快照"""
+    if request.param == 'inline':
+        return ssl_bot.PublicSuffixList.parse(RULES.splitlines())
+    return ssl_bot.PublicSuffixList.load(os.path.join(ROOT, 'public_suffix_list.dat'))
+
+
+@pytest.mark.parametrize('domain, suffix, registered', [
+    ('www.example.com', 'com', 'example.com'),
+    ('example.com', 'com', 'example.com'),
+    ('a.b.example.co.uk', 'co.uk', 'example.co.uk'),
+    ('co.uk', 'co.uk', None),
+    # 通配规则 *.kawasaki.jp：kawasaki.jp 下的每个二级名称都是公共后缀
+    ('www.foo.kawasaki.jp', 'foo.kawasaki.jp', 'www.foo.kawasaki.jp'),
+    ('foo.kawasaki.jp', 'foo.kawasaki.jp', None),
+    # 例外规则 !city.kawasaki.jp：city.kawasaki.jp 本身可以注册
+    ('city.kawasaki.jp', 'kawasaki.jp', 'city.kawasaki.jp'),
+    ('www.city.kawasaki.jp', 'kawasaki.jp', 'city.kawasaki.jp'),
+    # 私有域名 github.io：每个用户的子域名是独立的注册域
+    ('alice.github.io', 'github.io', 'alice.github.io'),
+    ('docs.alice.github.io', 'github.io', 'alice.github.io'),
+    ('github.io', 'github.io', None),
+    # 国际化域名规则同时匹配 Unicode 和 Punycode
+    ('shop.example.公司.cn', '公司.cn', 'example.公司.cn'),
+    ('shop.example.xn--55qx5d.cn', 'xn--55qx5d.cn', 'example.xn--55qx5d.cn'),
+    ('WWW.Example.COM.', 'com', 'example.com'),
+])
+def test_public_suffix(psl, domain, suffix, registered):
+    assert psl.public_suffix(domain) == suffix
+    assert psl.registered_domain(domain) == registered
+
+
+def test_unknown_tld_uses_default_rule():
+    psl = ssl_bot.PublicSuffixList.parse(RULES.splitlines())
+    assert psl.public_suffix('www.example.internal') == 'internal'
+    assert psl.registered_domain('www.example.internal') == 'example.internal'
+    # 域名本身是公共后缀时，模块级的 registered_domain 返回域名本身
+    assert ssl_bot.registered_domain('github.io', psl) == 'github.io'
+
+
+EXCLUDE = ['test', 'staging.', 'tenant1.', 'tenant2.', 'te', 'dev-', '*.corp.com', '.vpn.net', 'a.b']
+
+
+@pytest.mark.parametrize('domain, excluded', [
+    # 普通条目按子串匹配（与原来的 any(ex in domain ...) 一致）
+    ('test.example.com', True),
+    ('latest.example.com', True),
+    ('staging.example.com', True),
+    ('mystaging.example.com', True),
+    ('staging-x.example.com', False),
+    ('tenant1.example.com', True),
+    ('tenant3.example.com', True),  # 子串 te
+    ('dev-api.example.com', True),
+    ('dev.example.com', False),
+    ('a.b.example.com', True),
+    ('axb.example.com', False),  # 条目中的 . 是字面量
+    ('shop.example.com', False),
+    ('SHOP.TEST.COM', True),
+    # *. 和 . 开头的条目只匹配子域名，不匹配域名本身
+    ('corp.com', False),
+    ('www.corp.com', True),
+    ('a.b.corp.com', True),
+    ('mycorp.com', False),
+    ('corp.com.evil.org', False),
+    ('vpn.net', False),
+    ('db.vpn.net', True),
+])
+def test_exclude(domain, excluded):
+    assert ssl_bot.DomainPolicy(EXCLUDE).is_excluded(domain) is excluded
+
+
+def test_trie_matches_substring_check():
+    """前缀树正则与逐条比较的结果一致：普通条目为子串，*. 和 . 开头的条目为子域名后缀"""
+    rng = random.Random(0)
+    alphabet = 'abet.-1'
+
+    def word(low, high):
+        return ''.join(rng.choice(alphabet) for _ in range(rng.randint(low, high)))
+
+    for _ in range(300):
+        # 以 . 开头的条目是后缀条目，随机生成的子串条目不以 . 开头
+        substrings = {word(1, 5).lstrip('.') for _ in range(rng.randint(0, 8))} - {''}
+        suffixes = {word(1, 4).strip('.') for _ in range(rng.randint(0, 3))} - {''}
+        entries = list(substrings) + [rng.choice(['*.', '.']) + suffix for suffix in suffixes]
+        policy = ssl_bot.DomainPolicy(entries)
+        for _ in range(50):
+            domain = word(1, 12)
+            expected = (any(entry in domain for entry in substrings)
+                        or any(domain.endswith('.' + suffix) for suffix in suffixes))
+            assert policy.is_excluded(domain) == expected, (entries, domain)
+
+
+def test_trie_pattern_shape():
+    pattern = ssl_bot.DomainPolicy._trie_pattern(['test.', 'tenant1.', 'tenant2.'])
+    assert pattern == r'(?:te(?:nant(?:1\.|2\.)|st\.))'
+
+
+@pytest.mark.parametrize('domain, verdict', [
+    ('www.test.io', ssl_bot.DomainPolicy.EXCLUDED),
+    ('example.com', ssl_bot.DomainPolicy.INVALID),
+    ('printer.local', ssl_bot.DomainPolicy.INVALID),
+    ('under_score.io', ssl_bot.DomainPolicy.INVALID),
+    ('shop.alpha.io', ssl_bot.DomainPolicy.ALLOWED),
+])
+def test_classify(domain, verdict):
+    assert ssl_bot.DomainPolicy(['test']).classify(domain) == verdict
+
+
+def test_empty_exclude_list():
+    policy = ssl_bot.DomainPolicy([])
+    assert not policy.is_excluded('anything.example.com')
+    assert policy.classify('shop.alpha.io') == ssl_bot.DomainPolicy.ALLOWED
@@ -0,0 +1,156 @@
+"""失败缓存：certbot 错误分类、指数退避和 --retry-failed"""
+
+import os
+import sys
+import textwrap
+import subprocess
+
+import pytest
+
+import ssl_bot
+
+from conftest import server_block
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+UNAUTHORIZED = textwrap.dedent("""\
+    Saving debug log to /var/log/letsencrypt/letsencrypt.log
+    Requesting a certificate for a.example.com and b.example.com
+
+    Certbot failed to authenticate some domains (authenticator: nginx). The Certificate Authority reported these problems:
+      Domain: b.example.com
+      Type:   unauthorized
+      Detail: 203.0.113.7: Invalid response from http://b.example.com/.well-known/acme-challenge/abc: 404
+
+    Hint: The Certificate Authority failed to verify the temporary nginx configuration changes made by Certbot.
+""")
+
+DNS_PROBLEM = textwrap.dedent("""\
+    Certbot failed to authenticate some domains (authenticator: nginx). The Certificate Authority reported these problems:
+      Domain: gone.example.com
+      Type:   dns
+      Detail: DNS problem: NXDOMAIN looking up A for gone.example.com - check that a DNS record exists for this domain
+
+      Domain: other.example.com
+      Type:   dns
+      Detail: no valid A records found for other.example.com; no valid AAAA records found for other.example.com
+""")
+
+RATE_LIMITED = textwrap.dedent("""\
+    An unexpected error occurred:
+    Error creating new order :: too many certificates (5) already issued for this exact set of domains in the last
+    168h0m0s, retry after 2026-10-20T00:00:00Z: see https://letsencrypt.org/docs/rate-limits/#new-certificates-per-exact-set-of-hostnames
+""")
+
+
+@pytest.mark.parametrize('error, permanent, domains', [
+    (UNAUTHORIZED, True, {'b.example.com'}),
+    (DNS_PROBLEM, True, {'gone.example.com', 'other.example.com'}),
+    ('Domain: c.example.com\n  Type:   caa\n  Detail: CAA record for c.example.com prevents issuance', True,
+     {'c.example.com'}),
+    ('Error creating new order :: Cannot issue for "x.local": Domain name does not end with a valid public suffix '
+     '(TLD) :: rejectedIdentifier', True, set()),
+    (RATE_LIMITED, False, set()),
+    ('urn:ietf:params:acme:error:rateLimited: too many failed authorizations recently', False, set()),
+    ('Another instance of Certbot is already running.', False, set()),
+    ('The service is down for maintenance or had an internal error. :: serverInternal', False, set()),
+    ('申请超时', False, set()),
+    ('', False, set()),
+    (None, False, set()),
+])
+def test_classify_certbot_error(error, permanent, domains):
+    assert ssl_bot.classify_certbot_error(error) == (permanent, domains)
+
+
+def test_backoff_growth_and_cap(tmp_path, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(ssl_bot.time, 'time', lambda: now[0])
+    store = ssl_bot.StateStore(str(tmp_path / 'state.db'))
+
+    delays = []
+    for _ in range(7):
+        delays.append(store.record_failures([['a.example.com', 'www.a.example.com']], False, 'boom', 60, 1000) - now[0])
+    # base * 2^(n-1)，不超过 cap
+    assert delays == [60, 120, 240, 480, 960, 1000, 1000]
+    [(domain_set, count, permanent, retry_at, error)] = store.failures()
+    assert (domain_set, count, permanent, retry_at, error) == ('a.example.com,www.a.example.com', 7, 0, now[0] + 1000,
+                                                               'boom')
+    # 域名组合与顺序无关
+    assert store.retry_at(['www.a.example.com', 'a.example.com']) == now[0] + 1000
+
+    # 多个组合一起记录时返回最早的重试时间；成功后清除记录
+    earliest = store.record_failures([['a.example.com', 'www.a.example.com'], ['b.example.com']], True, 'x', 60, 1000)
+    assert earliest == now[0] + 60
+    store.clear_failures([['a.example.com', 'www.a.example.com']])
+    assert [row[0] for row in store.failures()] == ['b.example.com']
+    assert store.retry_at(['a.example.com', 'www.a.example.com']) is None
+
+
+# 参数中包含 FAIL_DOMAIN 时输出 FAIL_OUTPUT 并失败退出，其他情况与 conftest 的 certbot 桩程序相同
+FAILING_CERTBOT = '''#!{python}
+import os, sys, json
+with open({log!r}, 'a') as f:
+    f.write(json.dumps(sys.argv[1:]) + '\\n')
+if os.environ.get('FAIL_DOMAIN') in sys.argv:
+    sys.stderr.write(os.environ['FAIL_OUTPUT'])
+    sys.exit(1)
+'''
+
+
+@pytest.fixture
+def failing_certbot(stub_bin, tmp_path, monkeypatch):
+    with open(stub_bin.certbot, 'w') as f:
+        f.write(FAILING_CERTBOT.format(python=sys.executable, log=str(tmp_path / 'certbot.log')))
+    monkeypatch.setenv('FAIL_DOMAIN', 'b.example.com')
+    monkeypatch.setenv('FAIL_OUTPUT', UNAUTHORIZED)
+    return stub_bin
+
+
+def requested(calls):
+    return [sorted(args[i + 1] for i, arg in enumerate(args) if arg == '-d') for args in calls]
+
+
+def test_only_failed_blocks_back_off(make_bot, failing_certbot, nginx_tree, monkeypatch):
+    nginx_tree('site.conf', server_block('a.example.com') + server_block('b.example.com'))
+    bot = make_bot(certbot={'failure_backoff': {'permanent_base': 3600, 'cap': 86400}})
+    assert bot.scan_and_apply() == 0
+    assert requested(failing_certbot()) == [['a.example.com', 'b.example.com']]
+
+    # certbot 指明了验证失败的域名：只有 b 的 server 块进入退避（永久性错误，从 permanent_base 开始）
+    [(domain_set, count, permanent, retry_at, error)] = bot.store.failures()
+    assert (domain_set, count, permanent) == ('b.example.com', 1, 1)
+    assert 'Invalid response' in error
+
+    # 下次运行 a 单独申请，b 仍在退避期
+    monkeypatch.delenv('FAIL_DOMAIN')
+    bot = make_bot()
+    assert bot.scan_and_apply() == 1
+    assert requested(failing_certbot())[1:] == [['a.example.com']]
+
+
+def test_retry_failed(make_bot, failing_certbot, nginx_tree, monkeypatch):
+    nginx_tree('site.conf', server_block('b.example.com'))
+    bot = make_bot()
+    bot.scan_and_apply()
+    assert len(failing_certbot()) == 1
+    monkeypatch.delenv('FAIL_DOMAIN')
+
+    make_bot().scan_and_apply()
+    assert len(failing_certbot()) == 1
+
+    # --retry-failed 忽略退避；申请成功后清除失败记录
+    subprocess.run([sys.executable, os.path.join(ROOT, 'ssl_bot.py'), '--config', bot.config_path,
+                    '--scan-and-apply', '--retry-failed'], check=True, capture_output=True)
+    assert requested(failing_certbot()) == [['b.example.com'], ['b.example.com']]
+    assert make_bot().store.failures() == []
+
+
+def test_retryable_failure_uses_base(make_bot, failing_certbot, nginx_tree, monkeypatch):
+    monkeypatch.setenv('FAIL_OUTPUT', RATE_LIMITED)
+    nginx_tree('site.conf', server_block('b.example.com'))
+    bot = make_bot(certbot={'failure_backoff': {'base': 600, 'permanent_base': 86400}})
+    before = ssl_bot.time.time()
+    bot.scan_and_apply()
+    [(domain_set, count, permanent, retry_at, error)] = bot.store.failures()
+    assert (domain_set, permanent) == ('b.example.com', 0)
+    assert before + 600 <= retry_at <= ssl_bot.time.time() + 600
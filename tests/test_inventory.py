@@ -0,0 +1,157 @@
+"""证书清单：用 cryptography 生成的证书检查 DER 解析，以及按 stat 失效的解析缓存"""
+
+import os
+import time
+import calendar
+import datetime
+
+import pytest
+
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import ssl_bot
+
+KEY = ec.generate_private_key(ec.SECP256R1())
+
+
+def make_cert(domains, not_before=datetime.datetime(2024, 1, 2, 3, 4, 5),
+              not_after=datetime.datetime(2024, 4, 1, 12, 0, 0), common_name='example.com') -> bytes:
+    """生成自签名证书的 PEM；domains 为 None 时不带 SAN 扩展"""
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    builder = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(KEY.public_key())
+               .serial_number(x509.random_serial_number())
+               .not_valid_before(not_before.replace(tzinfo=datetime.timezone.utc))
+               .not_valid_after(not_after.replace(tzinfo=datetime.timezone.utc))
+               .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=True))
+    if domains is not None:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(d) for d in domains]),
+                                        critical=False)
+    return builder.sign(KEY, hashes.SHA256()).public_bytes(serialization.Encoding.PEM)
+
+
+def timestamp(value: datetime.datetime) -> int:
+    return calendar.timegm(value.timetuple())
+
+
+@pytest.mark.parametrize('domains', [
+    ['example.com', 'www.example.com'],
+    ['*.example.com', 'example.com'],
+    # SAN 扩展超过 255 字节，长度使用多字节编码
+    [f"host{i}.example.com" for i in range(202)],
+])
+def test_san_domains(domains):
+    assert ssl_bot.parse_certificate(make_cert(domains))['domains'] == domains
+
+
+def test_certificate_without_san():
+    assert ssl_bot.parse_certificate(make_cert(None))['domains'] == []
+
+
+@pytest.mark.parametrize('not_before, not_after', [
+    # 2050 年之前为 UTCTime，之后为 GeneralizedTime（RFC 5280 4.1.2.5）
+    (datetime.datetime(2024, 1, 2, 3, 4, 5), datetime.datetime(2049, 12, 31, 23, 59, 59)),
+    (datetime.datetime(2049, 6, 1), datetime.datetime(2050, 1, 1, 0, 0, 1)),
+    (datetime.datetime(1999, 12, 31, 23, 0, 0), datetime.datetime(2000, 1, 1)),
+])
+def test_validity(not_before, not_after):
+    cert = ssl_bot.parse_certificate(make_cert(['example.com'], not_before, not_after))
+    assert (cert['not_before'], cert['not_after']) == (timestamp(not_before), timestamp(not_after))
+
+
+def test_first_certificate_of_chain():
+    chain = make_cert(['leaf.example.com']) + make_cert(['issuer.example.com'])
+    assert ssl_bot.parse_certificate(chain)['domains'] == ['leaf.example.com']
+
+
+def test_not_pem():
+    with pytest.raises(ValueError):
+        ssl_bot.parse_certificate(b'not a certificate')
+
+
+def write_lineage(config_dir, name, pem, renewal=None):
+    live = config_dir / 'live' / name
+    live.mkdir(parents=True, exist_ok=True)
+    (live / 'cert.pem').write_bytes(pem)
+    if renewal is not None:
+        (config_dir / 'renewal').mkdir(exist_ok=True)
+        (config_dir / 'renewal' / f"{name}.conf").write_text(renewal)
+
+
+@pytest.fixture
+def parses(monkeypatch):
+    """记录 parse_certificate 的调用次数"""
+    calls = []
+    parse = ssl_bot.parse_certificate
+
+    def counting(pem):
+        calls.append(pem)
+        return parse(pem)
+
+    monkeypatch.setattr(ssl_bot, 'parse_certificate', counting)
+    return calls
+
+
+def touch_later(path):
+    """修改 mtime（不依赖文件系统的时间精度）"""
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+
+
+def test_inventory_cache(tmp_path, parses):
+    config_dir = tmp_path / 'letsencrypt'
+    cache = str(tmp_path / 'cert-inventory.json')
+    write_lineage(config_dir, 'alpha', make_cert(['alpha.io', 'www.alpha.io']),
+                  '[renewalparams]\nauthenticator = webroot\n[[webroot_map]]\nalpha.io = /srv/alpha\n')
+    write_lineage(config_dir, 'beta', make_cert(['beta.io'], not_after=datetime.datetime(2030, 5, 6)))
+
+    lineages = ssl_bot.CertificateInventory(str(config_dir), cache).lineages()
+    assert sorted(lineages) == ['alpha', 'beta']
+    assert lineages['alpha']['domains'] == ['alpha.io', 'www.alpha.io']
+    assert lineages['alpha']['renewal'] == {'authenticator': 'webroot', 'webroot_map': {'alpha.io': '/srv/alpha'}}
+    assert lineages['alpha']['path'] == str(config_dir / 'live' / 'alpha' / 'fullchain.pem')
+    assert lineages['beta']['expiry'] == '2030-05-06 00:00:00+00:00'
+    assert lineages['beta']['renewal'] == {}
+    assert len(parses) == 2
+
+    # 新的实例从磁盘缓存读取，不再解析
+    assert ssl_bot.CertificateInventory(str(config_dir), cache).lineages() == lineages
+    assert len(parses) == 2
+
+    # 只有续签配置变化时重新读取对应的证书
+    renewal = config_dir / 'renewal' / 'alpha.conf'
+    renewal.write_text('[renewalparams]\nauthenticator = nginx\n')
+    touch_later(renewal)
+    lineages = ssl_bot.CertificateInventory(str(config_dir), cache).lineages()
+    assert lineages['alpha']['renewal'] == {'authenticator': 'nginx'}
+    assert len(parses) == 3
+
+    # 续签后 cert.pem 换成新文件（inode、大小、mtime 变化）
+    live = config_dir / 'live' / 'beta'
+    (live / 'cert.new').write_bytes(make_cert(['beta.io', 'www.beta.io']))
+    os.replace(live / 'cert.new', live / 'cert.pem')
+    inventory = ssl_bot.CertificateInventory(str(config_dir), cache)
+    assert inventory.lineages()['beta']['domains'] == ['beta.io', 'www.beta.io']
+    assert len(parses) == 4
+    # 同一实例再次读取不解析
+    inventory.lineages()
+    assert len(parses) == 4
+
+    # 删除的证书从缓存中清除
+    os.unlink(live / 'cert.pem')
+    os.rmdir(live)
+    assert sorted(ssl_bot.CertificateInventory(str(config_dir), cache).lineages()) == ['alpha']
+
+
+def test_inventory_days_left(tmp_path):
+    config_dir = tmp_path / 'letsencrypt'
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0, tzinfo=None)
+    not_after = now + datetime.timedelta(days=10, hours=1)
+    write_lineage(config_dir, 'alpha', make_cert(['alpha.io'], not_before=datetime.datetime(2024, 1, 1),
+                                                 not_after=not_after))
+    lineage = ssl_bot.CertificateInventory(str(config_dir)).lineages()['alpha']
+    assert lineage['days_left'] == 10
+    assert lineage['not_after'] == timestamp(not_after)
+    assert lineage['not_after'] > time.time()
@@ -0,0 +1,142 @@
+"""Nginx 配置的词法分析和 server 块解析"""
+
+import textwrap
+
+import pytest
+
+import ssl_bot
+
+from conftest import server_block
+
+
+def tokens(text):
+    return [(kind, value) for kind, value, _ in ssl_bot.tokenize_nginx_config(text)]
+
+
+def directives(text):
+    """[(指令名, 参数)]，块指令的子指令递归展开为 (指令名, 参数, [...])"""
+    def convert(nodes):
+        return [(d.name, d.args) if d.block is None else (d.name, d.args, convert(d.block)) for d in nodes]
+    return convert(ssl_bot.parse_nginx_config(textwrap.dedent(text)))
+
+
+def test_nested_blocks():
+    text = """
+        server {
+            server_name example.com;
+            location / {
+                if ($http_user_agent ~ bot) {
+                    return 403;
+                }
+                location /inner { root /srv; }
+            }
+        }
+    """
+    assert directives(text) == [('server', [], [
+        ('server_name', ['example.com']),
+        ('location', ['/'], [
+            ('if', ['($http_user_agent', '~', 'bot)'], [('return', ['403'])]),
+            ('location', ['/inner'], [('root', ['/srv'])]),
+        ]),
+    ])]
+    # 流式产出的 server 块包含完整的嵌套结构，偏移指向原文
+    text = textwrap.dedent(text)
+    [server] = ssl_bot.iter_server_directives(text)
+    assert text[server.start:server.end] == text.strip()
+    assert [child.name for child in server.find('location')[0].block] == ['if', 'location']
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('add_header X-Test "a b;c";', [('add_header', ['X-Test', 'a b;c'])]),
+    ("log_format main '$remote_addr {x} \"q\"';", [('log_format', ['main', '$remote_addr {x} "q"'])]),
+    (r'return 200 "say \"hi\"";', [('return', ['200', 'say "hi"'])]),
+    ('set $a "";', [('set', ['$a', ''])]),
+])
+def test_quoted_values(text, expected):
+    assert directives(text) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    # ${var} 中的花括号属于单词，不是块
+    ('root /srv/${host}/html;', [('root', ['/srv/${host}/html'])]),
+    ('proxy_pass http://${backend}:8080;', [('proxy_pass', ['http://${backend}:8080'])]),
+    # 正则量词的花括号需要加引号，否则是块
+    ('rewrite "^/(\\d{4})/$" /year/$1 last;', [('rewrite', ['^/(\\d{4})/$', '/year/$1', 'last'])]),
+    ('location ~ "^/img/[a-z]{2,3}$" { return 404; }', [('location', ['~', '^/img/[a-z]{2,3}$'],
+                                                       [('return', ['404'])])]),
+    # 转义的 ; 不结束指令
+    (r'set $x a\;b;', [('set', ['$x', r'a\;b'])]),
+])
+def test_braces_in_words(text, expected):
+    assert directives(text) == expected
+
+
+def test_comments():
+    text = """
+        # server { server_name commented.example; }
+        server {  # 行尾注释 { ;
+            server_name a.example.com; # 注释中的 "引号
+            set $hash abc#def;
+        }
+    """
+    assert directives(text) == [('server', [], [('server_name', ['a.example.com']), ('set', ['$hash', 'abc#def'])])]
+    assert ('word', 'abc#def') in tokens(text)
+
+
+def test_http_and_stream_servers():
+    text = """
+        http {
+            server { listen 80; server_name web.example.com; }
+            include sites/*;
+        }
+        stream {
+            server { listen 5432; proxy_pass db; }
+        }
+        mail {
+            server { listen 25; server_name mail.example.com; }
+        }
+    """
+    servers = list(ssl_bot.iter_server_directives(textwrap.dedent(text)))
+    assert [server.find('server_name')[0].args for server in servers] == [['web.example.com']]
+
+
+@pytest.mark.parametrize('text, message, line', [
+    ('server {\n    server_name a.example.com\n}\n', '指令缺少结尾的 ;', 3),
+    ('server_name a.example.com', '指令缺少结尾的 ;', 1),
+    ('server {\n    listen 80;\n', 'server 块缺少 }', 1),
+    ('listen 80;\n}\n', '多余的 }', 2),
+    ('{ listen 80; }', '块缺少指令名', 1),
+    ('server_name "a.example.com;\n', '未闭合的引号', 1),
+])
+def test_syntax_errors(text, message, line):
+    with pytest.raises(ssl_bot.NginxConfigSyntaxError, match=message) as error:
+        ssl_bot.parse_nginx_config(text)
+    assert error.value.line == line
+
+
+def test_parser_reads_server_blocks(nginx_tree, tmp_path):
+    nginx_tree('a.conf', """
+        server {
+            listen 80;
+            server_name a.example.com "www.a.example.com";
+            root "/srv/a site";
+            location / { try_files $uri $uri/ =404; }
+        }
+        server {
+            listen 443 ssl;
+            server_name b.example.com _ localhost ~^(?<sub>.+)\\.example\\.com$;
+        }
+    """)
+    nginx_tree('broken.conf', server_block('broken.example.com').replace(';\n}', '\n}'))
+    parser = ssl_bot.NginxConfigParser(nginx_tree.root)
+    config_files = parser.find_nginx_configs()
+    blocks = dict(zip(config_files, parser.parse_config_files(config_files)))
+
+    a, b = blocks[f"{nginx_tree.root}/sites-enabled/a.conf"]
+    assert (a['server_names'], a['root_path'], a['has_ssl'], a['listen_80']) == (
+        ['a.example.com', 'www.a.example.com'], '/srv/a site', False, True)
+    # 只保留有效域名：跳过 _、localhost 和正则
+    assert (b['server_names'], b['root_path'], b['has_ssl'], b['listen_80']) == (
+        ['b.example.com'], None, True, False)
+    # 语法错误的文件不产出 server 块
+    assert blocks[f"{nginx_tree.root}/sites-enabled/broken.conf"] == []
@@ -0,0 +1,94 @@
+"""证书规划：用 certbot 桩程序检查 --cert-name / -d 的分组"""
+
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+from conftest import server_block
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def certificates(calls):
+    """certbot 调用记录 -> [(证书名, [域名...])]"""
+    result = []
+    for args in calls:
+        domains = [args[i + 1] for i, arg in enumerate(args) if arg == '-d']
+        result.append((args[args.index('--cert-name') + 1], domains))
+    return result
+
+
+def assert_blocks_not_split(certs, blocks):
+    """每个 server 块的全部域名都在同一张证书中，且只在一张证书中"""
+    for names in blocks:
+        holders = [domains for _, domains in certs if set(names) & set(domains)]
+        assert len(holders) == 1, names
+        assert set(names) <= set(holders[0])
+
+
+@pytest.fixture
+def sites(nginx_tree):
+    """两个站点文件，其中 alpha.io 的域名分布在两个文件中"""
+    nginx_tree('a.conf', server_block('alpha.io', 'www.alpha.io') + server_block('api.alpha.io')
+               + server_block('gamma.net'))
+    nginx_tree('b.conf', server_block('shop.alpha.io') + server_block('beta.io', 'www.beta.io'))
+    return [['alpha.io', 'www.alpha.io'], ['api.alpha.io'], ['gamma.net'], ['shop.alpha.io'],
+            ['beta.io', 'www.beta.io']]
+
+
+@pytest.mark.parametrize('group_by, expected', [
+    ('config_file', [('alpha.io', ['alpha.io', 'www.alpha.io', 'api.alpha.io', 'gamma.net']),
+                     ('shop.alpha.io', ['shop.alpha.io', 'beta.io', 'www.beta.io'])]),
+    ('registered_domain', [('alpha.io', ['alpha.io', 'www.alpha.io', 'api.alpha.io', 'shop.alpha.io']),
+                           ('gamma.net', ['gamma.net']),
+                           ('beta.io', ['beta.io', 'www.beta.io'])]),
+    ('none', [('alpha.io', ['alpha.io', 'www.alpha.io']), ('api.alpha.io', ['api.alpha.io']),
+              ('gamma.net', ['gamma.net']), ('shop.alpha.io', ['shop.alpha.io']),
+              ('beta.io', ['beta.io', 'www.beta.io'])]),
+])
+def test_group_by(make_bot, stub_bin, sites, group_by, expected):
+    bot = make_bot(certbot={'group_by': group_by})
+    assert bot.scan_and_apply() == len(sites)
+
+    certs = certificates(stub_bin())
+    assert sorted(certs) == sorted(expected)
+    assert_blocks_not_split(certs, sites)
+    assert all('--nginx' in args for args in stub_bin())
+
+
+def test_max_names_split(make_bot, stub_bin, nginx_tree):
+    blocks = [[f"s{i}.alpha.io", f"www.s{i}.alpha.io"] for i in range(5)]
+    nginx_tree('a.conf', ''.join(server_block(*names) for names in blocks))
+    bot = make_bot(certbot={'max_names_per_cert': 5})
+    bot.scan_and_apply()
+
+    certs = certificates(stub_bin())
+    # 每张证书最多 5 个域名，两个域名的 server 块不会拆开：2 + 2 放得下，再加 2 就超过上限
+    assert [len(domains) for _, domains in certs] == [4, 4, 2]
+    assert_blocks_not_split(certs, blocks)
+
+
+def test_block_larger_than_limit_is_truncated_not_split(make_bot, stub_bin, nginx_tree):
+    names = [f"n{i}.alpha.io" for i in range(4)]
+    nginx_tree('a.conf', server_block(*names) + server_block('other.alpha.io'))
+    bot = make_bot(certbot={'max_names_per_cert': 3})
+    bot.scan_and_apply()
+
+    certs = certificates(stub_bin())
+    assert certs == [('n0.alpha.io', names[:3]), ('other.alpha.io', ['other.alpha.io'])]
+
+
+def test_plan_cli_matches_certbot_calls(make_bot, stub_bin, sites):
+    bot = make_bot(certbot={'group_by': 'registered_domain'})
+    output = subprocess.run([sys.executable, os.path.join(ROOT, 'ssl_bot.py'), '--config', bot.config_path, '--plan'],
+                            check=True, capture_output=True, text=True).stdout
+    plan = json.loads(output)
+    # --plan 不调用 certbot
+    assert stub_bin() == []
+    assert_blocks_not_split([(job['cert_name'], job['domains']) for job in plan], sites)
+
+    bot.scan_and_apply()
+    assert sorted(certificates(stub_bin())) == sorted((job['cert_name'], job['domains']) for job in plan)
@@ -0,0 +1,163 @@
+"""申请前预检：用本地 UDP DNS 桩服务器检查通过、剔除和推迟，以及失败缓存的内容"""
+
+import time
+import socket
+import struct
+import functools
+import threading
+import http.server
+
+import pytest
+
+import ssl_bot
+
+from conftest import server_block
+
+HOST_V4 = '203.0.113.10'
+HOST_V6 = '2001:db8::10'
+
+# 域名 -> (RCODE, {记录类型: [地址...]})
+ZONE = {
+    'ok.example.com': (0, {1: [HOST_V4]}),
+    'v6.example.com': (0, {28: [HOST_V6]}),
+    'elsewhere.example.com': (0, {1: ['198.51.100.7']}),
+    'gone.example.com': (3, {}),
+    'broken.example.com': (2, {}),
+}
+
+
+def dns_answer(query: bytes) -> bytes:
+    """按 ZONE 应答 A/AAAA 查询（未知域名返回 NXDOMAIN）"""
+    query_id = struct.unpack('!H', query[:2])[0]
+    offset, labels = 12, []
+    while query[offset]:
+        labels.append(query[offset + 1:offset + 1 + query[offset]].decode())
+        offset += query[offset] + 1
+    question = query[12:offset + 5]
+    qtype = struct.unpack('!H', query[offset + 1:offset + 3])[0]
+    rcode, records = ZONE.get('.'.join(labels).lower(), (3, {}))
+    answers = b''
+    addresses = records.get(qtype, [])
+    for address in addresses:
+        rdata = socket.inet_pton(socket.AF_INET if qtype == 1 else socket.AF_INET6, address)
+        answers += struct.pack('!HHHIH', 0xC00C, qtype, 1, 60, len(rdata)) + rdata
+    return struct.pack('!HHHHHH', query_id, 0x8180 | rcode, 1, len(addresses), 0, 0) + question + answers
+
+
+@pytest.fixture
+def dns_server():
+    """在 127.0.0.1 的随机端口上运行 UDP DNS 桩服务器，返回 "host:port" """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.1)
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            try:
+                query, addr = sock.recvfrom(512)
+            except socket.timeout:
+                continue
+            sock.sendto(dns_answer(query), addr)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield f"127.0.0.1:{sock.getsockname()[1]}"
+    stop.set()
+    thread.join()
+    sock.close()
+
+
+@pytest.fixture
+def sites(nginx_tree):
+    nginx_tree('a.conf', ''.join(server_block(name) for name in ZONE))
+
+
+def certified(calls):
+    """所有 certbot 调用中申请的域名"""
+    return sorted(args[i + 1] for args in calls for i, arg in enumerate(args) if arg == '-d')
+
+
+def test_explicit_addresses(make_bot, stub_bin, dns_server, sites):
+    bot = make_bot(preflight={'enabled': True, 'resolver': dns_server, 'addresses': [HOST_V4, HOST_V6]})
+    before = time.time()
+    assert bot.scan_and_apply() == 2
+    assert certified(stub_bin()) == ['ok.example.com', 'v6.example.com']
+
+    # 解析到其他地址和 NXDOMAIN 是确定的失败，按永久性错误退避；SERVFAIL 只推迟，不记入失败缓存
+    failures = {domain_set: (count, permanent, retry_at, error)
+                for domain_set, count, permanent, retry_at, error in bot.store.failures()}
+    assert sorted(failures) == ['elsewhere.example.com', 'gone.example.com']
+    base = ssl_bot.IssuanceScheduler.DEFAULT_FAILURE_BACKOFF['permanent_base']
+    for domain_set, (count, permanent, retry_at, error) in failures.items():
+        assert (count, permanent) == (1, 1)
+        assert before + base <= retry_at <= time.time() + base
+        assert error.startswith(f"preflight: {domain_set}")
+
+    # 失败缓存中的 server 块在退避期内不再预检和申请（certbot 桩程序不生成证书，通过的块会再次申请）
+    bot.scan_and_apply()
+    assert certified(stub_bin()) == ['ok.example.com'] * 2 + ['v6.example.com'] * 2
+    assert [row[1] for row in bot.store.failures()] == [1, 1]
+
+
+def test_detected_addresses_only_defer(make_bot, stub_bin, dns_server, sites, monkeypatch):
+    monkeypatch.setattr(ssl_bot.PreflightChecker, '_host_addresses', staticmethod(lambda: {HOST_V4}))
+    bot = make_bot(preflight={'enabled': True, 'resolver': dns_server})
+    assert bot.scan_and_apply() == 1
+    assert certified(stub_bin()) == ['ok.example.com']
+    # 自动探测的地址可能不完整，解析到其他地址只推迟；没有 A/AAAA 记录仍是确定的失败
+    assert [row[0] for row in bot.store.failures()] == ['gone.example.com']
+
+
+def test_disabled_by_default(make_bot, stub_bin, sites):
+    bot = make_bot(preflight={})
+    assert bot.scan_and_apply() == len(ZONE)
+
+
+@pytest.fixture
+def web_server(tmp_path):
+    """在 127.0.0.1 的随机端口上提供 webroot 目录的静态文件，模拟 Nginx 的验证路径"""
+    webroot = tmp_path / 'challenge'
+    webroot.mkdir()
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=str(webroot))
+    handler.log_message = lambda *args: None
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield webroot, server.server_address[1]
+    server.shutdown()
+    server.server_close()
+
+
+def probe(blocks, port, **kwargs):
+    checker = ssl_bot.PreflightChecker({'http_probe': True, 'http_port': port, 'timeout': 2},
+                                       resolver=StaticResolver(), **kwargs)
+    return checker.run(blocks)
+
+
+class StaticResolver:
+    async def resolve(self, domain):
+        return {HOST_V4}
+
+
+def block(root):
+    return {'config_file': 'a.conf', 'server_names': ['ok.example.com'], 'root_path': root}
+
+
+def test_probe_uses_challenge_webroot(tmp_path, web_server):
+    webroot, port = web_server
+    other = tmp_path / 'site'
+    other.mkdir()
+    # 共用验证目录模式下探测文件写入 challenge.webroot，而不是 server 块的 root
+    assert probe([block(str(other))], port, challenge_webroot=str(webroot)) == [block(str(other))]
+    assert probe([block(str(other))], port) == []
+    assert probe([block(str(webroot))], port) == [block(str(webroot))]
+
+
+def test_probe_skips_blocks_without_root(tmp_path):
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    # 没有 root 指令的块不探测；有 root 的块连不上 Nginx 时推迟
+    assert probe([block(None)], port) == [block(None)]
+    assert probe([block(str(tmp_path))], port) == []
@@ -0,0 +1,156 @@
+"""扫描索引：未变化的文件从索引读取，修改、版本变化和 --rebuild-index 时重新解析"""
+
+import os
+import sys
+import json
+import subprocess
+
+import pytest
+
+import ssl_bot
+
+from conftest import server_block
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """记录每次扫描实际读取解析的配置文件（文件名）"""
+    files = []
+    read = ssl_bot.NginxConfigParser._read_config_file
+
+    def counting(self, config_file):
+        files.append(os.path.basename(config_file))
+        return read(self, config_file)
+
+    monkeypatch.setattr(ssl_bot.NginxConfigParser, '_read_config_file', counting)
+    return files
+
+
+@pytest.fixture
+def scan(nginx_tree, tmp_path, parsed):
+    """用磁盘上的索引扫描一次（每次都是新的进程状态），返回 {文件名: 域名列表} 并清空解析记录"""
+    index_path = str(tmp_path / 'scan-index.json')
+
+    def run(rebuild=False):
+        parsed.clear()
+        parser = ssl_bot.NginxConfigParser(nginx_tree.root, ssl_bot.ScanIndex(index_path, rebuild=rebuild))
+        config_files = parser.find_nginx_configs()
+        blocks = parser.parse_config_files(config_files)
+        parser.save_index()
+        run.index = parser.index
+        return {os.path.basename(config_file): [block['server_names'] for block in file_blocks]
+                for config_file, file_blocks in zip(config_files, blocks)}
+
+    run.index_path = index_path
+    return run
+
+
+@pytest.fixture
+def sites(nginx_tree):
+    nginx_tree('a.conf', server_block('a.example.com'))
+    nginx_tree('b.conf', server_block('b.example.com'))
+    return os.path.join(nginx_tree.root, 'sites-enabled')
+
+
+def test_cold_then_warm(scan, sites, parsed):
+    expected = {'nginx.conf': [], 'a.conf': [['a.example.com']], 'b.conf': [['b.example.com']]}
+    assert scan() == expected
+    assert sorted(parsed) == ['a.conf', 'b.conf', 'nginx.conf']
+    assert scan.index.misses == 3
+
+    assert scan() == expected
+    assert parsed == []
+    assert scan.index.misses == 0 and scan.index.hits
+
+
+def test_modified_file_is_reparsed(scan, sites, nginx_tree, parsed):
+    scan()
+    nginx_tree('a.conf', server_block('a.example.com', 'www.a.example.com'))
+    assert scan()['a.conf'] == [['a.example.com', 'www.a.example.com']]
+    assert parsed == ['a.conf']
+
+
+def test_new_and_deleted_files(scan, sites, nginx_tree, parsed):
+    scan()
+    nginx_tree('c.conf', server_block('c.example.com'))
+    os.unlink(os.path.join(sites, 'b.conf'))
+    assert scan() == {'nginx.conf': [], 'a.conf': [['a.example.com']], 'c.conf': [['c.example.com']]}
+    assert parsed == ['c.conf']
+    with open(scan.index_path) as f:
+        entries = json.load(f)['entries']
+    assert not any(path.endswith('b.conf') for path in entries)
+
+
+def test_touch_uses_sha1_fallback(scan, sites, parsed):
+    scan()
+    path = os.path.join(sites, 'a.conf')
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    # 只有 mtime 变化、内容哈希相同：不重新解析，索引记录更新为新的 stat
+    assert scan()['a.conf'] == [['a.example.com']]
+    assert parsed == []
+    with open(scan.index_path) as f:
+        entry = json.load(f)['entries'][path]
+    assert entry['stat'] == [st.st_ino, st.st_mtime_ns + 10 ** 9, st.st_size]
+
+
+def test_same_size_different_content(scan, sites, nginx_tree, parsed):
+    scan()
+    path = os.path.join(sites, 'a.conf')
+    st = os.stat(path)
+    nginx_tree('a.conf', server_block('z.example.com'))
+    # 大小相同、mtime 变化、内容哈希不同：重新解析
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert os.stat(path).st_size == st.st_size
+    assert scan()['a.conf'] == [['z.example.com']]
+    assert parsed == ['a.conf']
+
+
+def test_version_change_discards_entries(scan, sites, parsed):
+    scan()
+    with open(scan.index_path) as f:
+        data = json.load(f)
+    data['version'] = ssl_bot.ScanIndex.VERSION - 1
+    with open(scan.index_path, 'w') as f:
+        json.dump(data, f)
+
+    assert scan()['a.conf'] == [['a.example.com']]
+    assert sorted(parsed) == ['a.conf', 'b.conf', 'nginx.conf']
+    with open(scan.index_path) as f:
+        assert json.load(f)['version'] == ssl_bot.ScanIndex.VERSION
+
+
+def test_corrupt_index(scan, sites, parsed):
+    scan()
+    with open(scan.index_path, 'w') as f:
+        f.write('{not json')
+    assert scan()['b.conf'] == [['b.example.com']]
+    assert sorted(parsed) == ['a.conf', 'b.conf', 'nginx.conf']
+
+
+def test_rebuild(scan, sites, parsed):
+    scan()
+    assert scan(rebuild=True)['a.conf'] == [['a.example.com']]
+    assert sorted(parsed) == ['a.conf', 'b.conf', 'nginx.conf']
+    scan()
+    assert parsed == []
+
+
+def test_rebuild_index_option(make_bot, stub_bin, sites, tmp_path):
+    bot = make_bot()
+    command = [sys.executable, os.path.join(ROOT, 'ssl_bot.py'), '--config', bot.config_path, '--plan']
+    subprocess.run(command, check=True, capture_output=True)
+    index_path = tmp_path / 'state' / 'index.json'
+    before = json.loads(index_path.read_text())
+    assert len(before['entries']) == 3
+
+    # --rebuild-index 丢弃旧索引：旧记录中的字段不会保留
+    before['entries'][os.path.join(sites, 'a.conf')]['data']['stale'] = True
+    index_path.write_text(json.dumps(before))
+    result = subprocess.run(command + ['--rebuild-index'], check=True, capture_output=True, text=True)
+    assert '重建扫描索引' in result.stderr
+    after = json.loads(index_path.read_text())
+    assert 'stale' not in after['entries'][os.path.join(sites, 'a.conf')]['data']
+    assert sorted(after['entries']) == sorted(before['entries'])
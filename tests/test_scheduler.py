@@ -0,0 +1,37 @@
+"""申请调度：速率限制和失败退避配置的合并"""
+
+import ssl_bot
+
+from conftest import server_block
+
+Scheduler = ssl_bot.IssuanceScheduler
+
+
+def make_scheduler(tmp_path, certbot_config):
+    manager = ssl_bot.SSLCertManager({'certbot': certbot_config})
+    return Scheduler(manager, certbot_config, str(tmp_path / 'issuance-state.json'))
+
+
+def test_partial_rate_limit_override_keeps_defaults(tmp_path):
+    scheduler = make_scheduler(tmp_path, {'rate_limits': {'global': {'limit': 100}}})
+    assert scheduler.global_limit == {'limit': 100, 'period': Scheduler.DEFAULT_RATE_LIMITS['global']['period']}
+    assert scheduler.domain_limit == Scheduler.DEFAULT_RATE_LIMITS['per_registered_domain']
+    assert scheduler.global_bucket.capacity == 100
+
+
+def test_empty_rate_limit_sections_use_defaults(tmp_path):
+    scheduler = make_scheduler(tmp_path, {'rate_limits': {'global': None, 'per_registered_domain': {}}})
+    assert scheduler.global_limit == Scheduler.DEFAULT_RATE_LIMITS['global']
+    assert scheduler.domain_limit == Scheduler.DEFAULT_RATE_LIMITS['per_registered_domain']
+
+
+def test_partial_failure_backoff_override_keeps_defaults(tmp_path):
+    scheduler = make_scheduler(tmp_path, {'failure_backoff': {'cap': 7200, 'base': None}})
+    assert scheduler.failure_backoff == dict(Scheduler.DEFAULT_FAILURE_BACKOFF, cap=7200)
+
+
+def test_global_budget_defers_jobs(make_bot, stub_bin, nginx_tree):
+    nginx_tree('a.conf', server_block('alpha.io') + server_block('beta.io'))
+    bot = make_bot(certbot={'group_by': 'none', 'rate_limits': {'global': {'limit': 1}}})
+    assert bot.scan_and_apply() == 1
+    assert len(stub_bin()) == 1